@@ -1,9 +1,25 @@
 #!/bin/bash
 
+# Build a single file by default. With --onedir, build a folder instead, which
+# starts faster because it isn't unpacked to a temporary folder every time it
+# is launched.
 source env/bin/activate
-pyinstaller --onefile --windowed --name=vessegen --distpath=./executable --clean vessegen/__main__.py
+rm -rf ./executable/vessegen
+if [ "$1" == "--onedir" ];
+then
+    pyinstaller --onedir --windowed --name=vessegen --distpath=./executable --clean vessegen/__main__.py
+else
+    pyinstaller --onefile --windowed --name=vessegen --distpath=./executable --clean vessegen/__main__.py
+fi
 deactivate
-sudo cp ./executable/vessegen /usr/bin/vessegen
+sudo rm -rf /usr/bin/vessegen /opt/vessegen
+if [ "$1" == "--onedir" ];
+then
+    sudo cp -r ./executable/vessegen /opt/vessegen
+    sudo ln -s /opt/vessegen/vessegen /usr/bin/vessegen
+else
+    sudo cp ./executable/vessegen /usr/bin/vessegen
+fi
 sudo cp ./executable/vessegen.png /usr/bin/vessegen.png
 sudo cp ./executable/vessegen.desktop /home/pi/Desktop/
-sudo reboot
\ No newline at end of file
+sudo reboot
@@ -12,7 +12,9 @@ else
         git pull --rebase
         sudo chmod +x ./bin/*
         ./bin/install-vessegen.sh
-        if [[ $1 == "desktop" ]]; then
+        if [[ $1 == "desktop" && -d /opt/vessegen ]]; then
+            ./bin/install-desktop.sh --onedir
+        elif [[ $1 == "desktop" ]]; then
             ./bin/install-desktop.sh
         fi
     else
@@ -0,0 +1,158 @@
+"""Test the HTTP API against a daemon driving a simulated board."""
+import http.client
+import json
+import os
+import socket
+import threading
+import time
+import pytest
+from vessegen import api
+from vessegen import daemon
+
+TOKEN = "secret"
+
+
+@pytest.fixture(scope="module")
+def port(tmp_path_factory):
+    """Start a daemon serving the API, returning the API's port."""
+    directory = str(tmp_path_factory.mktemp("api"))
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        number = probe.getsockname()[1]
+    process = daemon.spawn(
+        "simulated", path=os.path.join(directory, "vessegen.sock"),
+        http="127.0.0.1:" + str(number),
+        env=dict(os.environ, VESSEGEN_DATA_DIR=directory,
+                 VESSEGEN_API_TOKEN=TOKEN))
+    try:
+        give_up = time.monotonic() + 10
+        while True:
+            try:
+                get(number, "/state")
+                break
+            except OSError:
+                if time.monotonic() > give_up or process.poll() is not None:
+                    raise
+                time.sleep(0.05)
+        yield number
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def get(port_number, path, headers=None):
+    """Make a GET request, returning the response and its body."""
+    connection = http.client.HTTPConnection("127.0.0.1", port_number,
+                                            timeout=10)
+    try:
+        connection.request("GET", path, headers=headers or {})
+        response = connection.getresponse()
+        return response, response.read()
+    finally:
+        connection.close()
+
+
+def post(port_number, op, body, token=TOKEN):
+    """Make one of the daemon's requests, returning the response status."""
+    connection = http.client.HTTPConnection("127.0.0.1", port_number,
+                                            timeout=10)
+    headers = {"Content-Type": "application/json"}
+    if token is not None:
+        headers["Authorization"] = "Bearer " + token
+    try:
+        connection.request("POST", "/" + op, json.dumps(body), headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def version(port_number):
+    """Return the current version of the state."""
+    return json.loads(get(port_number, "/state")[1])["version"]
+
+
+def test_an_unchanged_state_is_not_sent_again(port):
+    response, body = get(port, "/state")
+    etag = response.getheader("ETag")
+    assert etag == '"' + str(json.loads(body)["version"]) + '"'
+    response, body = get(port, "/state", {"If-None-Match": etag})
+    assert (response.status, body) == (304, b"")
+
+    assert post(port, "set_in_use", {"chambers": [0], "in_use": True}) == 200
+    response, body = get(port, "/state", {"If-None-Match": etag})
+    assert response.status == 200
+    assert response.getheader("ETag") != etag
+
+
+def test_changes_are_waited_for(port):
+    since = version(port)
+    started = time.monotonic()
+    response, _ = get(port, "/changes?since=" + str(since) + "&wait=0.3")
+    assert response.status == 304
+    assert time.monotonic() - started >= 0.3
+
+    # A change made while the request is waiting is sent straight away
+    timer = threading.Timer(0.3, post, (port, "set_in_use",
+                                        {"chambers": [1], "in_use": True}))
+    timer.start()
+    started = time.monotonic()
+    response, body = get(port, "/changes?since=" + str(since) + "&wait=20")
+    timer.join()
+    assert response.status == 200
+    assert time.monotonic() - started < 10
+    changes = json.loads(body)
+    assert changes["ids"] == [1]
+    assert changes["chambers"][0]["is_in_use"]
+
+
+def test_the_event_stream_carries_on_from_the_last_event(port):
+    def first_event(since):
+        """Read the first event sent after a version."""
+        connection = http.client.HTTPConnection("127.0.0.1", port,
+                                                timeout=10)
+        try:
+            connection.request("GET", "/events",
+                               headers={"Last-Event-ID": str(since)})
+            response = connection.getresponse()
+            fields = {}
+            while True:
+                line = response.fp.readline().decode("utf-8").rstrip("\n")
+                if not line and fields:
+                    return fields
+                if line and not line.startswith(":"):
+                    name, _, value = line.partition(": ")
+                    fields[name] = value
+        finally:
+            connection.close()
+
+    since = version(port)
+    assert post(port, "set_in_use", {"chambers": [2], "in_use": True}) == 200
+    event = first_event(since)
+    assert event["event"] == "changed"
+    assert json.loads(event["data"])["ids"] == [2]
+
+    # Changes made while disconnected are sent on reconnecting
+    assert post(port, "set_in_use", {"chambers": [3], "in_use": True}) == 200
+    event = first_event(int(event["id"]))
+    assert json.loads(event["data"])["ids"] == [3]
+
+
+@pytest.mark.parametrize("token", [None, "wrong"])
+def test_requests_without_the_token_are_turned_down(port, token):
+    since = version(port)
+    assert post(port, "set_in_use", {"chambers": [4], "in_use": True},
+                token) == 401
+    assert version(port) == since
+    assert not json.loads(get(port, "/state")[1])["chambers"][4]["is_in_use"]
+
+
+def test_changes_to_removed_chambers_send_everything(monkeypatch):
+    state = {"run": {"active": False}, "chambers": [{"chamber_id": 0}]}
+    monkeypatch.setitem(api.feed, "state", state)
+    monkeypatch.setitem(api.feed, "version", 12)
+    monkeypatch.setitem(api.feed, "log", [(11, {"ids": [0]}),
+                                          (12, {"ids": [5]})])
+    assert api.changes_since(10) == dict(state, version=12)
+    assert api.changes_since(11) == dict(state, version=12)
@@ -0,0 +1,94 @@
+"""Test fitting the valves' flow models and looking up their times."""
+import json
+import math
+import pytest
+import vessegen
+from vessegen import calibration
+from vessegen import control
+
+
+@pytest.fixture(autouse=True)
+def empty_calibration(monkeypatch):
+    """Start every test with nothing calibrated and nothing saved."""
+    monkeypatch.setitem(calibration.calibration, "path", None)
+    monkeypatch.setitem(calibration.calibration, "models", {})
+    monkeypatch.setitem(calibration.calibration, "tables", {})
+    monkeypatch.setitem(calibration.calibration, "pulses", {})
+
+
+def concave(seconds):
+    """Return the volume of a flow that peaks just above the table's top."""
+    return 1.6002 * seconds - 0.008001 * seconds * seconds
+
+
+def test_concave_fit_peaking_just_above_the_top_builds_a_table():
+    coefficients = calibration.fit([[seconds, concave(seconds)]
+                                    for seconds in (5, 10, 20, 40)])
+    assert coefficients[2] < 0
+    assert max(concave(seconds) for seconds in range(200)) >\
+        2 * vessegen.MEDIA_VOL
+
+    table = calibration.build_table(coefficients)
+    assert len(table) == round(2 * vessegen.MEDIA_VOL /
+                               vessegen.CALIBRATION_STEP) + 1
+    assert table == sorted(table)
+    assert calibration.volume_for(coefficients, table[-1]) ==\
+        pytest.approx(2 * vessegen.MEDIA_VOL, abs=1e-3)
+
+
+def test_concave_fit_peaking_below_the_top_falls_back_to_a_line():
+    def flow(seconds):
+        return 1.1 * seconds - 0.004 * seconds * seconds
+
+    coefficients = calibration.fit([[seconds, flow(seconds)]
+                                    for seconds in (5, 10, 20, 40)])
+    assert coefficients[2] == 0.0
+    assert calibration.build_table(coefficients)
+
+
+def test_models_that_never_reach_the_top_are_refused():
+    with pytest.raises(ValueError):
+        calibration.build_table([0.0, 1.0, -0.1])
+    with pytest.raises(ValueError):
+        calibration.build_table([0.0, math.nan, 0.0])
+
+
+def test_times_are_looked_up_from_the_fitted_model():
+    calibration.calibration["pulses"][(0, "add")] = [5.0, 10.0, 20.0, 40.0]
+    model = calibration.fit_pulses(0, "add", [4.5, 9.5, 19.5, 39.5])
+    assert model["coefficients"] == pytest.approx([-0.5, 1.0, 0.0])
+    assert calibration.duration_for(0, "add", 10) == pytest.approx(10.5)
+    assert calibration.duration_for(0, "remove", 10) is None
+    assert not calibration.calibration["pulses"]
+
+
+@pytest.mark.parametrize("volumes", [[1, math.nan], [1, math.inf], [1, -2],
+                                     [1, "lots"], 3])
+def test_unusable_volumes_are_refused(volumes):
+    calibration.calibration["pulses"][(0, "add")] = [5.0, 10.0]
+    with pytest.raises(ValueError):
+        calibration.fit_pulses(0, "add", volumes)
+    assert (0, "add") not in calibration.calibration["tables"]
+
+
+@pytest.mark.parametrize("duration", [0, -1, math.nan, math.inf,
+                                      vessegen.CALIBRATION_MAX_PULSE + 1])
+def test_unusable_test_pulses_are_refused(duration):
+    with pytest.raises(ValueError):
+        control.calibration_jobs([0], "add", duration)
+
+
+def test_loading_skips_models_that_cant_be_used(tmp_path):
+    path = tmp_path / "calibration.json"
+    path.write_text(json.dumps({"models": [
+        {"chamber_id": 0, "valve": "add", "coefficients": [0.0, 1.0, 0.0]},
+        {"chamber_id": 1, "valve": "add", "coefficients": [0.0, 1.0, -0.1]}
+    ]}), encoding="utf-8")
+    calibration.load(str(path))
+    assert list(calibration.calibration["tables"]) == [(0, "add")]
+
+
+def test_volumes_that_arent_numbers_keep_the_reason():
+    with pytest.raises(ValueError) as raised:
+        calibration.fit_pulses(0, "add", [1.0, "a lot"])
+    assert isinstance(raised.value.__cause__, ValueError)
@@ -0,0 +1,57 @@
+"""Test loading the rig configuration."""
+import json
+import pytest
+import vessegen
+from vessegen import config
+from vessegen import control
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    """Put the pins, chambers and limits back after every test."""
+    monkeypatch.setattr(vessegen, "GPIO_PINS", list(vessegen.GPIO_PINS))
+    for _, name, _, _ in config.LIMITS:
+        monkeypatch.setattr(vessegen, name, getattr(vessegen, name))
+    yield
+    control.resize(len(vessegen.GPIO_PINS))
+
+
+def write(tmp_path, settings):
+    """Write a configuration file, returning its path."""
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps(settings), encoding="utf-8")
+    return str(path)
+
+
+def test_the_limits_are_used(tmp_path):
+    config.configure(write(tmp_path, {"chambers": 2, "max_open_valves": 2,
+                                      "wash_cycles": 1,
+                                      "wash_soak_time": 0.5}))
+    assert len(vessegen.GPIO_PINS) == 2
+    assert len(control.chambers) == 2
+    assert vessegen.MAX_OPEN_VALVES == 2
+    assert vessegen.WASH_CYCLES == 1
+    assert vessegen.WASH_SOAK_TIME == 0.5
+
+
+@pytest.mark.parametrize("settings", [
+    {"max_open_valves": "2"},
+    {"max_open_valves": 0},
+    {"max_open_valves": 2.5},
+    {"max_open_valves": True},
+    {"wash_cycles": -1},
+    {"wash_cycles": None},
+    {"wash_soak_time": -5},
+    {"wash_soak_time": "300"},
+    {"chambers": 0},
+    {"chambers": "2"}
+])
+def test_a_bad_setting_is_refused_before_anything_is_used(tmp_path,
+                                                          settings):
+    pins = list(vessegen.GPIO_PINS)
+    before = {name: getattr(vessegen, name) for _, name, _, _ in config.LIMITS}
+    with pytest.raises(ValueError, match=next(iter(settings))):
+        config.configure(write(tmp_path, settings))
+    assert vessegen.GPIO_PINS == pins
+    assert {name: getattr(vessegen, name)
+            for _, name, _, _ in config.LIMITS} == before
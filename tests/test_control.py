@@ -0,0 +1,85 @@
+"""Test keeping track of the chambers as their valves open and close."""
+import pytest
+from vessegen import control
+from vessegen import gpio
+from vessegen import status
+from vessegen import valves
+
+
+@pytest.fixture(autouse=True)
+def chambers():
+    """Start and end every test with fresh chambers on a simulated board."""
+    gpio.use("simulated")
+    control.reset_chambers()
+    yield
+    control.reset_chambers()
+
+
+def test_cancelling_one_chamber_leaves_the_rest_of_the_wash_running():
+    jobs = control.wash_jobs([0, 1], cycles=2, soak=10)
+    left = [list(entry) for entry in control.run["wash"]["left"]]
+
+    control.apply_valve_event(valves.progress(jobs[0], "cancelled"))
+    wash = control.run["wash"]
+    assert wash["active"]
+    assert wash["left"] == [[0.0, 0.0], left[1]]
+    assert control.chambers[1].status == control.Status.QUEUED
+
+    control.apply_valve_event(valves.progress(jobs[1], "done"))
+    assert not wash["active"]
+    assert wash["cancelled"]
+
+
+def test_a_wash_that_finishes_is_not_cancelled():
+    jobs = control.wash_jobs([0, 1], cycles=1, soak=0)
+    control.apply_valve_event(valves.progress(jobs[0], "done"))
+    assert control.run["wash"]["active"]
+    control.apply_valve_event(valves.progress(jobs[1], "done"))
+    assert not control.run["wash"]["active"]
+    assert not control.run["wash"]["cancelled"]
+
+
+def test_every_step_of_a_wash_has_a_status():
+    control.set_in_use([0], True)
+    job = control.wash_jobs([0], cycles=2, soak=10)[0]
+    shown = []
+    for event in ("opened", "closed", "opened", "closed"):
+        control.apply_valve_event(valves.progress(job, event))
+        if event == "opened":
+            job["step"] += 1
+        chamber = control.chambers[0]
+        assert isinstance(chamber.status, control.Status)
+        shown.append(status.describe(chamber.status, chamber.detail))
+    assert shown == ["Draining (cycle 1 of 2)...", "Waiting for valve...",
+                     "Filling with wash media (cycle 1 of 2)...",
+                     "Soaking..."]
+
+
+def test_the_chambers_can_be_saved_and_loaded_again():
+    control.set_in_use([0, 2], True)
+    control.add_media(None, 150)
+    job = control.calibration_jobs([2], "add", 5)[0]
+    control.apply_valve_event(valves.progress(job, "opened"))
+    saved = control.saved_state()
+
+    control.reset_chambers()
+    control.apply_state(saved)
+    assert control.saved_state() == saved
+    assert control.in_use() == [0, 2]
+    assert control.chambers[2].status == control.Status.CALIBRATING
+    assert control.chambers[2].detail == "the add valve"
+
+
+def test_a_status_saved_as_text_before_it_was_a_status_is_settled():
+    control.set_in_use([0], True)
+    saved = control.saved_state()
+    saved["chambers"][0]["status"] = "Draining (cycle 1 of 3)..."
+    del saved["chambers"][0]["detail"]
+    control.apply_state(saved)
+    assert control.chambers[0].status == control.Status.RUNNING
+    assert control.chambers[0].detail is None
+
+
+def test_chambers_only_have_their_own_fields():
+    with pytest.raises(AttributeError):
+        control.chambers[0].media = 100
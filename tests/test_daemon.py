@@ -0,0 +1,54 @@
+"""Test that the daemon turns down bad requests without changing anything."""
+import json
+import pytest
+from vessegen import control
+from vessegen import daemon
+from vessegen import gpio
+
+
+@pytest.fixture(autouse=True)
+def chambers():
+    """Start and end every test with fresh chambers on a simulated board."""
+    gpio.use("simulated")
+    control.reset_chambers()
+    yield
+    control.reset_chambers()
+
+
+def handle(line):
+    """Send the daemon a request, returning its reply."""
+    return daemon._handle(None, line)  # pylint: disable=protected-access
+
+
+@pytest.mark.parametrize("arguments", [
+    {"length": "a week"},
+    {"change_interval": [3600]},
+    {"change_interval": -1},
+    {"length": 604800, "change_interval": True}
+])
+def test_a_run_with_bad_times_is_not_started(arguments):
+    reply = handle(json.dumps(dict(arguments, op="start_run", id=1)))
+    assert "error" in reply
+    assert not control.run["active"]
+
+
+def test_bad_times_are_also_caught_when_not_finite():
+    reply = handle('{"op": "start_run", "length": Infinity}')
+    assert "error" in reply
+    assert not control.run["active"]
+
+
+def test_a_run_with_good_times_is_started():
+    reply = handle(json.dumps({"op": "start_run", "length": 604800,
+                               "change_interval": 86400.5}))
+    assert "result" in reply
+    assert control.run["change_interval"] == 86400.5
+
+
+@pytest.mark.parametrize("volume", ["Infinity", "NaN", '"nan"'])
+def test_media_that_isnt_a_number_is_not_added(volume):
+    control.set_in_use([0], True)
+    reply = handle('{"op": "add_media", "chambers": [0], "volume": ' +
+                   volume + '}')
+    assert "error" in reply
+    assert control.chambers[0].media_in_chamber == 0
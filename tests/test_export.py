@@ -0,0 +1,86 @@
+"""Test exporting the history of the chambers and reading it back."""
+import csv
+import sys
+import pytest
+import vessegen
+from vessegen import clock
+from vessegen import control
+from vessegen import export
+from vessegen import telemetry
+from vessegen.status import Status
+
+
+@pytest.fixture
+def history(tmp_path, monkeypatch):
+    """Record a short history in the data directory, then stop recording."""
+    monkeypatch.setitem(clock.clock, "current", clock.VirtualClock(1000.0))
+    monkeypatch.setattr(vessegen, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(vessegen, "TELEMETRY_CAPACITY", 4096)
+    monkeypatch.setattr(vessegen, "TELEMETRY_ROLLUPS", ((60.0, 256),))
+    monkeypatch.setattr(control, "chambers", [])
+    telemetry.start()
+    try:
+        for second in range(100):
+            telemetry.record(second % 2, "volume", second / 4,
+                             1000.0 + second)
+        telemetry.record(1, "status", telemetry.STATUS_CODES[
+            Status.REMOVING.value], 1100.0)
+    finally:
+        telemetry.stop()
+    return tmp_path
+
+
+def read_csv(path):
+    """Read a CSV file back, returning its header and rows."""
+    with open(path, newline="", encoding="utf-8") as exported:
+        rows = list(csv.reader(exported))
+    return tuple(rows[0]), rows[1:]
+
+
+def test_raw_records_round_trip_through_csv(history):
+    path = str(history / "history.csv")
+    assert export.export(path) == 101
+    header, rows = read_csv(path)
+    assert header == export.RECORD_HEADER
+    assert [(float(row[1]), int(row[2]), row[3], float(row[4]))
+            for row in rows[:-1]] == [
+        (1000.0 + second, second % 2 + 1, "volume", second / 4)
+        for second in range(100)]
+    assert rows[-1][2:] == ["2", "status", str(telemetry.STATUS_CODES[
+        Status.REMOVING.value]) + ".0", Status.REMOVING.value]
+    assert telemetry.store["raw"] is None
+
+
+def test_one_chamber_can_be_exported_as_rollups(history):
+    path = str(history / "history.csv")
+    assert export.export(path, chamber_id=0, resolution=60) == 3
+    header, rows = read_csv(path)
+    assert header == export.ROLLUP_HEADER
+    assert [(float(row[1]), row[2], row[3], int(row[4]), float(row[8]))
+            for row in rows] == [(960.0, "1", "volume", 10, 4.5),
+                                 (1020.0, "1", "volume", 30, 19.5),
+                                 (1080.0, "1", "volume", 10, 24.5)]
+
+
+def test_parquet_is_written_in_batches(history, monkeypatch):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    monkeypatch.setattr(vessegen, "EXPORT_BATCH", 7)
+    path = str(history / "history.parquet")
+    assert export.export(path) == 101
+    table = parquet.read_table(path)
+    assert tuple(table.column_names) == export.RECORD_HEADER
+    assert table.column("time").to_pylist()[:100] ==\
+        [1000.0 + second for second in range(100)]
+
+
+def test_an_unknown_format_is_turned_down(history):
+    with pytest.raises(ValueError):
+        export.export(str(history / "history.xlsx"))
+
+
+def test_parquet_without_pyarrow_says_how_to_install_it(history,
+                                                        monkeypatch):
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    with pytest.raises(ImportError, match="pip install pyarrow"):
+        export.export(str(history / "history.parquet"))
+    assert telemetry.store["raw"] is None
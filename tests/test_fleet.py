@@ -0,0 +1,52 @@
+"""Test following several rigs with the fleet viewer."""
+import os
+import signal
+import subprocess
+import sys
+import time
+import pytest
+from vessegen import fleet
+
+
+@pytest.mark.parametrize("rig, expected", [
+    ("lab=http://rig1:8080", ("lab", "http://rig1:8080")),
+    ("http://rig1:8080", ("rig1:8080", "http://rig1:8080")),
+    ("http://rig1:8080/?token=abc", ("rig1:8080",
+                                     "http://rig1:8080/?token=abc")),
+    ("lab=http://rig1:8080/?token=abc", ("lab",
+                                         "http://rig1:8080/?token=abc")),
+    ("rig1:8080", ("rig3", "rig1:8080"))
+])
+def test_a_rig_is_named_by_what_comes_before_the_first_equals(rig, expected):
+    assert fleet.parse_rig(rig, 2) == expected
+
+
+def run_fleet(tmp_path, *arguments, simulated=False):
+    """Run the fleet viewer for a moment, then stop it like the system does.
+
+    If simulated is True, this waits for the simulated rigs' directory to
+    be made first. Returns what was left in the temporary directory the
+    viewer was given.
+    """
+    process = subprocess.Popen(
+        [sys.executable, "-m", "vessegen.fleet", "--watch", *arguments],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        env=dict(os.environ, TMPDIR=str(tmp_path)))
+    give_up = time.monotonic() + 10
+    while simulated and not os.listdir(tmp_path) and\
+            time.monotonic() < give_up:
+        time.sleep(0.05)
+    assert bool(os.listdir(tmp_path)) == simulated
+    time.sleep(0.5)
+    process.send_signal(signal.SIGTERM)
+    process.wait(timeout=10)
+    return os.listdir(tmp_path)
+
+
+def test_the_simulated_rigs_are_cleaned_up(tmp_path):
+    assert run_fleet(tmp_path, "--simulate", "1", simulated=True) == []
+
+
+def test_no_directory_is_made_without_simulated_rigs(tmp_path):
+    assert run_fleet(tmp_path, "--simulate", "0",
+                     "lab=http://127.0.0.1:9") == []
@@ -0,0 +1,69 @@
+"""Test the drain model that estimates how long the valves stay open."""
+import pytest
+import vessegen
+from vessegen import calibration
+from vessegen import flow
+
+
+@pytest.fixture(autouse=True)
+def uncalibrated(monkeypatch):
+    """Start every test with no valve calibrated."""
+    monkeypatch.setitem(calibration.calibration, "tables", {})
+
+
+def drain_by_steps(target, media_in_res, diameter):
+    """Step through the drain model a second at a time, as it used to be."""
+    steps = 0
+    volume = 0
+    bulk = media_in_res
+    while volume < target:
+        step = bulk * (diameter / 2) * (diameter / 2)
+        steps += 1
+        volume += max(step, flow.MIN_FLOW)
+        bulk -= step
+    return steps, volume
+
+
+@pytest.mark.parametrize("target, media_in_res", [
+    (40, 100), (40, 60), (40, 41), (40, 40.5), (40, 40), (40, 200),
+    (10, 5), (0, 100)
+])
+@pytest.mark.parametrize("diameter", [0.5, 1.0])
+def test_the_drain_model_matches_stepping_through_it(target, media_in_res,
+                                                     diameter):
+    steps, volume = flow.solve_drain(target, media_in_res, diameter)
+    expected_steps, expected_volume = drain_by_steps(target, media_in_res,
+                                                     diameter)
+    assert steps == expected_steps
+    assert volume == pytest.approx(expected_volume, abs=1e-6)
+
+
+
+
+def test_the_drain_model_is_remembered():
+    flow.solve_drain.cache_clear()
+    flow.solve_drain(40, 100, 0.5)
+    flow.solve_drain(40, 100, 0.5)
+    assert flow.solve_drain.cache_info().hits == 1
+
+
+@pytest.mark.parametrize("add, diameter", [(False, 0.5), (True, 1.0)])
+def test_media_change_times_come_from_the_drain_model(add, diameter):
+    assert flow.calculate_media_change_time(100, add, chamber_id=0) ==\
+        flow.solve_drain(vessegen.MEDIA_VOL, 100, diameter)
+
+
+def test_a_calibrated_valve_is_timed_by_its_table(monkeypatch):
+    # A second for every CALIBRATION_STEP mL, followed on past the end
+    monkeypatch.setitem(calibration.calibration, "tables",
+                        {(0, "add"): [0.0, 1.0, 2.0]})
+    duration, volume = flow.calculate_media_change_time(10, True, 0)
+    assert volume == 10
+    assert duration == pytest.approx(10 / vessegen.CALIBRATION_STEP)
+
+    # The other valve, and the same valve without a chamber, still use the
+    # drain model
+    assert flow.calculate_media_change_time(10, False, 0) ==\
+        flow.solve_drain(vessegen.MEDIA_VOL, 10, 0.5)
+    assert flow.calculate_media_change_time(10, True) ==\
+        flow.solve_drain(vessegen.MEDIA_VOL, 10, 1.0)
@@ -0,0 +1,51 @@
+"""Test writing groups of pins to the board in one call."""
+import pytest
+from vessegen import clock
+from vessegen import gpio
+
+
+@pytest.fixture
+def board(monkeypatch):
+    """Drive a simulated board that counts the calls made to it."""
+    monkeypatch.setitem(clock.clock, "current", clock.VirtualClock(0))
+    simulated = gpio.use("simulated")
+    simulated.calls = []
+    for method in ("setup_many", "output_many"):
+        original = getattr(simulated, method)
+
+        def counted(*args, method=method, original=original):
+            simulated.calls.append(method)
+            return original(*args)
+        monkeypatch.setattr(simulated, method, counted)
+    yield simulated
+    gpio.use("simulated")
+
+
+def test_pins_are_set_up_and_switched_in_one_call_each(board):
+    gpio.output_many([3, 5, 7], gpio.HIGH)
+    assert board.calls == ["setup_many", "output_many"]
+    assert board.state == {3: gpio.HIGH, 5: gpio.HIGH, 7: gpio.HIGH}
+    assert board.transitions == [(0, 3, gpio.HIGH), (0, 5, gpio.HIGH),
+                                 (0, 7, gpio.HIGH)]
+
+    # Pins that are already set up aren't set up again
+    gpio.output_many([3, 5], gpio.LOW)
+    assert board.calls == ["setup_many", "output_many", "output_many"]
+
+
+def test_each_pin_can_be_given_its_own_value(board):
+    gpio.output_many([3, 5, 7], [gpio.HIGH, gpio.LOW, gpio.HIGH])
+    assert board.state == {3: gpio.HIGH, 5: gpio.LOW, 7: gpio.HIGH}
+    assert [pin for _, pin, _ in board.transitions] == [3, 7]
+
+
+def test_only_the_pins_not_set_up_are_set_up(board):
+    gpio.setup([3])
+    gpio.output_many([3, 5, 3], gpio.HIGH)
+    assert board.calls == ["setup_many", "setup_many", "output_many"]
+    assert gpio.board["configured"] == {3, 5}
+
+
+def test_no_pins_means_no_calls(board):
+    gpio.output_many([], gpio.HIGH)
+    assert board.calls == []
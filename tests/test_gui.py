@@ -0,0 +1,117 @@
+"""Test that the windows survive the daemon turning requests down."""
+import pytest
+
+# The windows need PySimpleGUI, which only the Raspberry Pi has installed
+pytest.importorskip("PySimpleGUI")
+from vessegen import __main__ as gui  # noqa: E402 pylint: disable=C0413
+
+
+class Daemon:
+    """Stands in for the connection to a daemon that fails every request."""
+
+    def __init__(self, error):
+        self.error = error
+        self.listener = None
+
+    def request(self, op, **arguments):
+        """Fail the request with the error."""
+        raise self.error
+
+
+@pytest.fixture(name="shown")
+def shown_errors(monkeypatch):
+    """Collect the errors shown to the user instead of showing them."""
+    shown = []
+    monkeypatch.setattr(gui, "show_error", shown.append)
+    return shown
+
+
+def test_a_request_turned_down_is_shown(monkeypatch, shown):
+    monkeypatch.setitem(gui.connection, "client",
+                        Daemon(ValueError("A run is in progress")))
+    assert gui.request("wash") is None
+    assert shown == ["That couldn't be done: A run is in progress"]
+
+
+def test_a_daemon_that_goes_away_is_connected_to_again(monkeypatch, shown):
+    reconnected = []
+    monkeypatch.setitem(gui.connection, "client",
+                        Daemon(ConnectionError("Lost the connection")))
+    monkeypatch.setattr(gui, "reconnect", lambda: reconnected.append(True))
+    assert gui.request("add_media", volume=10) is None
+    assert reconnected == [True]
+    assert len(shown) == 1
+
+
+def test_a_daemon_that_cant_be_reached_again_is_shown(monkeypatch, shown):
+    def reconnect():
+        raise ConnectionRefusedError("No daemon")
+    monkeypatch.setitem(gui.connection, "client",
+                        Daemon(ConnectionError("Lost the connection")))
+    monkeypatch.setattr(gui, "reconnect", reconnect)
+    assert gui.request("change_media") is None
+    assert "can't be reached" in shown[0]
+
+
+class Window:
+    """Stands in for a window, keeping track of what is done to it."""
+
+    built = []
+
+    def __init__(self, title, layout, **options):
+        self.layout = layout
+        self.calls = []
+        self.closed = False
+        Window.built.append(self)
+
+    def was_closed(self):
+        """Return True if the window was closed."""
+        return self.closed
+
+    def __getattr__(self, name):
+        """Note a call to any other method of the window."""
+        return lambda: self.calls.append(name)
+
+
+@pytest.fixture(name="windows")
+def built_windows(monkeypatch):
+    """Build stand-in windows instead of real ones, returning them."""
+    monkeypatch.setattr(gui.sg, "Window", Window)
+    monkeypatch.setattr(Window, "built", [])
+    monkeypatch.setattr(gui, "popups", {})
+    return Window.built
+
+
+def test_a_popup_is_built_once_and_shown_again(windows):
+    first = gui.show_popup("media", lambda: ["layout"])
+    gui.hide_popup("media", "-DONE-")
+    again = gui.show_popup("media", lambda: ["another layout"])
+    assert again is first
+    assert windows == [first]
+    assert first.layout == ["layout"]
+    assert first.calls == ["hide", "un_hide", "bring_to_front"]
+
+
+def test_a_popup_closed_by_the_user_is_built_again(windows):
+    first = gui.show_popup("media", lambda: ["layout"])
+    gui.hide_popup("media", gui.sg.WIN_CLOSED)
+    assert first.calls == ["close"]
+    assert "media" not in gui.popups
+    again = gui.show_popup("media", lambda: ["layout"])
+    assert again is not first
+    assert len(windows) == 2
+
+
+def test_a_popup_closed_behind_our_back_is_built_again(windows):
+    first = gui.show_popup("low_media", lambda: ["layout"])
+    first.closed = True
+    assert gui.show_popup("low_media", lambda: ["layout"]) is not first
+    assert len(windows) == 2
+
+
+def test_every_popup_is_closed_on_exit(windows):
+    gui.show_popup("media", lambda: ["layout"])
+    gui.show_popup("low_media", lambda: ["layout"])
+    gui.close_popups()
+    assert gui.popups == {}
+    assert [window.calls for window in windows] == [["close"], ["close"]]
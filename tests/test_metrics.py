@@ -0,0 +1,69 @@
+"""Test measuring how long things take and writing out the histograms."""
+import threading
+import types
+import pytest
+from vessegen import metrics
+
+
+@pytest.fixture(autouse=True)
+def profiling(monkeypatch):
+    """Start every test with profiling enabled and nothing measured."""
+    monkeypatch.setitem(metrics.profile, "enabled", True)
+    monkeypatch.setitem(metrics.profile, "histograms", {})
+    monkeypatch.setitem(metrics.profile, "path", None)
+    monkeypatch.setitem(metrics.profile, "wake", threading.Event())
+    monkeypatch.setitem(metrics.profile, "thread", None)
+
+
+def samples(text):
+    """Read the samples of the Prometheus text format into a dictionary."""
+    return {line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+            for line in text.splitlines() if not line.startswith("#")}
+
+
+def test_histograms_are_rendered_with_cumulative_buckets():
+    for seconds in (0.00005, 0.0001, 0.0003, 0.5, 100.0):
+        metrics.observe("poll", seconds)
+    rendered = metrics.render()
+    assert rendered.startswith("# TYPE vessegen_seconds histogram\n")
+    assert "# TYPE vessegen_seconds_max gauge\n" in rendered
+    values = samples(rendered)
+    assert values['vessegen_seconds_bucket{name="poll",le="0.0001"}'] == 2
+    assert values['vessegen_seconds_bucket{name="poll",le="0.0004"}'] == 3
+    assert values['vessegen_seconds_bucket{name="poll",le="0.8192"}'] == 4
+    assert values['vessegen_seconds_bucket{name="poll",le="+Inf"}'] == 5
+    assert values['vessegen_seconds_count{name="poll"}'] == 5
+    assert values['vessegen_seconds_sum{name="poll"}'] ==\
+        pytest.approx(100.50045)
+    assert values['vessegen_seconds_max{name="poll"}'] == 100.0
+
+    # Every bucket is sent, each counting all the measurements below it
+    buckets = [value for name, value in values.items()
+               if name.startswith("vessegen_seconds_bucket")]
+    assert len(buckets) == len(metrics.BUCKETS) + 1
+    assert buckets == sorted(buckets)
+
+
+def test_nothing_is_measured_unless_profiling_is_enabled(monkeypatch):
+    monkeypatch.setitem(metrics.profile, "enabled", False)
+    metrics.observe("poll", 0.1)
+    metrics.startup("startup")
+    assert metrics.render() == "# TYPE vessegen_seconds histogram\n" \
+        "# TYPE vessegen_seconds_max gauge\n"
+
+
+def test_instrumented_functions_are_timed_under_their_names():
+    owner = types.SimpleNamespace(__name__="vessegen.valves",
+                                  poll=lambda value: value * 2)
+    metrics.instrument(owner, "poll")
+    assert owner.poll(21) == 42
+    assert metrics.profile["histograms"]["valves.poll"]["count"] == 1
+
+
+def test_the_histograms_are_written_whole(tmp_path):
+    metrics.observe("poll", 0.001)
+    path = str(tmp_path / "metrics" / "vessegen.prom")
+    metrics.write(path)
+    with open(path, encoding="utf-8") as written:
+        assert written.read() == metrics.render()
+    assert not (tmp_path / "metrics" / "vessegen.prom.tmp").exists()
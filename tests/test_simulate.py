@@ -0,0 +1,182 @@
+"""Test the valves, media changes and journal with the headless simulator.
+
+Each test replays a script (see vessegen/simulate.py) or drives the valve
+engine against the simulated board with a virtual clock, so days of a run
+are checked in well under a second.
+"""
+import json
+import pytest
+import vessegen
+from vessegen import clock
+from vessegen import control
+from vessegen import gpio
+from vessegen import journal
+from vessegen import schedule
+from vessegen import simulate
+from vessegen import valves
+
+DAY = 86400
+
+
+@pytest.fixture(autouse=True)
+def simulated(monkeypatch):
+    """Put the clock, board and chambers back after every test."""
+    monkeypatch.setitem(clock.clock, "current", clock.SystemClock())
+    gpio.use("simulated")
+    yield
+    schedule.stop()
+    control.reset_chambers()
+
+
+def most_open(transitions):
+    """Return the most pins that were HIGH at the same time."""
+    high = set()
+    most = 0
+    for _, pin, value in transitions:
+        if value == gpio.HIGH:
+            high.add(pin)
+        else:
+            high.discard(pin)
+        most = max(most, len(high))
+    return most
+
+
+def first_opened(result, chamber, after=0):
+    """Return when a chamber's first valve opened after the given time."""
+    return min(event["time"] for event in result["events"]
+               if event["chamber"] == chamber and
+               event["event"] == "opened" and event["time"] >= after)
+
+
+@pytest.mark.parametrize("max_open", [1, 2, 3, 8])
+def test_no_more_valves_open_than_allowed(monkeypatch, max_open):
+    monkeypatch.setattr(vessegen, "MAX_OPEN_VALVES", max_open)
+    result = simulate.run_script({
+        "chambers": [1, 2, 3, 4, 5, 6],
+        "actions": [
+            {"at": 0, "action": "add_media", "volume": 100},
+            {"at": 60, "action": "change_media"}
+        ]
+    })
+    assert most_open((change["time"], change["pin"], change["value"])
+                     for change in result["pins"]) == min(max_open, 6)
+    assert sum(event["event"] == "done" for event in result["events"]) == 6
+    assert all(chamber["status"] == control.Status.RUNNING
+               for chamber in result["chambers"][:6])
+
+
+def test_media_changes_due_close_together_share_a_cycle(monkeypatch):
+    monkeypatch.setattr(vessegen, "AUTO_CHANGE_WINDOW", 600.0)
+    result = simulate.run_script({
+        "chambers": [1, 2, 3],
+        "change_interval": DAY,
+        "length": 2 * DAY - 1,
+        "actions": [
+            {"at": 0, "action": "add_media", "volume": 400},
+            # Chamber 2 comes due a few minutes after chamber 1, and
+            # chamber 3 a couple of hours after
+            {"at": 120, "action": "change_media", "chambers": [2]},
+            {"at": 7200, "action": "change_media", "chambers": [3]}
+        ]
+    })
+    assert first_opened(result, 1, DAY) == pytest.approx(DAY)
+    assert first_opened(result, 2, DAY) == pytest.approx(DAY)
+    assert first_opened(result, 3, DAY) > DAY + 7200
+
+
+def test_a_run_with_no_end_stops_once_the_valves_are_done():
+    result = simulate.run_script({
+        "chambers": [1, 2],
+        "change_interval": 3600,
+        "actions": [
+            {"at": 0, "action": "add_media", "volume": 100},
+            {"at": 60, "action": "change_media", "chambers": [1]}
+        ]
+    })
+    assert result["duration"] < 3600
+    assert [event["chamber"] for event in result["events"]
+            if event["event"] == "done"] == [1]
+
+
+def test_a_run_with_a_length_changes_the_media_until_it_ends():
+    result = simulate.run_script({
+        "chambers": [1],
+        "change_interval": DAY,
+        "length": 3 * DAY,
+        "actions": [
+            {"at": 0, "action": "add_media", "volume": 400},
+            {"at": 60, "action": "change_media"}
+        ]
+    })
+
+    # Each change is planned a day after the last one finished, and the one
+    # that would come after the run ends is left out
+    changes = [event["time"] for event in result["events"]
+               if event["event"] == "opened" and
+               event["status"] == control.Status.REMOVING]
+    assert len(changes) == 3
+    assert all(DAY < later - earlier < DAY + 3600
+               for earlier, later in zip(changes, changes[1:]))
+    assert result["duration"] < 3 * DAY
+
+
+def test_the_journal_replays_to_the_state_it_recorded(tmp_path,
+                                                      monkeypatch):
+    # Compact now and then, so the state comes from a snapshot and the
+    # changes after it
+    monkeypatch.setattr(vessegen, "JOURNAL_COMPACT_EVERY", 7)
+    assert journal.start(str(tmp_path)) is None
+    control.listeners.append(lambda kind, chamber_ids: journal.flush())
+    try:
+        simulate.run_script({
+            "chambers": [1, 3],
+            "change_interval": DAY,
+            "actions": [
+                {"at": 0, "action": "add_media", "volume": 300},
+                {"at": 3600, "action": "empty_reservoirs", "chambers": [3]},
+                {"at": 3 * DAY, "action": "end"}
+            ]
+        })
+    finally:
+        control.listeners.pop()
+        journal.stop()
+    recorded = json.loads(json.dumps(control.saved_state()))
+    assert (tmp_path / "snapshot.json").exists()
+    assert journal.load(str(tmp_path)) == recorded
+
+    # A line half written when the power went out is left out, and loading
+    # again gives the same state
+    with open(tmp_path / "journal.jsonl", "a", encoding="utf-8") as lines:
+        lines.write('{"run": {"active": fal')
+    assert journal.load(str(tmp_path)) == recorded
+    assert journal.load(str(tmp_path)) == recorded
+
+    # Restoring the state brings the run back, with the chamber that was
+    # part way through a media change running again
+    control.reset_chambers()
+    assert control.restore(journal.load(str(tmp_path)))
+    for chamber in recorded["chambers"]:
+        chamber["status"] = control.Status.RUNNING if chamber["is_in_use"]\
+            else control.Status.UNUSED
+    assert control.saved_state() == recorded
+
+
+@pytest.mark.parametrize("jump", [-3600.0, 3600.0, -DAY])
+def test_valves_keep_time_when_the_wall_clock_jumps(monkeypatch, jump):
+    virtual = clock.VirtualClock(1700000000.0)
+    monkeypatch.setitem(clock.clock, "current", virtual)
+    engine = valves.new_engine()
+    valves.submit(engine, valves.pin_job(10, 2.5, chamber_id=0))
+    assert [event for _, event in
+            valves.poll(engine, virtual.monotonic_ns())] == ["opened"]
+    deadline = valves.next_deadline(engine)
+
+    # The computer's time is corrected while the valve is open, which only
+    # moves the wall clock
+    virtual.current += jump
+    virtual.advance_to_ns(deadline - 1)
+    assert valves.poll(engine, virtual.monotonic_ns()) == []
+    virtual.advance_to_ns(deadline)
+    job, event = valves.poll(engine, virtual.monotonic_ns())[0]
+    assert event == "done"
+    assert job["timing"] == (2.5, 2.5)
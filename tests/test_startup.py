@@ -0,0 +1,23 @@
+"""Test that the windows don't load what they don't need to start up."""
+import subprocess
+import sys
+
+
+def loaded_by(*modules):
+    """Import some modules in a fresh Python, returning everything loaded."""
+    code = ("import sys\n" +
+            "".join("import " + module + "\n" for module in modules) +
+            "print('\\n'.join(sys.modules))")
+    result = subprocess.run([sys.executable, "-c", code], check=True,
+                            capture_output=True, text=True)
+    return set(result.stdout.split())
+
+
+def test_the_windows_start_without_loading_the_daemon():
+    loaded = loaded_by("vessegen.client", "vessegen.control",
+                       "vessegen.render", "vessegen.status",
+                       "vessegen.timers")
+    assert "vessegen.daemon" not in loaded
+    assert "vessegen.journal" not in loaded
+    assert "vessegen.telemetry" not in loaded
+    assert "humanize" not in loaded
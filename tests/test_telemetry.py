@@ -0,0 +1,154 @@
+"""Test reading the history of the chambers back a page at a time."""
+import math
+import pytest
+import vessegen
+from vessegen import clock
+from vessegen import control
+from vessegen import telemetry
+
+
+@pytest.fixture
+def history(tmp_path, monkeypatch):
+    """Record a history with many records sharing the same times."""
+    monkeypatch.setitem(clock.clock, "current", clock.VirtualClock(1000.0))
+    monkeypatch.setattr(vessegen, "TELEMETRY_CAPACITY", 4096)
+    monkeypatch.setattr(vessegen, "TELEMETRY_ROLLUPS", ((60.0, 256),))
+    telemetry.start(str(tmp_path))
+    try:
+        for second in range(200):
+            for chamber_id in range(3):
+                telemetry.record(chamber_id, "requested", second / 10,
+                                 1000.0 + second // 7)
+                telemetry.record(chamber_id, "achieved", second / 10,
+                                 1000.0 + second // 7)
+        yield
+    finally:
+        telemetry.stop()
+        telemetry.close_history()
+
+
+def pages(limit, **arguments):
+    """Read the whole history a page at a time.
+
+    Returns the time, chamber and kind of every record, and the number of
+    pages it took.
+    """
+    arguments = dict(start=0.0, end=1e12, **arguments)
+    records = []
+    count = 0
+    while True:
+        result = telemetry.query(limit=limit, **arguments)
+        count += 1
+        columns = [result[name] for name in ("time", "chamber", "kind")]
+        records.extend(zip(*columns))
+        if "next" not in result:
+            return records, count
+        assert len(result["time"]) == limit
+        arguments.update(result["next"])
+
+
+@pytest.mark.parametrize("limit", [1, 5, 6, 7, 64, 5000])
+@pytest.mark.parametrize("kind", [None, "achieved"])
+def test_pages_add_up_to_the_whole_history(history, limit, kind):
+    whole = telemetry.query(0.0, 1e12, kind=kind)
+    expected = list(zip(whole["time"], whole["chamber"], whole["kind"]))
+    records, count = pages(limit, kind=kind)
+    assert records == expected
+    assert count == max(math.ceil(len(expected) / limit), 1)
+
+
+def test_rollups_are_paged_at_the_same_resolution(history):
+    whole = telemetry.query(0.0, 1e12, resolution=60)
+    assert whole["resolution"] == 60
+    records, _ = pages(2, resolution=60)
+    assert records == list(zip(whole["time"], whole["chamber"],
+                               whole["kind"]))
+
+
+@pytest.fixture
+def recording(tmp_path, monkeypatch):
+    """Record into a small history, so it soon wraps around."""
+    monkeypatch.setitem(clock.clock, "current", clock.VirtualClock(1000.0))
+    monkeypatch.setattr(vessegen, "TELEMETRY_CAPACITY", 100)
+    monkeypatch.setattr(vessegen, "TELEMETRY_ROLLUPS", ((60.0, 64),))
+    monkeypatch.setattr(telemetry.RingFile, "CHUNK", 10)
+    telemetry.start(str(tmp_path))
+    try:
+        yield tmp_path
+    finally:
+        telemetry.stop()
+        telemetry.close_history()
+
+
+def test_records_stay_in_order_when_the_clock_is_set_back(recording):
+    for second in range(10):
+        telemetry.record(0, "requested", second, 1000.0 + second * 30)
+    for second in range(10):
+        telemetry.record(1, "requested", second, 1100.0 + second)
+    times = list(telemetry.query(0.0, 1e12, kind="requested")["time"])
+    assert times[:10] == [1000.0 + second * 30 for second in range(10)]
+    assert times[10:] == [1270.0] * 10
+
+    # Paging over the records from when the clock was set back repeats and
+    # skips none of them
+    records, _ = pages(3, chamber_id=1, kind="requested")
+    assert records == [(1270.0, 1, telemetry.KINDS.index("requested"))] * 10
+    rollups = list(telemetry.query(0.0, 1e12, resolution=60)["time"])
+    assert rollups == sorted(rollups)
+
+
+def test_a_scan_misses_nothing_while_the_history_wraps(recording):
+    for number in range(100):
+        telemetry.record(0, "requested", number, 1000.0 + number)
+    records = telemetry.scan(1050.0, 1e12, kind="requested")
+    seen = [next(records)[1] for _ in range(10)]
+
+    # Replace the oldest records while the scan is part way through, but not
+    # the ones it has still to read
+    for number in range(100, 130):
+        telemetry.record(0, "requested", number, 1000.0 + number)
+    seen.extend(values[1] for values in records)
+    assert seen == list(range(50, 130))
+
+
+def test_a_scan_skips_records_replaced_before_it_reached_them(recording):
+    for number in range(100):
+        telemetry.record(0, "requested", number, 1000.0 + number)
+    records = telemetry.scan(1020.0, 1e12, kind="requested")
+    assert next(records)[1] == 20
+
+    # The rest of the chunk it was reading is kept
+    for number in range(100, 150):
+        telemetry.record(0, "requested", number, 1000.0 + number)
+    assert [values[1] for values in records] ==\
+        list(range(21, 30)) + list(range(50, 150))
+
+
+def test_a_history_keeps_its_newest_records_when_its_capacity_changes(
+        recording, monkeypatch):
+    monkeypatch.setattr(control, "chambers", [])
+    telemetry.stop()
+    telemetry.start(str(recording))
+    for number in range(80):
+        telemetry.record(0, "requested", number, 1000.0 + number)
+    telemetry.stop()
+
+    monkeypatch.setattr(vessegen, "TELEMETRY_CAPACITY", 50)
+    telemetry.start(str(recording))
+    assert list(telemetry.query(1030.0, 1e12)["value"]) ==\
+        list(range(30, 80))
+    telemetry.stop()
+
+    monkeypatch.setattr(vessegen, "TELEMETRY_CAPACITY", 200)
+    telemetry.start(str(recording))
+    telemetry.record(0, "requested", 80, 1080.0)
+    assert list(telemetry.query(1030.0, 1e12)["value"]) ==\
+        list(range(30, 81))
+
+
+def test_a_file_that_is_not_a_history_is_refused(tmp_path):
+    path = tmp_path / "raw.bin"
+    path.write_bytes(b"not a history")
+    with pytest.raises(ValueError):
+        telemetry.RingFile(str(path), telemetry.RECORD, 10)
+    assert path.read_bytes() == b"not a history"
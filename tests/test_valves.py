@@ -0,0 +1,119 @@
+"""Test the valve engine directly, with a virtual clock and simulated board."""
+import pytest
+import vessegen
+from vessegen import clock
+from vessegen import gpio
+from vessegen import valves
+
+
+@pytest.fixture(autouse=True)
+def board(monkeypatch):
+    """Drive a simulated board with a virtual clock, returning the board."""
+    monkeypatch.setitem(clock.clock, "current", clock.VirtualClock(0))
+    simulated = gpio.use("simulated")
+    yield simulated
+    gpio.use("simulated")
+
+
+def run(engine):
+    """Poll the engine until it is idle, returning the events in order.
+
+    Each event is (time in seconds, chamber, event, pin), where the pin is
+    the one that opened, or None for the other events. The most pins HIGH at
+    once is checked against the engine's limit after every poll.
+    """
+    events = []
+    while not valves.is_idle(engine):
+        clock.sleep_until_ns(valves.next_deadline(engine))
+        for job, event in valves.poll(engine, clock.monotonic_ns()):
+            pin = job["steps"][job["step"]]["pin"] if event == "opened"\
+                else None
+            events.append((clock.monotonic_ns() / 1e9, job["chamber_id"],
+                           event, pin))
+        high = [pin for pin, value in gpio.get_board().state.items()
+                if value == gpio.HIGH]
+        assert len(high) <= engine["max_open"]
+        assert len(engine["running"]) == len(high)
+    return events
+
+
+@pytest.mark.parametrize("max_open", [1, 3, 8])
+def test_no_more_valves_open_than_the_limit(max_open):
+    engine = valves.new_engine(max_open)
+    for chamber_id in range(8):
+        valves.submit(engine, valves.media_change_job(chamber_id, 2.0, 1.0))
+    events = run(engine)
+
+    # As many chambers as allowed start straight away, and every chamber
+    # removes its media and then adds it back
+    assert sum(event == "opened" and when == 0
+               for when, _, event, _ in events) == max_open
+    for chamber_id in range(8):
+        pins = vessegen.GPIO_PINS[chamber_id]
+        assert [(event, pin) for _, chamber, event, pin in events
+                if chamber == chamber_id] == [
+            ("opened", pins["remove"]), ("closed", None),
+            ("opened", pins["add"]), ("done", None)]
+
+
+def test_the_limit_defaults_to_the_configured_one(monkeypatch):
+    monkeypatch.setattr(vessegen, "MAX_OPEN_VALVES", 2)
+    engine = valves.new_engine()
+    for chamber_id in range(4):
+        valves.submit(engine, valves.media_change_job(chamber_id, 2.0, 1.0))
+    valves.poll(engine, clock.monotonic_ns())
+    assert len(engine["running"]) == 2
+    run(engine)
+
+
+def test_waiting_jobs_do_not_wake_the_engine_while_it_is_full():
+    engine = valves.new_engine(1)
+    valves.submit(engine, valves.pin_job(10, 5.0))
+    valves.submit(engine, valves.pin_job(11, 1.0))
+    valves.poll(engine, clock.monotonic_ns())
+    assert valves.next_deadline(engine) == round(5e9)
+
+
+def test_a_closed_valve_is_reported_by_its_own_pin():
+    engine = valves.new_engine()
+    valves.submit(engine, valves.media_change_job(0, 2.0, 1.0))
+    pins = vessegen.GPIO_PINS[0]
+    reported = []
+    while not valves.is_idle(engine):
+        clock.sleep_until_ns(valves.next_deadline(engine))
+        reported.extend((event, valves.progress(job, event)["pin"])
+                        for job, event in valves.poll(engine,
+                                                      clock.monotonic_ns()))
+    assert reported == [("opened", pins["remove"]),
+                        ("closed", pins["remove"]),
+                        ("opened", pins["add"]), ("done", pins["add"])]
+
+
+def test_a_soaking_chamber_leaves_the_valves_to_the_others():
+    engine = valves.new_engine(1)
+    for chamber_id in range(2):
+        valves.submit(engine, valves.wash_job(chamber_id, 2.0, [1.0, 1.0],
+                                              soak=10.0))
+    events = run(engine)
+
+    # Each chamber drains and fills for every cycle, then drains once more
+    for chamber_id in range(2):
+        pins = vessegen.GPIO_PINS[chamber_id]
+        assert [pin for _, chamber, event, pin in events
+                if chamber == chamber_id and event == "opened"] ==\
+            [pins["remove"], pins["add"]] * 2 + [pins["remove"]]
+
+    # With one valve to share, the chambers take turns, each using it while
+    # the other's valve settles or the other soaks, and each carries on as
+    # soon as its soak is over
+    opened = [(when, chamber) for when, chamber, event, _ in events
+              if event == "opened"]
+    assert [chamber for _, chamber in opened] == [0, 1] * 5
+    settle = vessegen.VALVE_SETTLE_TIME
+    assert [when for when, _ in opened[:4]] == [0.0, 2.0, 4.0, 5.0]
+    assert opened[4][0] == pytest.approx(5.0 + settle + 10.0)
+    assert opened[5][0] == pytest.approx(opened[4][0] + 2.0)
+
+    # So washing both takes far less than twice as long as washing one
+    alone = 3 * 2.0 + 2 * 1.0 + 2 * 10.0 + 4 * settle
+    assert events[-1][0] < 1.25 * alone
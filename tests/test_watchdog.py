@@ -0,0 +1,157 @@
+"""Test that the watchdog closes valves the actuator leaves open."""
+import threading
+import time
+import pytest
+import vessegen
+from vessegen import actuator
+from vessegen import clock
+from vessegen import gpio
+from vessegen import valves
+from vessegen import watchdog
+
+
+@pytest.fixture(autouse=True)
+def board(monkeypatch):
+    """Drive a simulated board with a fresh watchdog, returning the board."""
+    monkeypatch.setitem(clock.clock, "current", clock.VirtualClock(0))
+    monkeypatch.setitem(watchdog.watch, "armed", {})
+    monkeypatch.setitem(watchdog.watch, "heartbeat", None)
+    monkeypatch.setitem(watchdog.watch, "lock", threading.Lock())
+    monkeypatch.setitem(watchdog.watch, "dead", False)
+    monkeypatch.setitem(watchdog.watch, "listener", None)
+    simulated = gpio.use("simulated")
+    yield simulated
+    gpio.use("simulated")
+
+
+def open_valve(pin, duration, chamber_id=0):
+    """Open a pin through the valve engine and tell the watchdog about it."""
+    engine = valves.new_engine()
+    valves.submit(engine, valves.pin_job(pin, duration, chamber_id))
+    valves.poll(engine, clock.monotonic_ns())
+    watchdog.track(engine)
+    return engine
+
+
+def test_an_overdue_pin_is_forced_low(board):
+    heard = []
+    watchdog.set_listener(heard.append)
+    open_valve(10, 1.0)
+    assert board.state[10] == gpio.HIGH
+
+    grace = round(vessegen.WATCHDOG_GRACE * 1e9)
+    clock.sleep_until_ns(round(1e9) + grace - 1)
+    assert watchdog.check(clock.monotonic_ns()) == []
+    assert board.state[10] == gpio.HIGH
+
+    clock.sleep_until_ns(round(1e9) + grace)
+    interventions = watchdog.check(clock.monotonic_ns())
+    assert [(forced["pin"], forced["chamber_id"], forced["event"])
+            for forced in interventions] == [(10, 0, "forced")]
+    assert interventions[0]["late"] == pytest.approx(vessegen.WATCHDOG_GRACE)
+    assert heard == interventions
+    assert board.state[10] == gpio.LOW
+    assert watchdog.next_deadline() is None
+
+
+def test_a_dead_actuator_closes_every_valve(board):
+    # One pin the watchdog knows about, and one the actuator opened just
+    # before it died
+    open_valve(12, 100.0, chamber_id=0)
+    gpio.output(11, gpio.HIGH)
+    watchdog.watch["heartbeat"] = lambda: None
+
+    interventions = watchdog.check(clock.monotonic_ns())
+    assert [forced["pin"] for forced in interventions] == [12]
+    assert all(board.state.get(pin, gpio.LOW) == gpio.LOW
+               for pins in vessegen.GPIO_PINS
+               for pin in (pins["add"], pins["remove"]))
+
+    # Once every valve is closed, nothing more is done
+    assert watchdog.check(clock.monotonic_ns()) == []
+
+
+def test_a_stuck_actuator_closes_every_valve(board):
+    open_valve(12, 100.0)
+    beat = clock.monotonic_ns()
+    watchdog.watch["heartbeat"] = lambda: beat
+
+    # The actuator goes round its loop at least every WATCHDOG_INTERVAL, so
+    # a heartbeat that is a little old is fine
+    clock.sleep_until_ns(beat + round(vessegen.WATCHDOG_STALL * 1e9))
+    assert watchdog.check(clock.monotonic_ns()) == []
+    assert board.state[12] == gpio.HIGH
+
+    clock.sleep_until_ns(beat + round(vessegen.WATCHDOG_STALL * 1e9) + 1)
+    assert [forced["pin"] for forced in
+            watchdog.check(clock.monotonic_ns())] == [12]
+    assert board.state[12] == gpio.LOW
+
+
+def test_an_actuator_stuck_opening_a_valve_is_caught(board, monkeypatch):
+    monkeypatch.setattr(vessegen, "WATCHDOG_STALL", 0.05)
+    open_valve(12, 100.0)
+    with watchdog.writing():
+        assert [forced["pin"] for forced in
+                watchdog.check(clock.monotonic_ns())] == [12]
+    assert board.state[12] == gpio.LOW
+
+
+def test_a_pin_opened_again_is_left_open(board):
+    engine = open_valve(10, 1.0)
+    grace = round(vessegen.WATCHDOG_GRACE * 1e9)
+    clock.sleep_until_ns(round(1e9) + grace)
+    valves.submit(engine, valves.pin_job(10, 5.0, chamber_id=1))
+
+    # The actuator closes the pin and opens it again for the next job, and
+    # the watchdog checks before it has been told
+    checked = []
+    checker = threading.Thread(
+        target=lambda: checked.extend(watchdog.check(clock.monotonic_ns())))
+    with watchdog.writing():
+        assert [event for _, event in
+                valves.poll(engine, clock.monotonic_ns())] ==\
+            ["done", "opened"]
+        checker.start()
+        checker.join(0.1)
+        assert checker.is_alive()
+        watchdog.track(engine)
+    checker.join()
+    assert checked == []
+    assert board.state[10] == gpio.HIGH
+
+
+@pytest.mark.filterwarnings(
+    "ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_an_actuator_that_dies_opening_a_valve_is_caught(board, monkeypatch):
+    monkeypatch.setitem(clock.clock, "current", clock.SystemClock())
+    monkeypatch.setitem(actuator.worker, "thread", None)
+    actuator.start()
+    watchdog.start(heartbeat=actuator.heartbeat)
+    try:
+        # A valve that can't be timed kills the actuator once it is HIGH
+        actuator.submit(valves.pin_job(10, float("inf")))
+        give_up = time.monotonic() + 5
+        while actuator.is_running() and time.monotonic() < give_up:
+            time.sleep(0.01)
+        assert not actuator.is_running()
+        assert (10, gpio.HIGH) in [(pin, value) for _, pin, value in
+                                   board.transitions]
+        time.sleep(vessegen.WATCHDOG_INTERVAL * 4)
+        assert board.state[10] == gpio.LOW
+    finally:
+        watchdog.stop()
+        actuator.worker["thread"] = None
+
+
+def test_an_idle_actuator_keeps_its_heartbeat_fresh(monkeypatch):
+    monkeypatch.setitem(clock.clock, "current", clock.SystemClock())
+    monkeypatch.setitem(actuator.worker, "thread", None)
+    actuator.start()
+    try:
+        time.sleep(vessegen.WATCHDOG_INTERVAL * 3)
+        age = clock.monotonic_ns() - actuator.heartbeat()
+        assert age <= round(vessegen.WATCHDOG_INTERVAL * 2 * 1e9)
+    finally:
+        actuator.stop()
+    assert actuator.heartbeat() is None
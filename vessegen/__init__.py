@@ -1,56 +1,157 @@
 """A program for running Vessegen's Bioreactor."""
-import RPi.GPIO as GPIO  # pylint: disable=consider-using-from-import
+import os
 
 # Declare the amount that should occur in a media change
 MEDIA_VOL = 40.0
 
+# Declare the maximum number of solenoids that may be open at the same time.
+# Each open solenoid draws current from the same power supply, so lower this if
+# the supply cannot drive every chamber at once.
+MAX_OPEN_VALVES = 8
+
+# Declare how long to wait after closing a solenoid before opening the next
+# one for the same chamber (in seconds)
+VALVE_SETTLE_TIME = 0.1
+
+# Declare how long before a solenoid is due to close the valve thread stops
+# sleeping and watches the clock instead, since sleeping can wake up late (in
+# seconds)
+VALVE_SPIN_TIME = 0.002
+
+# Declare how long after its deadline a solenoid may still be open before the
+# watchdog closes it, how often the watchdog checks that the valve thread is
+# still running, and how long the valve thread may go without going round its
+# loop before it is treated as stuck (in seconds). If the valve thread dies,
+# every solenoid is closed within WATCHDOG_INTERVAL, and if it gets stuck,
+# within WATCHDOG_STALL and WATCHDOG_INTERVAL. The valve thread shares Python
+# with the rest of the daemon, and closed its valves up to 4 ms late with one
+# other busy thread and up to 90 ms late with three on a desktop computer, so
+# the grace period leaves room for a slower Raspberry Pi.
+WATCHDOG_GRACE = 0.1
+WATCHDOG_INTERVAL = 0.05
+WATCHDOG_STALL = 1.0
+
+# Declare how many times a wash drains the chambers and fills them with wash
+# media, and how long the wash media soaks in the chambers after each fill (in
+# seconds). The chambers are drained once more at the end.
+WASH_CYCLES = 3
+WASH_SOAK_TIME = 300.0
+
+# Declare how long the valves are opened for when calibrating a chamber, and
+# the longest test pulse that may be asked for (in seconds), and how finely
+# the calibrated volumes are looked up (in mL). The lookup tables cover up to
+# twice the volume of a media change.
+CALIBRATION_PULSES = (5.0, 10.0, 20.0, 40.0)
+CALIBRATION_MAX_PULSE = 60.0
+CALIBRATION_STEP = 0.1
+
+# Declare how far ahead of time a chamber's automatic media change may be
+# pulled forward so that it runs in the same cycle as other chambers that are
+# due (in seconds)
+AUTO_CHANGE_WINDOW = 600.0
+
+# Declare where the software keeps its data between runs
+DATA_DIR = os.environ.get("VESSEGEN_DATA_DIR",
+                          os.path.expanduser("~/.vessegen"))
+
+# Declare how often the state journal is written to disk (in seconds). Changes
+# are grouped together in between to go easy on the SD card.
+JOURNAL_FLUSH_INTERVAL = 5.0
+
+# Declare how many changes the journal holds before it is compacted into a
+# snapshot
+JOURNAL_COMPACT_EVERY = 1000
+
+# Declare how many records of chamber history are kept (16 bytes each), and
+# the lengths of the buckets they are rolled up into for the longer term (in
+# seconds) along with how many buckets of each length are kept (32 bytes
+# each). By default this is about a month of raw records for a busy rig, and
+# years of hourly history. Changing these keeps the newest records already
+# kept, as many as there is room for.
+TELEMETRY_CAPACITY = 1 << 20
+TELEMETRY_ROLLUPS = ((60.0, 1 << 18), (3600.0, 1 << 16))
+
+# Declare the most records of chamber history the daemon sends in one reply.
+# Longer histories are sent a page at a time, which keeps each reply well
+# under SOCKET_BACKLOG_LIMIT.
+HISTORY_PAGE = 5000
+
+# Declare how often the chamber history is written to disk (in seconds)
+TELEMETRY_FLUSH_INTERVAL = 60.0
+
+# Declare how many rows are written at a time when exporting to Parquet
+EXPORT_BATCH = 10000
+
+# Declare how often the measurements are written out when profiling (in
+# seconds)
+METRICS_INTERVAL = 10.0
+
+# Declare where the daemon listens for the windows and other clients
+SOCKET_PATH = os.environ.get("VESSEGEN_SOCKET",
+                             os.path.join(DATA_DIR, "vessegen.sock"))
+
+# Declare how many bytes may be waiting to be sent to a client of the daemon
+# before it is disconnected for not keeping up
+SOCKET_BACKLOG_LIMIT = 1024 * 1024
+
+# Declare how many changes the HTTP API remembers for clients catching up,
+# and how long a client may wait for a change (in seconds)
+API_HISTORY = 1000
+API_MAX_WAIT = 30.0
+
+# Declare the token needed to make requests that change anything through the
+# HTTP API. Without one, anyone who can reach the API can make them.
+API_TOKEN = os.environ.get("VESSEGEN_API_TOKEN")
+
 # Declare the icon path for the windows
 ICON_PATH = '/usr/bin/vessegen.png'
 
-# Create a list of dictionaries to keep track of which GPIO pins are for which
-# chamber
-GPIO_PINS = [
-    {
-        "add": 10,
-        "remove": 12
-    },
-    {
-        "add": 11,
-        "remove": 13
-    },
-    {
-        "add": 18,
-        "remove": 19
-    },
-    {
-        "add": 21,
-        "remove": 22
-    },
-    {
-        "add": 23,
-        "remove": 24
-    },
-    {
-        "add": 31,
-        "remove": 32
-    },
-    {
-        "add": 33,
-        "remove": 35
-    },
-    {
-        "add": 36,
-        "remove": 38
-    }
-]
-
-# Disable GPIO warnings (very common to do)
-GPIO.setwarnings(False)  # pylint: disable=no-member
-
-# Set up the GPIO pins
-GPIO.setmode(GPIO.BOARD)  # pylint: disable=no-member
-for chamber in GPIO_PINS:
-    GPIO.setup(chamber["add"], GPIO.OUT)  # pylint: disable=no-member
-    GPIO.setup(chamber["remove"], GPIO.OUT)  # pylint: disable=no-member
-    GPIO.output(chamber["add"], GPIO.LOW)  # pylint: disable=no-member
-    GPIO.output(chamber["remove"], GPIO.LOW)  # pylint: disable=no-member
+# Declare where the configuration file is kept. It can choose a pin map and
+# add pin maps of its own, see vessegen/config.py.
+CONFIG_PATH = os.environ.get("VESSEGEN_CONFIG",
+                             os.path.join(DATA_DIR, "config.json"))
+
+# Create the pin maps that can be chosen from. Each pin map is a list of
+# dictionaries to keep track of which GPIO pins are for which chamber, and the
+# number of chambers is the length of the pin map.
+PIN_MAPS = {
+    "default": [
+        {
+            "add": 10,
+            "remove": 12
+        },
+        {
+            "add": 11,
+            "remove": 13
+        },
+        {
+            "add": 18,
+            "remove": 19
+        },
+        {
+            "add": 21,
+            "remove": 22
+        },
+        {
+            "add": 23,
+            "remove": 24
+        },
+        {
+            "add": 31,
+            "remove": 32
+        },
+        {
+            "add": 33,
+            "remove": 35
+        },
+        {
+            "add": 36,
+            "remove": 38
+        }
+    ]
+}
+
+# The pins for the chambers in use, which is the default pin map unless the
+# configuration says otherwise. The pins are set up by vessegen.gpio the first
+# time they are used.
+GPIO_PINS = list(PIN_MAPS["default"])
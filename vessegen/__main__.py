@@ -1,22 +1,23 @@
-"""Get user input and run the bioreactor."""
-import time
+"""Get user input and run the bioreactor.
+
+The windows are a client of the daemon in vessegen/daemon.py, which drives
+the valves. The daemon is started if it isn't already running, and it keeps
+running the experiment if the windows are closed.
+"""
+import argparse
 import datetime
 import PySimpleGUI as sg
-import humanize
-import atexit
-import RPi.GPIO as GPIO  # pylint: disable=consider-using-from-import
+import os
+import sys
+import threading
 import vessegen
-
-# Initialize a structure to keep track of chambers
-chambers = []
-for n in range(8):
-    chambers.append({
-        "chamber_id": n + 1,
-        "is_in_use": False,
-        "last_changed": None,
-        "media_in_chamber": 0,
-        "status": "Unused"
-    })
+from vessegen import client
+from vessegen import clock
+from vessegen import control
+from vessegen import render
+from vessegen import status
+from vessegen import timers
+from vessegen.control import chambers
 
 # Initialize a shutdown dictionary to control shutdown if desired
 shutdown = {
@@ -24,27 +25,38 @@ shutdown = {
     "settings": False,
 }
 
+# Keep track of the connection to the daemon, along with the socket it is
+# on and how to start it, so it can be connected to again if it goes away
+connection = {
+    "client": None,
+    "path": None,
+    "spawn": None
+}
 
-def reset_chambers():
-    """Reset the chambers if requested.
+# Keep track of whether the windows are being measured (with --profile).
+# Nothing to do with measuring is loaded unless they are.
+profiling = {
+    "enabled": False
+}
 
-    This is useful since the software is set up to run on a loop until told to
-    stop, meaning there may be multiple trials run in between stopping the
-    software. Thus, the chambers need to be reset in between trials.
-    """
-    for chamber in chambers:
-        chamber["is_in_use"] = False
-        chamber["last_changed"] = None
-        chamber["media_in_chamber"] = 0
-        chamber["status"] = "Unused"
-        GPIO.output(vessegen.GPIO_PINS[chamber["chamber_id"] - 1]["remove"],
-                    GPIO.LOW)
-        GPIO.output(vessegen.GPIO_PINS[chamber["chamber_id"] - 1]["add"],
-                    GPIO.LOW)
+# Keep the popup windows that have been built, keyed by name, so they can be
+# shown again without building them each time
+popups = {}
+
+# Initialize a settings dictionary to hold the run settings chosen by the user
+# (in seconds, or None if not set)
+settings = {
+    "length": None,
+    "change_interval": None
+}
 
 
 def get_user_settings():
     """Get the user input in a graphical format."""
+    # Start with the default settings
+    settings["length"] = None
+    settings["change_interval"] = None
+
     # Set the font and the theme of the GUI
     default_font = 'Roboto 20'
     sg.theme('LightGray1')
@@ -59,35 +71,24 @@ def get_user_settings():
 
     # Define the layout to allow the user to select the chambers that will be
     # in use. Really, this just makes a bunch of checkboxes.
+    # There are two checkboxes to a row, or four for larger rigs, and they
+    # scroll if there are too many rows to fit on the screen.
+    checkbox_keys = {'chamber' + str(i + 1): i for i in range(len(chambers))}
+    per_row = 2 if len(chambers) <= 8 else 4
+    checkboxes = [[sg.Checkbox('Chamber ' + str(i + 1), default=False,
+                               font=default_font, key='chamber' + str(i + 1),
+                               enable_events=True)
+                   for i in range(row, min(row + per_row, len(chambers)))]
+                  for row in range(0, len(chambers), per_row)]
+    if len(checkboxes) > 4:
+        checkboxes = [[sg.Column(checkboxes, scrollable=True,
+                                 vertical_scroll_only=True, size=(None, 200))]]
     chamber_layout = [[sg.Text(text="Which chambers will you be using?",
                                font='Roboto 30', pad=((0, 0), (120, 20)))],
                       [sg.Checkbox('Select All', default=False,
                                    font=default_font, key='selectallchamber',
                                    enable_events=True)],
-                      [sg.Checkbox('Chamber 1', default=False,
-                                   font=default_font, key='chamber1',
-                                   enable_events=True),
-                       sg.Checkbox('Chamber 2', default=False,
-                                   font=default_font, key='chamber2',
-                                   enable_events=True)],
-                      [sg.Checkbox('Chamber 3', default=False,
-                                   font=default_font, key='chamber3',
-                                   enable_events=True),
-                       sg.Checkbox('Chamber 4', default=False,
-                                   font=default_font, key='chamber4',
-                                   enable_events=True)],
-                      [sg.Checkbox('Chamber 5', default=False,
-                                   font=default_font, key='chamber5',
-                                   enable_events=True),
-                       sg.Checkbox('Chamber 6', default=False,
-                                   font=default_font, key='chamber6',
-                                   enable_events=True)],
-                      [sg.Checkbox('Chamber 7', default=False,
-                                   font=default_font, key='chamber7',
-                                   enable_events=True),
-                       sg.Checkbox('Chamber 8', default=False,
-                                   font=default_font, key='chamber8',
-                                   enable_events=True)],
+                      *checkboxes,
                       [sg.Button("Submit Chambers", font=default_font,
                                  pad=(5, 20)),
                        sg.Cancel(font=default_font, pad=(5, 20),
@@ -108,49 +109,59 @@ def get_user_settings():
     #                              sg.Cancel(font=default_font, pad=(5,20),
     #                                        key='Cancel2')]]
 
-    # Allows the user to specify how long the experiment will run
-    # same_settings_time = [[sg.Text(text="How long should the experiment \
-    #                                run for?", font='Roboto 30', pad=(0,20))],
-    #                       [sg.InputText(size=(2,2), font=default_font,
-    #                                       default_text='0'),
-    #                       sg.Text(text="weeks,", font=default_font),
-    #                       sg.InputText(size=(2,2), font=default_font,
-    #                                       default_text='0'),
-    #                       sg.Text(text="days,", font=default_font),
-    #                       sg.InputText(size=(2,2), font=default_font,
-    #                                       default_text='0'),
-    #                       sg.Text(text="hours", font=default_font)],
-    #                      [sg.Button("Next", font=default_font, pad=(5,20),
-    #                                 key='samesettingstimenext'),
-    #                       sg.Cancel(font=default_font, pad=(5,20),
-    #                                 key='Cancel3')]]
-
-    # If we were doing automated media changes, this would allow the user to
-    # specify the time between media changes for each chamber.
-    # same_settings_media = [[sg.Text(text="How much time should there be \
-    #                                 between media changes?",font='Roboto 30',
-    #                                 pad=(0,20))],
-    #                        [sg.InputText(size=(2,2), font=default_font,
-    #                                        default_text='0'),
-    #                         sg.Text(text="days,", font=default_font),
-    #                         sg.InputText(size=(2,2), font=default_font,
-    #                                      default_text='0'),
-    #                         sg.Text(text="hours", font=default_font)],
-    #                        [sg.Button("Next", font=default_font, pad=(5,20),
-    #                                   key='samesettingsmedianext'),
-    #                         sg.Cancel(font=default_font, pad=(5,20),
-    #                                   key='Cancel4')]]
+    # Allows the user to specify how long the experiment will run. Leaving
+    # everything at zero runs the experiment until the user finishes it.
+    time_layout = [[sg.Text(text="How long should the experiment run for?",
+                            font='Roboto 30', pad=((0, 0), (120, 20)))],
+                   [sg.InputText(size=(2, 2), font=default_font,
+                                 default_text='0', key='-LENGTHWEEKS-'),
+                    sg.Text(text="weeks,", font=default_font),
+                    sg.InputText(size=(2, 2), font=default_font,
+                                 default_text='0', key='-LENGTHDAYS-'),
+                    sg.Text(text="days,", font=default_font),
+                    sg.InputText(size=(2, 2), font=default_font,
+                                 default_text='0', key='-LENGTHHOURS-'),
+                    sg.Text(text="hours", font=default_font)],
+                   [sg.Text(text="Leave at zero to run until you select "
+                            "'Finish'.", font='Roboto 15', pad=(0, 10))],
+                   [sg.Button("Next", font=default_font, pad=(5, 20),
+                              key='samesettingstimenext'),
+                    sg.Cancel(font=default_font, pad=(5, 20),
+                              key='Cancel3')]]
+
+    # Allows the user to specify the time between automatic media changes.
+    # Leaving everything at zero means the media is only changed by hand.
+    media_layout = [[sg.Text(text="How much time should there be between "
+                             "media changes?", font='Roboto 30',
+                             pad=((0, 0), (120, 20)))],
+                    [sg.InputText(size=(2, 2), font=default_font,
+                                  default_text='0', key='-CHANGEDAYS-'),
+                     sg.Text(text="days,", font=default_font),
+                     sg.InputText(size=(2, 2), font=default_font,
+                                  default_text='0', key='-CHANGEHOURS-'),
+                     sg.Text(text="hours", font=default_font)],
+                    [sg.Text(text="Leave at zero to only change the media by "
+                             "hand.", font='Roboto 15', pad=(0, 10))],
+                    [sg.Button("Next", font=default_font, pad=(5, 20),
+                               key='samesettingsmedianext'),
+                     sg.Cancel(font=default_font, pad=(5, 20),
+                               key='Cancel4')]]
 
     # Put the various layouts into a list so we can call them
     layout = [[sg.Column(start_layout, key='-STARTCOL-',
                          element_justification='center'),
                sg.Column(chamber_layout, visible=False, key='-CHAMBERCOL-',
+                         element_justification='center'),
+               sg.Column(time_layout, visible=False, key='-TIMECOL-',
+                         element_justification='center'),
+               sg.Column(media_layout, visible=False, key='-MEDIACOL-',
                          element_justification='center')]]
 
     # Initialize the window
     window = sg.Window("Vessegen Bioreactor Software", layout,
                        element_justification='center', size=(1024, 595),
-                       icon=vessegen.ICON_PATH)
+                       finalize=True, icon=vessegen.ICON_PATH)
+    measure_startup()
 
     # Start in the starting window column
     current_layout = '-STARTCOL-'
@@ -158,7 +169,7 @@ def get_user_settings():
     # Loop until the user closes the window (or submits the settings)
     while True:
         # Read the user input from the GUI
-        event, values = window.read()
+        event, values = timers.read(window)
 
         # If the user selects close from the start page or closes the window,
         # exit the entire program
@@ -169,7 +180,7 @@ def get_user_settings():
 
         # If the user has selected one of the subwindow cancel buttons, send
         # them back to the starting screen
-        if event in ('Cancel1', 'Cancel2', 'Cancel3'):
+        if event in ('Cancel1', 'Cancel2', 'Cancel3', 'Cancel4'):
             shutdown["settings"] = True
             break
 
@@ -183,164 +194,122 @@ def get_user_settings():
         # If the user has selected "Select All", then select all the chambers
         elif (event == 'selectallchamber' and
               values['selectallchamber']):
-            # Update all the checkboxes in the window
-            window['chamber1'].update(True)
-            window['chamber2'].update(True)
-            window['chamber3'].update(True)
-            window['chamber4'].update(True)
-            window['chamber5'].update(True)
-            window['chamber6'].update(True)
-            window['chamber7'].update(True)
-            window['chamber8'].update(True)
-
-            # Update the data structure containing information on the chambers
-            for j in range(8):
-                chambers[j]["is_in_use"] = True
-                chambers[j]["status"] = "Running"
+            # Update all the checkboxes in the window, along with the data
+            # structure containing information on the chambers
+            for key in checkbox_keys:
+                window[key].update(True)
+            request("set_in_use", chambers=list(checkbox_keys.values()),
+                    in_use=True)
 
         # If the user unselected "Select All", then deselect all the chambers
         elif (event == 'selectallchamber' and
               not values['selectallchamber']):
-            # Update all the checkboxes in the window
-            window['chamber1'].update(False)
-            window['chamber2'].update(False)
-            window['chamber3'].update(False)
-            window['chamber4'].update(False)
-            window['chamber5'].update(False)
-            window['chamber6'].update(False)
-            window['chamber7'].update(False)
-            window['chamber8'].update(False)
-
-            # Update the data structure containing information on the chambers
-            for j in range(8):
-                chambers[j]["is_in_use"] = False
-                chambers[j]["status"] = "Unused"
+            # Update all the checkboxes in the window, along with the data
+            # structure containing information on the chambers
+            for key in checkbox_keys:
+                window[key].update(False)
+            request("set_in_use", chambers=list(checkbox_keys.values()),
+                    in_use=False)
 
         # If the user has selected a single chamber, then set it as in use if
         # it wasn't and as unused if it was in use
-        elif event in ('chamber1', 'chamber2', 'chamber3', 'chamber4',
-                       'chamber5', 'chamber6', 'chamber7', 'chamber8'):
+        elif event in checkbox_keys:
             # See if the select all box was checked, unchecking it if so
             if values['selectallchamber']:
                 window['selectallchamber'].update(False)
 
-            # Set the chamber to the opposite of is_in_use as it was
-            chambers[int(event[7]) - 1]["is_in_use"] =\
-                not chambers[int(event[7]) - 1]["is_in_use"]
+            # Set the chamber to match its checkbox
+            request("set_in_use", chambers=[checkbox_keys[event]],
+                    in_use=values[event])
+
+        # If the user submits their chamber selection, then ask them how long
+        # the experiment will run
+        elif event == 'Submit Chambers':
+            window[current_layout].update(visible=False)
+            current_layout = '-TIMECOL-'
+            window[current_layout].update(visible=True)
 
-            # Make sure the status correlates to its is_in_use (this is just
-            # a "fancy" one line if else statement)
-            chambers[int(event[7]) - 1]["status"] = "Running" if\
-                chambers[int(event[7]) - 1]["is_in_use"] else "Unused"
+        # Once the user has said how long the experiment will run, ask them
+        # how often the media should be changed
+        elif event == 'samesettingstimenext':
+            settings["length"] = read_duration(values, weeks='-LENGTHWEEKS-',
+                                               days='-LENGTHDAYS-',
+                                               hours='-LENGTHHOURS-')
+            window[current_layout].update(visible=False)
+            current_layout = '-MEDIACOL-'
+            window[current_layout].update(visible=True)
 
-        # If the user submits their chamber selection, then move to the
+        # Once the user has said how often to change the media, move to the
         # monitoring page
-        elif event == 'Submit Chambers':
+        elif event == 'samesettingsmedianext':
+            settings["change_interval"] = read_duration(values,
+                                                        days='-CHANGEDAYS-',
+                                                        hours='-CHANGEHOURS-')
             break
 
     # Close the window
     window.close()
 
 
+def read_duration(values, weeks=None, days=None, hours=None):
+    """Read a duration typed in by the user, returning it in seconds.
+
+    The keys of the weeks, days and hours inputs are given. Anything that
+    isn't a number counts as zero, and a duration of zero gives None.
+    """
+    seconds = 0
+    for key, unit in ((weeks, 7 * 24 * 60 * 60), (days, 24 * 60 * 60),
+                      (hours, 60 * 60)):
+        if key is None:
+            continue
+        try:
+            seconds += max(float(values[key]), 0) * unit
+        except ValueError:
+            pass
+    return seconds or None
+
+
 def start_monitoring_window(start_time):
-    """Display information for the chambers and allow user control."""
+    """Display information for the chambers and allow user control.
+
+    Returns True if the user finished the run, or False if they closed the
+    window, in which case the run is left in progress so it can be resumed.
+    """
     # Set the font and the theme of the GUI
     default_font = 'Roboto 12'
     sg.theme('LightGray1')
 
     # Define the layout of the monitoring window, however this must be done
     # after the settings have been defined.
-    chamber_frames = []
-
-    # The monitoring window has two rows, the top row has 1, 3, 5, 7 and the
-    # bottom has 2, 4, 6, 8. Go through and see which chambers are in use.
-    # If a chamber is in use, then add a GUI element to its row. If it isn't in
-    # use, then add a GUI element that says it isn't in use to its row.
-    row1 = []
-    row2 = []
-    for i in range(0, 8, 2):
-        j = i + 1
-        if chambers[i]['is_in_use']:
-            row1.append(sg.Frame("Chamber " + str(chambers[i]['chamber_id']),
-                        [[sg.Text(text="Status: " + chambers[i]["status"],
-                                  font='Roboto 12', key='-CHAMBER' +
-                                  str(chambers[i]['chamber_id']) +
-                                  '-STATUS-')],
-                         [sg.Text(text="Last Changed: " +
-                                  humanize.naturaltime(
-                                    datetime.datetime.now() - chambers[i]
-                                    ["last_changed"]),
-                                  font='Roboto 12', key='-CHAMBER' +
-                                  str(chambers[i]['chamber_id']) +
-                                  '-LASTCHANGE-')],
-                         [sg.Text(text="Media in Reservoir: " +
-                                  str(chambers[i]["media_in_chamber"]) +
-                                  " mL", font='Roboto 12', key='-CHAMBER' +
-                                  str(chambers[i]['chamber_id']) +
-                                  '-MEDIARES-')],
-                         [sg.Button("Add Media to Reservoir",
-                                    font=default_font, key='-CHAMBER' +
-                                    str(chambers[i]['chamber_id']) +
-                                    '-ADDMEDIA-')],
-                         [sg.Button("Change Media", font=default_font,
-                                    key='-CHAMBER' +
-                                    str(chambers[i]['chamber_id']) +
-                                    '-CHANGEMEDIA-')]], font='Roboto 20',
-                                 element_justification='center',
-                                 title_color="red", size=(240, 200)))
-        else:
-            row1.append(sg.Frame("Chamber " + str(chambers[i]['chamber_id']),
-                                 [[sg.Text(text="Status: " +
-                                           chambers[i]["status"],
-                                           font='Roboto 12', key='-CHAMBER' +
-                                           str(chambers[i]['chamber_id']) +
-                                           '-STATUS-')]], font='Roboto 20',
-                                 element_justification='center',
-                                 title_color="red", size=(240, 200)))
-        if chambers[j]['is_in_use']:
-            row2.append(sg.Frame("Chamber " + str(chambers[j]['chamber_id']),
-                                 [[sg.Text(text="Status: " +
-                                           chambers[j]["status"],
-                                           font='Roboto 12', key='-CHAMBER' +
-                                           str(chambers[j]['chamber_id']) +
-                                           '-STATUS-')],
-                                  [sg.Text(text="Last Change: " +
-                                           humanize.naturaltime(
-                                            datetime.datetime.now() -
-                                            chambers[j]["last_changed"]),
-                                           font='Roboto 12', key='-CHAMBER' +
-                                           str(chambers[j]['chamber_id']) +
-                                           '-LASTCHANGE-')],
-                                  [sg.Text(text="Media in Reservoir: " +
-                                           str(chambers[j]["media_in_chamber"])
-                                           + " mL", font='Roboto 12',
-                                           key='-CHAMBER' +
-                                           str(chambers[j]['chamber_id']) +
-                                           '-MEDIARES-')],
-                                  [sg.Button("Add Media to Reservoir",
-                                             font=default_font, key='-CHAMBER'
-                                             + str(chambers[j]["chamber_id"]) +
-                                             '-ADDMEDIA-')],
-                                  [sg.Button("Change Media", font=default_font,
-                                             key='-CHAMBER' +
-                                             str(chambers[j]["chamber_id"]) +
-                                             '-CHANGEMEDIA-')]],
-                                 font='Roboto 20',
-                                 element_justification='center',
-                                 title_color="red", size=(240, 200)))
-        else:
-            row2.append(sg.Frame("Chamber " + str(chambers[j]['chamber_id']),
-                                 [[sg.Text(text="Status: " +
-                                           chambers[j]["status"],
-                                           font='Roboto 12', key='-CHAMBER' +
-                                           str(chambers[j]['chamber_id']) +
-                                           '-STATUS-')]], font='Roboto 20',
-                                 element_justification='center',
-                                 title_color="red", size=(240, 200)))
-
-    # Then, just add the two rows to the overall structure
-    chamber_frames.append(row1)
-    chamber_frames.append(row2)
+    chamber_rows = []
+
+    # The chambers are shown in banks of eight. Each bank has two rows, the
+    # top row has 1, 3, 5, 7 and the bottom has 2, 4, 6, 8 (then 9, 11, 13, 15
+    # and 10, 12, 14, 16 and so on). If a chamber is in use, then it gets a
+    # GUI element to control it. If it isn't in use, then it gets a GUI
+    # element that says it isn't in use.
+    for bank in range(0, len(chambers), 8):
+        bank_ids = range(bank, min(bank + 8, len(chambers)))
+        chamber_rows.append([chamber_frame(chambers[i], default_font)
+                             for i in bank_ids if (i - bank) % 2 == 0])
+        chamber_rows.append([chamber_frame(chambers[i], default_font)
+                             for i in bank_ids if (i - bank) % 2 == 1])
+
+    # If there are more rows than fit on the screen, let them scroll
+    if len(chamber_rows) > 2:
+        chamber_rows = [[sg.Column(chamber_rows, scrollable=True,
+                                   vertical_scroll_only=True,
+                                   size=(1000, 420))]]
+
+    # Look up which chamber a button is for straight from its key
+    chamber_events = {}
+    for i in control.in_use():
+        key = '-CHAMBER' + str(chambers[i].chamber_id)
+        chamber_events[key + '-ADDMEDIA-'] = (add_media_to_single_reservoir,
+                                              i)
+        chamber_events[key + '-CHANGEMEDIA-'] =\
+            (change_media_in_single_chamber, i)
+        chamber_events[key + '-CANCEL-'] = (cancel_chamber, i)
 
     # Create a small spot for a little running blinking indicator
     led_spot = sg.Graph((20, 20), (0, 0), (20, 20), key="-LED-SPOT-",
@@ -350,138 +319,211 @@ def start_monitoring_window(start_time):
     layout = [
         [sg.Text(text="System Status and Control", font='Roboto 30',
                  pad=(0, 5))],
-        chamber_frames,
+        *chamber_rows,
         [led_spot, sg.Text(text="System running for: " +
-                           humanize.naturaldelta(datetime.datetime.now() -
-                                                 start_time),
-                           font='Roboto 18', pad=(0, 5), key='-RUNTIME-')],
+                           render.natural_delta('-RUNTIME-', start_time,
+                                                clock.now()),
+                           font='Roboto 18', pad=(0, 5), key='-RUNTIME-'),
+         sg.Text(text="", font='Roboto 18', pad=(20, 5), size=(30, 1),
+                 key='-QUEUE-')],
         [sg.Button("Add Media to All Reservoirs", font='Roboto 15',
                    pad=(5, 5)),
          sg.Button("Change Media in All Chambers", font='Roboto 15',
                    pad=(5, 5)),
          sg.Button("Finish", font='Roboto 15', pad=(5, 5))]]
 
-    # Initialize the window
+    # Initialize the window, forgetting what was rendered in any old window
     window = sg.Window("Vessegen Bioreactor Software", layout,
                        element_justification='center', size=(1024, 595),
                        finalize=True, icon=vessegen.ICON_PATH)
+    measure_startup()
+    render.reset()
 
     # Draw the LED blinking indicator, storing it as a dictionary to keep track
     # of it and its color
     led = {
         "obj": led_spot.draw_circle((10, 10), 9, fill_color='white',
                                     line_color="black", line_width=1),
-        "color": "white",
-        "last_updated": time.time()
+        "color": "white"
     }
 
+    # Have the daemon's changes to the chambers sent to this window as events
+    connection["client"].set_listener(lambda:
+                                      window.write_event_value('-DAEMON-',
+                                                               None))
+
+    def tick():
+        """Blink the LED and update the monitor once a second."""
+        blink_led(window, led)
+        update_monitor(window, start_time)
+        timers.schedule('-MONITOR-', clock.time() + 1, tick)
+
+    # Start the first tick, which will keep scheduling the next one
+    tick()
+
     # Loop until the user closes the window
     while True:
-        # Read the user input from the GUI
-        event, _ = window.read(timeout=100)
-
-        # First, the monitor should check if it needs to update itself
-        update_monitor(window, led, start_time)
+        # Read the user input from the GUI, waking up only for events and for
+        # timers that are due
+        event, values = timers.read(window)
 
         # If the user has selected "Cancel", "Finished", orclosed the window,
         # then exit the program
         if event in ('Cancel', 'Finish', None, sg.WIN_CLOSED):
+            finished = event in ('Cancel', 'Finish')
             break
 
+        # If the daemon has changed the chambers, catch up with it
+        if event == '-DAEMON-':
+            connection["client"].apply_changes()
+
         # If the user has selected to add media to all reservoirs, then add the
         # media specified by the user to all of the chambers
         if event == 'Add Media to All Reservoirs':
-            add_media_to_all_reservoirs(window, led, start_time)
-
-        # If the user has selected to add media to a single reservoir, then add
-        # the media specified to that single chamber
-        elif event in [f"-CHAMBER{i}-ADDMEDIA-" for i in range(1, 9)]:
-            add_media_to_single_reservoir(int(event[8]) - 1,
-                                          window, led, start_time)
+            add_media_to_all_reservoirs()
 
         # If the user has selected to change media in all chambers, then start
         # changing the media in all of the chambers
         elif event == 'Change Media in All Chambers':
-            change_media_in_all_chambers(window, led, start_time)
+            change_media_in_all_chambers()
 
-        # If the user has selected change media in a single chamber, then start
-        # changing the media in that chamber
-        elif event in [f"-CHAMBER{i}-CHANGEMEDIA-" for i in range(1, 9)]:
-            change_media_in_single_chamber(int(event[8]) - 1,
-                                           window, led, start_time)
-
-    # Once appropriate, close the window
-    window.close()
+        # If the user has selected to add media to a single reservoir or to
+        # change the media in a single chamber, then do so for that chamber
+        elif event in chamber_events:
+            action, chamber_id = chamber_events[event]
+            action(chamber_id)
 
+        # Show any changes the event made to the chambers right away
+        update_monitor(window, start_time)
 
-def update_monitor(window, led, start_time):
-    """Update the window with information from the chambers."""
-    if time.time() > led["last_updated"] + 1:
-        # Blink the LED
-        led["color"] = "green" if led["color"] == "white" else "white"
-        window["-LED-SPOT-"].Widget.itemconfig(led["obj"], fill=led["color"])
-
-        # Update the text shown on the window
-        window['-RUNTIME-'].update("System running for: " +
-                                   humanize.naturaldelta(datetime.
-                                                         datetime.now() -
-                                                         start_time))
-        for i in range(8):
-            if chambers[i]['is_in_use']:
-                window["-CHAMBER" + str(chambers[i]["chamber_id"]) +
-                       "-STATUS-"].update("Status: " + chambers[i]["status"])
-                window['-CHAMBER' + str(chambers[i]['chamber_id']) +
-                       '-LASTCHANGE-'].update("Last Change: " +
-                                              humanize.naturaltime(
-                                                datetime.datetime.now() -
-                                                chambers[i]["last_changed"]))
-                window['-CHAMBER' + str(chambers[i]['chamber_id']) +
-                       '-MEDIARES-'].update("Media in Reservoir: " +
-                                            str(round(
-                                                chambers[i]
-                                                ["media_in_chamber"],
-                                                1)) + " mL")
-        window.refresh()
-        led["last_updated"] = time.time()
-
-
-def add_media_to_single_reservoir(chamber_id, window, led, start_time):
-    """Add the media specified by the user to the specified reservoir.
-
-    Note, this function takes in the led indicator information as well as the
-    parent window so that it can keep updating the parent window while it
-    waits for the user to be finished with this screen.
+    # Once appropriate, stop listening to the daemon, stop the monitor's timer
+    # and close the window
+    connection["client"].set_listener(None)
+    timers.cancel('-MONITOR-')
+    window.close()
+    return finished
+
+
+def chamber_frame(chamber, default_font):
+    """Create the GUI element that shows and controls a single chamber."""
+    key = '-CHAMBER' + str(chamber.chamber_id)
+
+    # If the chamber isn't in use, just say so
+    if not chamber.is_in_use:
+        return sg.Frame("Chamber " + str(chamber.chamber_id),
+                        [[sg.Text(text="Status: " + status.describe(
+                            chamber.status, chamber.detail),
+                                  font='Roboto 12', key=key + '-STATUS-')]],
+                        font='Roboto 20', element_justification='center',
+                        title_color="red", size=(240, 200))
+
+    return sg.Frame("Chamber " + str(chamber.chamber_id),
+                    [[sg.Text(text="Status: " + status.describe(
+                        chamber.status, chamber.detail),
+                              font='Roboto 12', key=key + '-STATUS-')],
+                     [sg.Text(text="Last Change: " +
+                              render.natural_delta(key + '-LASTCHANGE-',
+                                                   chamber.last_changed,
+                                                   clock.now(), ago=True),
+                              font='Roboto 12', key=key + '-LASTCHANGE-')],
+                     [sg.Text(text="Media in Reservoir: " +
+                              str(chamber.media_in_chamber) + " mL",
+                              font='Roboto 12', key=key + '-MEDIARES-')],
+                     [sg.Button("Add Media to Reservoir", font=default_font,
+                                key=key + '-ADDMEDIA-')],
+                     [sg.Button("Change Media", font=default_font,
+                                key=key + '-CHANGEMEDIA-'),
+                      sg.Button("Cancel", font=default_font,
+                                key=key + '-CANCEL-', disabled=True)]],
+                    font='Roboto 20', element_justification='center',
+                    title_color="red", size=(240, 200))
+
+
+def blink_led(window, led):
+    """Blink the running indicator LED."""
+    led["color"] = "green" if led["color"] == "white" else "white"
+    window["-LED-SPOT-"].Widget.itemconfig(led["obj"], fill=led["color"])
+
+
+def update_monitor(window, start_time):
+    """Update the window with information from the chambers.
+
+    Only the elements whose text has changed are pushed to the window, and the
+    humanized durations are only recomputed when the shown value can change,
+    so this is cheap enough to call after every event.
     """
-    # Specify the layout for prompting the user for the media to add, including
-    # built in buttons
-    layout = [
-        [sg.Text(text="How much media did you add to reservoir " +
-                 str(chamber_id + 1) + "?", font='Roboto 20', pad=(0, 20))],
-        [sg.Text(text="0", key="-MEDIAVAL-", font='Roboto 20', pad=(0, 20)),
-         sg.Text(text=" mL", font='Roboto 20', pad=(0, 20))],
-        [sg.Button("-0.1", button_color='DarkRed', font='Roboto 15', pad=(5, 5)),
-         sg.Button("+0.1", button_color='DarkRed', font='Roboto 15', pad=(5, 5))],
-        [sg.Button("-1", button_color='DarkRed', font='Roboto 15', pad=(5, 5)),
-         sg.Button("+1", button_color='DarkRed', font='Roboto 15', pad=(5, 5))],
-        [sg.Button("-5", button_color='DarkRed', font='Roboto 15', pad=(5, 5)),
-         sg.Button("+5", button_color='DarkRed', font='Roboto 15', pad=(5, 5))],
-        [sg.Button("-10", button_color='DarkRed', font='Roboto 15', pad=(5, 5)),
-         sg.Button("+10", button_color='DarkRed', font='Roboto 15', pad=(5, 5))],
-        [sg.Button("Set to Zero", font='Roboto 15', pad=(5, 20)),
-         sg.Button("Empty Resevoir", font='Roboto 15', pad=(5, 20)),
-         sg.Button("Submit", font='Roboto 15', pad=(5, 20)),
-         sg.Cancel(font='Roboto 15', pad=(5, 20))],
-        [sg.Text(text="Note: include any volume of extra additives added " +
-                 "to the media.", font='Roboto 10', pad=(0, 20))]
-    ]
-
-    # Start the "popup" window
-    popup_window = sg.Window("Vessegen Bioreactor Software", layout,
-                             element_justification='center', finalize=True,
-                             icon=vessegen.ICON_PATH)
+    now = clock.now()
+    render.set_text(window, '-RUNTIME-', "System running for: " +
+                    render.natural_delta('-RUNTIME-', start_time, now))
+
+    # Show how many chambers are waiting their turn and how many are under
+    # way, so the user can queue more without waiting for these
+    queued, working = control.busy()
+    render.set_text(window, '-QUEUE-', "" if not queued and not working else
+                    str(len(working)) + " under way, " + str(len(queued)) +
+                    " queued")
+
+    for i in control.in_use():
+        key = '-CHAMBER' + str(chambers[i].chamber_id)
+        render.set_text(window, key + '-STATUS-',
+                        "Status: " + status.describe(chambers[i].status,
+                                                     chambers[i].detail))
+        render.set_disabled(window, key + '-CANCEL-',
+                            i not in queued and i not in working)
+        render.set_text(window, key + '-LASTCHANGE-',
+                        "Last Change: " +
+                        render.natural_delta(key + '-LASTCHANGE-',
+                                             chambers[i].last_changed,
+                                             now, ago=True))
+        render.set_text(window, key + '-MEDIARES-',
+                        "Media in Reservoir: " +
+                        str(round(chambers[i].media_in_chamber, 1)) +
+                        " mL")
+
+
+def add_media_to_single_reservoir(chamber_id):
+    """Add the media specified by the user to the specified reservoir."""
+    media_to_add = ask_for_media("How much media did you add to reservoir " +
+                                 str(chamber_id + 1) + "?")
+
+    # Add the media to the correct reservoir and update the chamber
+    # information, or empty that specific reservoir
+    if media_to_add == "empty":
+        request("empty_reservoirs", chambers=[chamber_id])
+    elif media_to_add is not None:
+        request("add_media", chambers=[chamber_id], volume=media_to_add)
+
+
+def cancel_chamber(chamber_id):
+    """Stop the media change in the specified chamber, queued or not."""
+    request("cancel", chambers=[chamber_id])
+
+
+def add_media_to_all_reservoirs():
+    """Add the media specified by the user to all reservoirs."""
+    media_to_add = ask_for_media("How much media did you add to all the "
+                                 "reservoirs?")
+
+    # Add the media to all of the reservoirs for the chambers that are in use,
+    # or empty all of the reservoirs
+    if media_to_add == "empty":
+        request("empty_reservoirs")
+    elif media_to_add is not None:
+        request("add_media", volume=media_to_add)
+
+
+def ask_for_media(question):
+    """Ask the user how much media they added to one or more reservoirs.
+
+    Returns the volume (in mL), "empty" if the user asked to empty the
+    reservoirs, or None if they cancelled.
+    """
+    popup_window = show_popup("media", media_popup_layout)
+    popup_window['-MEDIAQUESTION-'].update(question)
 
     # Initially, the media to add is zero
     media_to_add = 0
+    result = None
     while True:
         # Check if the media is 0.0, and if so round it to zero decimal places.
         # This is just for formatting.
@@ -491,10 +533,7 @@ def add_media_to_single_reservoir(chamber_id, window, led, start_time):
             popup_window.refresh()
 
         # Read the user input from the GUI
-        event, _ = popup_window.read(timeout=100)
-
-        # First, the monitor should check if it needs to update itself
-        update_monitor(window, led, start_time)
+        event, _ = timers.read(popup_window)
 
         # If the user has selected "Cancel" or closed the window, then exit the
         # popup window
@@ -508,11 +547,9 @@ def add_media_to_single_reservoir(chamber_id, window, led, start_time):
             popup_window['-MEDIAVAL-'].update(str(media_to_add))
             popup_window.refresh()
 
-        # Once the user submits, add the media to the correct reservoir and
-        # update the chamber information
+        # Once the user submits, hand back the media they added
         elif event == 'Submit':
-            chambers[chamber_id]['media_in_chamber'] =\
-                max(media_to_add + chambers[chamber_id]['media_in_chamber'], 0)
+            result = media_to_add
             break
 
         # If the user wishes to reset the counter and display, do so
@@ -521,27 +558,23 @@ def add_media_to_single_reservoir(chamber_id, window, led, start_time):
             popup_window['-MEDIAVAL-'].update(str(media_to_add))
             popup_window.refresh()
 
-        # If the user would like to empty that specific reservoir, do so
+        # If the user would like to empty the reservoirs, do so
         elif event == 'Empty Resevoir':
-            chambers[chamber_id]['media_in_chamber'] = 0
+            result = "empty"
             break
 
-    # Once done, close the popup window
-    popup_window.close()
-
+    # Once done, hide the popup window until it is needed again
+    hide_popup("media", event)
+    return result
 
-def add_media_to_all_reservoirs(window, led, start_time):
-    """Add the media specified by the user to all reservoirs.
 
-    Note, this function takes in the led indicator information as well as the
-    parent window so that it can keep updating the parent window while it
-    waits for the user to be finished with this screen.
-    """
+def media_popup_layout():
+    """Return the layout for asking the user how much media they added."""
     # Specify the layout for prompting the user for the media to add, including
-    # built in buttons
-    layout = [
-        [sg.Text(text="How much media did you add to all the reservoirs?",
-                 font='Roboto 20', pad=(0, 20))],
+    # built in buttons. The question is filled in each time it is shown.
+    return [
+        [sg.Text(text="", key="-MEDIAQUESTION-", size=(50, 1),
+                 justification='center', font='Roboto 20', pad=(0, 20))],
         [sg.Text(text="0", key="-MEDIAVAL-", font='Roboto 20', pad=(0, 20)),
          sg.Text(text=" mL", font='Roboto 20', pad=(0, 20))],
         [sg.Button("-0.1", button_color='DarkRed', font='Roboto 15', pad=(5, 5)),
@@ -556,244 +589,135 @@ def add_media_to_all_reservoirs(window, led, start_time):
          sg.Button("Empty Resevoir", font='Roboto 15', pad=(5, 20)),
          sg.Button("Submit", font='Roboto 15', pad=(5, 20)),
          sg.Cancel(font='Roboto 15', pad=(5, 20))],
-        [sg.Text(text="Note: include any volume of extra additives " +
-                 "added to the media.", font='Roboto 10', pad=(0, 20))]
+        [sg.Text(text="Note: include any volume of extra additives added " +
+                 "to the media.", font='Roboto 10', pad=(0, 20))]
     ]
 
-    # Launch the "popup" window
-    popup_window = sg.Window("Vessegen Bioreactor Software", layout,
-                             element_justification='center', finalize=True,
-                             icon=vessegen.ICON_PATH)
 
-    # Initially, the media to add is zero
-    media_to_add = 0
-    while True:
-        # Check if the media is 0.0, and if so round it to zero decimal places.
-        # This is just for formatting.
-        if media_to_add == 0:
-            media_to_add = round(media_to_add, 0)
-            popup_window['-MEDIAVAL-'].update(str(media_to_add))
-            popup_window.refresh()
-
-        # Read the user input from the GUI
-        event, _ = popup_window.read(timeout=100)
-
-        # First, the monitor should check if it needs to update itself
-        update_monitor(window, led, start_time)
-
-        # If the user has selected "Cancel" or closed the window, then exit the
-        # popup window
-        if event in ('Cancel', 'Finish', None, sg.WIN_CLOSED):
-            break
-
-        # If the user clicks one of the buttons to add or remove media, keep
-        # track of it
-        if event in ('-0.1', '+0.1', '-1', '+1', '-5', '+5', '-10', '+10'):
-            media_to_add = round(media_to_add + float(event), 1)
-            popup_window['-MEDIAVAL-'].update(str(media_to_add))
-            popup_window.refresh()
-
-        # If the user submits, then add the media to all of the reservoirs
-        # for the chambers that are in use
-        elif event == 'Submit':
-            # Get the user input and update the chamber information
-            for chamber_id in range(8):
-                if chambers[chamber_id]['status'] != 'Unused':
-                    chambers[chamber_id]['media_in_chamber'] =\
-                        max(media_to_add + chambers[chamber_id]
-                            ['media_in_chamber'], 0)
-            break
-
-        # If the user wishes to reset the counter and display, do so
-        if event == 'Set to Zero':
-            media_to_add = 0
-            popup_window['-MEDIAVAL-'].update(str(media_to_add))
-            popup_window.refresh()
-
-        # If the user would like to empty all of the reservoirs, do so
-        elif event == 'Empty Resevoir':
-            for chamber_id in range(8):
-                if chambers[chamber_id]['status'] != 'Unused':
-                    chambers[chamber_id]['media_in_chamber'] = 0
-            break
+def show_popup(name, build_layout):
+    """Show a popup window, building it the first time it is needed.
 
-    # Close the popup window when the user is finished
-    popup_window.close()
+    Building a window with many buttons is slow on a Raspberry Pi, so the
+    popups are built once and then hidden rather than closed, and shown again
+    the next time. The caller fills in anything that changes each time.
+    """
+    popup_window = popups.get(name)
+    if popup_window is None or popup_window.was_closed():
+        popup_window = popups[name] = sg.Window(
+            "Vessegen Bioreactor Software", build_layout(),
+            element_justification='center', finalize=True,
+            icon=vessegen.ICON_PATH)
+    else:
+        popup_window.un_hide()
+        popup_window.bring_to_front()
+    return popup_window
 
 
-def change_media_in_single_chamber(chamber_id, window, led, start_time):
-    """Change the media in the specified chamber.
+def hide_popup(name, event):
+    """Hide a popup window once the user is done with it.
 
-    Note, this function takes in the led indicator information as well as the
-    parent window so that it can keep updating the parent window while it
-    waits for the user to be finished with this screen.
+    If the user closed the window, it is gone, so it is built again next
+    time.
     """
-    # First, make sure that we think there is enough media to complete a media
-    # change
-    if chambers[chamber_id]["media_in_chamber"] < vessegen.MEDIA_VOL:
-        layout = [
-            [sg.Text(text="Are you sure there is enough media in Reservoir " +
-                     str(chamber_id + 1) + "?", font='Roboto 20',
-                     pad=(0, 20))],
-            [sg.Text(text="There should be at least " +
-                     str(vessegen.MEDIA_VOL) +
-                     "mL in the reservoir.", font='Roboto 20',
-                     pad=(0, 20))],
-            [sg.Text(text="Note: if there is enough media, make sure the " +
-                     "value noted by the software is accurate.",
-                     font='Roboto 15', pad=(0, 20))],
-            [sg.Button("OK", font='Roboto 15', pad=(5, 20))]
-        ]
+    if event in (None, sg.WIN_CLOSED):
+        popups.pop(name).close()
+    else:
+        popups[name].hide()
 
-        # If there isn't enough media in the reservoir, alert the user
-        popup_window = sg.Window("Vessegen Bioreactor Software", layout,
-                                 element_justification='center',
-                                 finalize=True, icon=vessegen.ICON_PATH)
 
-        while True:
-            # Read the user input from the GUI
-            event, _ = popup_window.read(timeout=100)
+def close_popups():
+    """Close every popup window that has been built."""
+    while popups:
+        popups.popitem()[1].close()
 
-            # First, the monitor should check if it needs to update itself
-            update_monitor(window, led, start_time)
 
-            # If the user has selected "OK", "Cancel", or closed the window,
-            # then exit the popup window
-            if event in ('Cancel', None, 'OK', sg.WIN_CLOSED):
-                break
+def change_media_in_single_chamber(chamber_id):
+    """Change the media in the specified chamber."""
+    change_media_in_chambers([chamber_id])
 
-        # Close the popup window
-        popup_window.close()
-    else:
-        # Inform the user that we are calculating time (update GUI)
-        chambers[chamber_id]["status"] = "Calculating time..."
-
-        # Check if the monitor needs to be updated
-        update_monitor(window, led, start_time)
-
-        # Determine the time it will take to remove the media
-        time_to_remove, _ = calculate_media_change_time(vessegen.MEDIA_VOL,
-                                                        window, led,
-                                                        start_time)
-        # HARD CODE FOR NOW
-        time_to_remove = 80
-
-        # Inform the user that we are removing media (update GUI)
-        chambers[chamber_id]["status"] = "Removing media..."
-
-        # Send the signal to remove the media and wait
-        # pylint: disable=no-member
-        GPIO.output(vessegen.GPIO_PINS[chamber_id]["remove"], GPIO.HIGH)
-        started = time.time()
-        while True:
-            update_monitor(window, led, start_time)
-            if time.time() > started + time_to_remove:
-                break
-            time.sleep(0.05)
-
-        # Send the close signal and wait a brief moment to ensure closure
-        # pylint: disable=no-member
-        GPIO.output(vessegen.GPIO_PINS[chamber_id]["remove"], GPIO.LOW)
-        time.sleep(0.1)
-
-        # Inform the user that we are calculating time (update GUI)
-        chambers[chamber_id]["status"] = "Calculating time..."
-
-        # Check if the monitor needs to be updated
-        update_monitor(window, led, start_time)
-
-        # Calculate the time it will take to add the media as well as the
-        # volume we estimate to be removed
-        time_to_add, vol = calculate_media_change_time(chambers[chamber_id]
-                                                       ["media_in_chamber"],
-                                                       window, led,
-                                                       start_time, True)
-        # HARD CODE FOR NOW
-        time_to_add = 20
-
-        # Inform the user that we are adding media (update GUI)
-        chambers[chamber_id]["status"] = "Adding media..."
-
-        # Send the signal to remove the media and wait
-        # pylint: disable=no-member
-        GPIO.output(vessegen.GPIO_PINS[chamber_id]["add"], GPIO.HIGH)
-        started = time.time()
-
-        while True:
-            update_monitor(window, led, start_time)
-            if time.time() > started + time_to_add:
-                break
-            time.sleep(0.05)
-
-        # Send the close signal
-        # pylint: disable=no-member
-        GPIO.output(vessegen.GPIO_PINS[chamber_id]["add"], GPIO.LOW)
-
-        # Inform the user that we are running again, decrement the media
-        # removed from the reservoir
-        chambers[chamber_id]["status"] = "Running"
-        chambers[chamber_id]["last_changed"] = datetime.datetime.now()
-        chambers[chamber_id]["media_in_chamber"] =\
-            round(max(chambers[chamber_id]["media_in_chamber"] - vol, 0), 1)
-        update_monitor(window, led, start_time)
-
-
-def change_media_in_all_chambers(window, led, start_time):
-    """Change the media in all of the used chambers."""
-    # For all of the chambers in use, change the media
-    for i in range(8):
-        if chambers[i]['is_in_use']:
-            change_media_in_single_chamber(i, window, led, start_time)
 
+def change_media_in_all_chambers():
+    """Change the media in all of the used chambers."""
+    # For all of the chambers in use, change the media at the same time
+    change_media_in_chambers(control.in_use())
 
-def calculate_media_change_time(media_in_res,
-                                window, led, start_time, add=False):
-    """Calculate the estimated time to complete a media change.
 
-    This function defaults to removing media (add is False). To calculate time
-    for adding media, simply set add to True.
+def change_media_in_chambers(chamber_ids):
+    """Change the media in the specified chambers at the same time.
 
-    Note, this function takes in the led indicator information as well as the
-    parent window so that it can keep updating the parent window while it
-    waits for the user to be finished with this screen.
+    The media changes are handed to the daemon, which drives the valves so
+    that several chambers can be removing or adding media at once, while
+    never opening more solenoids than vessegen.MAX_OPEN_VALVES allows. This
+    function returns as soon as the media changes are queued, and the daemon
+    reports their progress through '-DAEMON-' window events.
     """
-    # The diameters of the tubes change depending on if it is the adding or
-    # removing solenoid.
-    diameter = 1.0 if add else 0.5
+    # Hand the media changes to the daemon. Only chambers that have enough
+    # media and aren't already in the middle of a media change are changed.
+    result = request("change_media", chambers=chamber_ids)
 
-    # Initially, the time to complete is zero as is the volume added
-    time_to_complete = 0
-    volume_added = 0
+    # Alert the user about any reservoirs that are running low
+    if result is not None and result["low_media"]:
+        alert_low_media(result["low_media"])
 
-    # Specify a small time step
-    time_step = 1
 
-    # Work with a copy
-    bulk = media_in_res
+def alert_low_media(chamber_ids):
+    """Alert the user that the specified reservoirs may be low on media."""
+    # Name the reservoirs in the alert, e.g. "Reservoir 1" or "Reservoirs 1, 3"
+    names = ("Reservoir " if len(chamber_ids) == 1 else "Reservoirs ") +\
+        ", ".join(str(i + 1) for i in chamber_ids)
+
+    # If there isn't enough media in the reservoir, alert the user
+    popup_window = show_popup("low_media", low_media_popup_layout)
+    popup_window['-LOWMEDIA-'].update(
+        "Are you sure there is enough media in " + names + "?")
 
-    # Approximate the time to complete by iterating over small time steps and
-    # estimating the volume added for that small time step
-    while volume_added < vessegen.MEDIA_VOL:
-        update_monitor(window, led, start_time)
-        vol_step = bulk*((diameter/2)*(diameter/2))*time_step
-        time_to_complete += time_step
-        volume_added += max(vol_step, 0.0001)
-        bulk -= vol_step
+    while True:
+        # Read the user input from the GUI
+        event, _ = timers.read(popup_window)
+
+        # If the user has selected "OK", "Cancel", or closed the window,
+        # then exit the popup window
+        if event in ('Cancel', None, 'OK', sg.WIN_CLOSED):
+            break
 
-    # Add a margin of error
-    time_to_complete = 5
+    # Hide the popup window until it is needed again
+    hide_popup("low_media", event)
+
+
+def low_media_popup_layout():
+    """Return the layout for alerting the user to low media."""
+    # Leave room to name every reservoir, since the reservoirs are filled in
+    # each time it is shown
+    longest = "Are you sure there is enough media in Reservoirs " +\
+        ", ".join(str(i + 1) for i in range(len(chambers))) + "?"
+    return [
+        [sg.Text(text="", key="-LOWMEDIA-", size=(len(longest), 1),
+                 justification='center', font='Roboto 20', pad=(0, 20))],
+        [sg.Text(text="There should be at least " +
+                 str(vessegen.MEDIA_VOL) +
+                 "mL in the reservoir.", font='Roboto 20',
+                 pad=(0, 20))],
+        [sg.Text(text="Note: if there is enough media, make sure the " +
+                 "value noted by the software is accurate.",
+                 font='Roboto 15', pad=(0, 20))],
+        [sg.Button("OK", font='Roboto 15', pad=(5, 20))]
+    ]
 
-    # Once estimated, return the time
-    return time_to_complete, volume_added
 
+def chamber_wash_screen(start_time=None):
+    """Display the screen that can control a chamber wash.
 
-def chamber_wash_screen():
-    """Display the screen that can control a chamber wash."""
+    If the start time of the run that just finished is given, its data can
+    be exported from here too.
+    """
+    end_time = clock.time()
     prompt = [
             [sg.Text(text="Would you like to do a wash cycle?",
                      font='Roboto 30', pad=((0, 0), (120, 20)))],
             [sg.Button("Yes", font='Roboto 20', pad=(5, 20)),
-             sg.Button("No", font='Roboto 20', pad=(5, 20))]
+             sg.Button("No", font='Roboto 20', pad=(5, 20))],
+            [sg.Button("Export Data", font='Roboto 15', pad=(5, 20),
+                       key='-EXPORT-', visible=start_time is not None)]
         ]
     
     confirm_empty = [
@@ -812,12 +736,21 @@ def chamber_wash_screen():
     
     running_screen = [
         [sg.Text(text="Wash cycle running, please wait...",
-                     font='Roboto 30', pad=((0, 0), (120, 20)))]
+                     font='Roboto 30', pad=((0, 0), (120, 20)))],
+        [sg.ProgressBar(100, orientation='h', size=(40, 20),
+                        key='-WASHBAR-', pad=(0, 10))],
+        [sg.Text(text="", key='-WASHSTEPS-', size=(50, 1),
+                 justification='center', font='Roboto 15', pad=(0, 5))],
+        [sg.Text(text="", key='-WASHETA-', size=(50, 1),
+                 justification='center', font='Roboto 15', pad=(0, 5))],
+        [sg.Button("Stop Wash", font='Roboto 20', pad=(5, 20),
+                   key='CANCEL3')]
     ]
 
     wash_complete = [
-        [sg.Text(text="Wash cycle complete!",
-                     font='Roboto 30', pad=((0, 0), (120, 20)))],
+        [sg.Text(text="Wash cycle complete!", key='-WASHDONE-', size=(30, 1),
+                 justification='center', font='Roboto 30',
+                 pad=((0, 0), (120, 20)))],
         [sg.Button("Ok", font='Roboto 20', pad=(5, 20), key='OK3')]
     ]
 
@@ -837,17 +770,45 @@ def chamber_wash_screen():
                                 element_justification='center',
                                 finalize=True, icon=vessegen.ICON_PATH,
                                 size=(1024, 595))
+    render.reset()
     
     # Start in the prompt
     current_layout = '-PROMPT-'
 
+    def tick():
+        """Count down to the end of the wash once a second."""
+        update_wash(window)
+        timers.schedule('-WASH-', clock.time() + 1, tick)
+
     while True:
         # Read the user input from the GUI
-        event, _ = window.read()
+        event, values = timers.read(window)
 
         if event in ('No', 'CANCEL1', 'CANCEL2', 'OK3', None, sg.WIN_CLOSED):
             break
 
+        # If the user wants the run's data, ask where to save it and write it
+        # in the background so the screen doesn't freeze
+        elif event == '-EXPORT-':
+            path = sg.popup_get_file(
+                "Where should the data be saved?", save_as=True,
+                default_path="vessegen-" +
+                start_time.strftime("%Y-%m-%d-%H%M") + ".csv",
+                file_types=(("CSV", "*.csv"), ("Parquet", "*.parquet")),
+                font='Roboto 15', icon=vessegen.ICON_PATH)
+            if path:
+                window['-EXPORT-'].update("Exporting...", disabled=True)
+                threading.Thread(target=export_run,
+                                 args=(window, path, start_time.timestamp(),
+                                       end_time),
+                                 name="vessegen-export", daemon=True).start()
+
+        # Once the data is written, let the user know how it went
+        elif event == '-EXPORTED-':
+            window['-EXPORT-'].update("Export Data", disabled=False)
+            sg.popup(values['-EXPORTED-'], font='Roboto 15',
+                     icon=vessegen.ICON_PATH)
+
         elif event in ('Yes'):
             window[current_layout].update(visible=False)
             current_layout = '-CONFIRM-EMPTY-'
@@ -862,49 +823,254 @@ def chamber_wash_screen():
             window[current_layout].update(visible=False)
             current_layout = '-RUNNING-'
             window[current_layout].update(visible=True)
-            wash_chambers()
+            wash_chambers(window)
+            tick()
+
+        # If the user wants to stop the wash, close the valves. The wash is
+        # over once the daemon says so.
+        elif event == 'CANCEL3':
+            request("close_all")
+
+        # Show the progress of the wash until it is over
+        elif event == '-DAEMON-':
+            connection["client"].apply_changes()
+
+        if current_layout == '-RUNNING-' and not update_wash(window):
+            timers.cancel('-WASH-')
+            connection["client"].set_listener(None)
+            if control.run["wash"] is not None and\
+                    control.run["wash"]["cancelled"]:
+                window['-WASHDONE-'].update("Wash cycle stopped.")
             window[current_layout].update(visible=False)
             current_layout = '-COMPLETE-'
             window[current_layout].update(visible=True)
 
-
+    # If the window was closed part way through the wash, stop it
+    if current_layout == '-RUNNING-':
+        timers.cancel('-WASH-')
+        connection["client"].set_listener(None)
+        request("close_all")
     window.close()
 
 
-def wash_chambers():
-    """Wash the chambers in use."""
-    pass
+def export_run(window, path, start, end):
+    """Export the data for a run, telling the window once it is written.
 
+    This runs on its own thread, so it hands the outcome back to the window
+    as an '-EXPORTED-' event. The exporter is only loaded when it is first
+    needed, to keep it out of the way of starting up.
+    """
+    # pylint: disable=import-outside-toplevel
+    from vessegen import export
+    try:
+        count = export.export(path, start, end)
+        message = "Saved " + str(count) + " rows to " + path
+    except (ImportError, OSError, ValueError) as error:
+        message = "The data couldn't be saved: " + str(error)
+    window.write_event_value('-EXPORTED-', message)
+
+
+def wash_chambers(window):
+    """Wash the chambers that were used in the run.
+
+    The daemon runs the wash, overlapping the chambers' valves like it does
+    for media changes, and sends its progress to the window as '-DAEMON-'
+    events for update_wash to show.
+    """
+    connection["client"].set_listener(lambda:
+                                      window.write_event_value('-DAEMON-',
+                                                               None))
+    if control.run["wash"] is None or not control.run["wash"]["active"]:
+        request("wash")
+
+
+def update_wash(window):
+    """Show the progress of the wash, returning False once it is over."""
+    # pylint: disable=import-outside-toplevel
+    import humanize
+    wash = control.run["wash"]
+    if wash is None or not wash["active"]:
+        return False
+
+    done = wash["steps_done"]
+    total = max(wash["steps_total"], 1)
+    window['-WASHBAR-'].update(current_count=round(100 * done / total))
+    render.set_text(window, '-WASHSTEPS-', "Washing " +
+                    ", ".join(str(i + 1) for i in wash["chambers"]) + ": " +
+                    str(done) + " of " + str(total) + " steps done")
+
+    # Show when the wash should be done, counting down to it
+    end_time = datetime.datetime.fromisoformat(wash["end_time"])
+    render.set_text(window, '-WASHETA-', "Should be done at " +
+                    end_time.strftime("%H:%M") + " (" +
+                    humanize.naturaldelta(max(end_time - clock.now(),
+                                              datetime.timedelta())) +
+                    " from now)")
+    return True
+
+
+def request(op, **arguments):
+    """Make a request of the daemon, returning its result.
+
+    Any changes the daemon sent along with the result are applied first, so
+    the chambers are up to date once this returns. If the daemon turns the
+    request down, or has gone away, the user is told and None is returned.
+    A daemon that has gone away is connected to again (and started again if
+    need be), but the request isn't sent again, since it may have been
+    carried out before the daemon went away.
+    """
+    try:
+        result = connection["client"].request(op, **arguments)
+    except ValueError as error:
+        show_error("That couldn't be done: " + str(error))
+        return None
+    except ConnectionError:
+        try:
+            reconnect()
+        except OSError as error:
+            show_error("The software driving the valves can't be reached: " +
+                       str(error))
+        else:
+            show_error("The connection to the software driving the valves "
+                       "was lost, so that may not have been done. Check the "
+                       "chambers and try again if need be.")
+        return None
+    connection["client"].apply_changes()
+    return result
 
-def main():
-    """Top level function."""
-    while not shutdown['main']:
-        # Reset the chambers
-        reset_chambers()
 
-        # Reset shutdown variable
-        shutdown['settings'] = False
+def reconnect():
+    """Connect to the daemon again, starting it if it isn't running.
 
-        # Load the GUI that can input the user settings
-        get_user_settings()
+    Whoever was listening for the daemon's changes is kept listening, and the
+    chambers are brought up to date with the daemon's.
+    """
+    listener = connection["client"].listener
+    connection["client"].close()
+    connection["client"] = client.connect(connection["path"],
+                                          connection["spawn"])
+    connection["client"].set_listener(listener)
+    connection["client"].subscribe()
 
-        # If the user cancels, pass the current iteration
-        if shutdown["settings"]:
-            continue
 
-        # Define a new start time and make the chambers time accurate
-        start_time = datetime.datetime.now()
-        for i in range(8):
-            chambers[i]["last_changed"] = datetime.datetime.now()
+def show_error(message):
+    """Tell the user something went wrong, waiting until they have read it."""
+    sg.popup(message, title="Vessegen Bioreactor Software",
+             font='Roboto 15', icon=vessegen.ICON_PATH)
 
-        # Get the monitoring window
-        start_monitoring_window(start_time)
 
-        # Prompt the user if they would like to do a wash cycle
-        chamber_wash_screen()
+def main():
+    """Top level function."""
+    # Read the command line options
+    parser = argparse.ArgumentParser(prog="vessegen",
+                                     description="Run Vessegen's Bioreactor.")
+    client.add_arguments(parser)
+    parser.add_argument("--daemon", action="store_true",
+                        help="run the daemon that drives the valves instead "
+                        "of the windows")
+    args = parser.parse_args()
+
+    # If asked to, just drive the valves for the windows to connect to
+    if args.daemon:
+        # pylint: disable=import-outside-toplevel
+        from vessegen import daemon
+        daemon.run(args.gpio, args.pin_map, args.socket, args.http,
+                   args.profile)
+        return
+
+    # If asked to, measure how long the windows take to do things
+    if args.profile:
+        enable_profiling()
+
+    # Connect to the daemon that drives the valves, starting it if it isn't
+    # running, and keep a copy of its chambers to show
+    connection["path"] = args.socket
+    connection["spawn"] = lambda: spawn_daemon(args)
+    connection["client"] = client.connect(connection["path"],
+                                          connection["spawn"])
+    connection["client"].subscribe()
+
+    # If the daemon is in the middle of a run, carry on with it
+    resumed = control.run["active"]
 
+    while not shutdown['main']:
+        if resumed:
+            # Skip the settings and carry on with the resumed run
+            start_time = control.run["start_time"]
+            resumed = False
+        else:
+            # Reset the chambers
+            request("reset")
+
+            # Reset shutdown variable
+            shutdown['settings'] = False
+
+            # Load the GUI that can input the user settings
+            get_user_settings()
+
+            # If the user cancels, pass the current iteration
+            if shutdown["settings"]:
+                continue
+
+            # Define a new start time and make the chambers time accurate. If
+            # the run couldn't be started, go back to the settings.
+            started = request("start_run", length=settings["length"],
+                              change_interval=settings["change_interval"])
+            if started is None:
+                continue
+            start_time = datetime.datetime.fromisoformat(started)
+
+        # Get the monitoring window. If the user closed it rather than
+        # finishing, leave the run going in the daemon so the windows can
+        # pick it up again next time.
+        if not start_monitoring_window(start_time):
+            break
+        request("end_run")
+
+        # Prompt the user if they would like to do a wash cycle (or export the
+        # run's data)
+        chamber_wash_screen(start_time)
 
-atexit.register(reset_chambers)
+    close_popups()
+    connection["client"].close()
+    if profiling["enabled"]:
+        # pylint: disable=import-outside-toplevel
+        from vessegen import metrics
+        metrics.disable()
+
+
+def spawn_daemon(args):
+    """Start the daemon with the options the windows were started with.
+
+    The daemon is only loaded here, so the windows don't wait for it when it
+    is already running.
+    """
+    # pylint: disable=import-outside-toplevel
+    from vessegen import daemon
+    return daemon.spawn(args.gpio, args.pin_map, args.socket, args.http,
+                        profile=args.profile)
+
+
+def measure_startup():
+    """Measure how long the first window took to show, if profiling."""
+    if profiling["enabled"]:
+        # pylint: disable=import-outside-toplevel
+        from vessegen import metrics
+        metrics.startup("gui_startup")
+
+
+def enable_profiling():
+    """Measure the GUI's hot paths, writing them to the data directory."""
+    # pylint: disable=import-outside-toplevel
+    import humanize
+    from vessegen import metrics
+    profiling["enabled"] = True
+    metrics.enable(os.path.join(vessegen.DATA_DIR, "metrics-gui.prom"))
+    metrics.instrument(sys.modules[__name__], "update_monitor", "blink_led",
+                       "chamber_frame", prefix="gui")
+    metrics.instrument(render, "set_text", "natural_delta")
+    metrics.instrument(humanize, "naturaldelta", "naturaltime")
+    metrics.instrument(sg.Window, "__init__", "refresh")
 
 
 if __name__ == "__main__":
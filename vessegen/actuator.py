@@ -0,0 +1,160 @@
+"""Run the solenoid valves on their own thread, away from the GUI."""
+import queue
+import threading
+import vessegen
+from vessegen import clock
+from vessegen import gpio
+from vessegen import metrics
+from vessegen import valves
+from vessegen import watchdog
+
+# Commands for the actuator are sent through this queue as (command, argument)
+# tuples, so that only the actuator thread ever touches the GPIO outputs
+commands = queue.Queue()
+
+# Keep track of the actuator thread, when it last went round its loop (the
+# monotonic time in nanoseconds) and who should hear about valve progress
+worker = {
+    "thread": None,
+    "heartbeat": None,
+    "listener": None
+}
+
+
+def start():
+    """Start the actuator thread if it isn't already running."""
+    if worker["thread"] is not None and worker["thread"].is_alive():
+        return
+    worker["heartbeat"] = clock.monotonic_ns()
+    worker["thread"] = threading.Thread(target=_work, name="vessegen-actuator",
+                                        daemon=True)
+    worker["thread"].start()
+
+
+def stop():
+    """Close all valves and stop the actuator thread."""
+    if worker["thread"] is None:
+        return
+    commands.put(("stop", None))
+    worker["thread"].join()
+    worker["thread"] = None
+
+
+def is_running():
+    """Return True if the actuator thread is running."""
+    return worker["thread"] is not None and worker["thread"].is_alive()
+
+
+def heartbeat():
+    """Return when the actuator last went round its loop, or None if stopped.
+
+    The time is the monotonic time in nanoseconds. The loop goes round at
+    least every vessegen.WATCHDOG_INTERVAL seconds, even with nothing to do,
+    so the watchdog can tell if it is stuck.
+    """
+    return worker["heartbeat"] if is_running() else None
+
+
+def set_listener(listener):
+    """Set the function that is told about valve progress.
+
+    The listener is called from the actuator thread with the dictionary made
+    by valves.progress. It should hand the progress back to the GUI thread
+    rather than touching the GUI itself, e.g. with window.write_event_value.
+    """
+    worker["listener"] = listener
+
+
+def open_pin(pin, duration):
+    """Ask the actuator to open a pin for the given number of seconds."""
+    commands.put(("submit", valves.pin_job(pin, duration)))
+
+
+def submit(job):
+    """Ask the actuator to run a job created by the valve engine."""
+    commands.put(("submit", job))
+
+
+def cancel(chamber_ids):
+    """Stop the jobs for some chambers, closing their valves."""
+    commands.put(("cancel", list(chamber_ids)))
+
+
+def close_all():
+    """Close every valve, dropping any jobs that haven't finished.
+
+    If the actuator thread isn't running, the valves are closed right away.
+    """
+    if is_running():
+        commands.put(("close_all", None))
+    else:
+        valves.cancel_all(valves.new_engine())
+
+
+def _notify(job, event):
+    """Tell the listener (if there is one) what happened to a job."""
+    if worker["listener"] is not None:
+        worker["listener"](valves.progress(job, event))
+
+
+def _work():
+    """Run the valve engine, sleeping until the next deadline or command."""
+    engine = valves.new_engine()
+
+    # Set up every pin now, on this thread, rather than when the first valve
+    # opens (or before the daemon is ready for clients)
+    gpio.setup([pin for pins in vessegen.GPIO_PINS
+                for pin in (pins["remove"], pins["add"])])
+
+    spin = round(vessegen.VALVE_SPIN_TIME * 1e9)
+    while True:
+        worker["heartbeat"] = clock.monotonic_ns()
+
+        # Wait for a new command, but only until shortly before the next
+        # valve deadline, then wait out the rest of the time precisely. Wake
+        # up every so often anyway, so the heartbeat stays fresh.
+        deadline = valves.next_deadline(engine)
+        timeout = vessegen.WATCHDOG_INTERVAL if deadline is None else\
+            min((deadline - worker["heartbeat"] - spin) / 1e9,
+                vessegen.WATCHDOG_INTERVAL)
+        try:
+            if timeout <= 0:
+                command, argument = commands.get_nowait()
+            else:
+                command, argument = commands.get(timeout=timeout)
+        except queue.Empty:
+            command, argument = None, None
+            if deadline is not None and\
+                    deadline - clock.monotonic_ns() <= spin:
+                clock.sleep_until_ns(deadline)
+                if metrics.profile["enabled"]:
+                    metrics.observe("actuator_wake_lag",
+                                    (clock.monotonic_ns() - deadline) / 1e9)
+
+        # Stop the thread, making sure every valve is closed first
+        if command == "stop":
+            for job in valves.cancel_all(engine):
+                _notify(job, "cancelled")
+            break
+
+        # Add a new job to the engine
+        if command == "submit":
+            valves.submit(engine, argument)
+
+        # Drop the jobs for some chambers, closing their valves
+        elif command == "cancel":
+            for job in valves.cancel(engine, argument):
+                _notify(job, "cancelled")
+
+        # Close every valve and drop the jobs that were running
+        elif command == "close_all":
+            for job in valves.cancel_all(engine):
+                _notify(job, "cancelled")
+
+        # Open and close any valves that are due, and let the watchdog know
+        # which are open now before it can close any of them
+        with watchdog.writing():
+            events = valves.poll(engine, clock.monotonic_ns())
+            watchdog.track(engine)
+        for job, event in events:
+            _notify(job, event)
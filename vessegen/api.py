@@ -0,0 +1,325 @@
+"""Serve the chambers over HTTP so they can be watched from other computers.
+
+The API is a client of the daemon, and keeps a copy of its state along with
+a version number that goes up every time the run or some chambers change.
+All responses are JSON.
+
+    GET /state
+        The run and every chamber, with the version as the ETag. Sending the
+        ETag back in If-None-Match gets 304 Not Modified if nothing changed.
+
+    GET /changes?since=VERSION&wait=SECONDS
+        What changed after the given version, waiting up to the given number
+        of seconds (at most vessegen.API_MAX_WAIT) for something to change.
+        The result holds the "version", the "ids" of the chambers that
+        changed, their "chambers" and the "run" if it changed, like a change
+        sent by the daemon. If the version is too old to tell what changed,
+        the full state is sent without "ids". If nothing changed in time, the
+        response is 304 Not Modified.
+
+    GET /events
+        A stream of server-sent events, one for each change, with the version
+        as the event ID. Reconnecting with Last-Event-ID picks up where the
+        stream left off.
+
+    GET /history?start=TIME&end=TIME&chamber=ID&kind=KIND&resolution=SECONDS
+        The history of the chambers between two timestamps, as columns (see
+        vessegen/telemetry.py). The chamber, kind and resolution are optional.
+        At most vessegen.HISTORY_PAGE records are sent at once (fewer if a
+        "limit" is given). If there are more, the result holds "next", with
+        the "start", "resolution" and "skip" to ask for the rest with.
+
+    GET /metrics
+        How long things have taken in the daemon, in the Prometheus text
+        format, when it is run with --profile (see vessegen/metrics.py).
+
+    POST /OP
+        Make one of the daemon's requests (see vessegen/daemon.py), with the
+        JSON body as its arguments, e.g. POST /change_media with
+        {"chambers": [0, 1]}. If vessegen.API_TOKEN is set, the request must
+        have an "Authorization: Bearer TOKEN" header.
+"""
+import collections
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+import vessegen
+from vessegen import client
+from vessegen import metrics
+
+# The daemon's requests that can be made over HTTP
+OPS = ("state", "reset", "set_in_use", "start_run", "end_run", "add_media",
+       "empty_reservoirs", "change_media", "wash", "cancel", "close_all",
+       "calibrate", "fit_calibration", "calibration")
+
+# Keep track of the connection to the daemon, the latest state and version,
+# and the recent changes (as (version, message) tuples) for clients that are
+# catching up
+feed = {
+    "client": None,
+    "state": None,
+    "version": 0,
+    "log": collections.deque(maxlen=vessegen.API_HISTORY),
+    "condition": threading.Condition(),
+    "server": None
+}
+
+
+def serve(port, host="127.0.0.1", path=None):
+    """Connect to the daemon and serve the API until stop is called."""
+    feed["client"] = client.connect(path, spawn=lambda: None)
+    feed["client"].set_listener(_on_message)
+    state = feed["client"].request("subscribe")
+    with feed["condition"]:
+        # Start the versions from the time, so clients that remember a
+        # version from before a restart are sent everything
+        feed["state"] = state
+        feed["version"] = max(feed["version"] + 1, int(time.time() * 1000))
+        feed["log"].clear()
+    _on_message()
+
+    feed["server"] = http.server.ThreadingHTTPServer((host, port), Handler)
+    feed["server"].daemon_threads = True
+    try:
+        feed["server"].serve_forever()
+    finally:
+        feed["server"].server_close()
+        feed["server"] = None
+        feed["client"].close()
+        feed["client"] = None
+
+
+def start(port, host="127.0.0.1", path=None):
+    """Serve the API on a thread of its own, returning the thread."""
+    thread = threading.Thread(target=serve, args=(port, host, path),
+                              name="vessegen-api", daemon=True)
+    thread.start()
+    return thread
+
+
+def stop():
+    """Stop serving the API."""
+    if feed["server"] is not None:
+        feed["server"].shutdown()
+
+
+def changes_since(version):
+    """Return what changed after a version, or None if nothing has.
+
+    This is in the form described for GET /changes.
+    """
+    with feed["condition"]:
+        if version == feed["version"]:
+            return None
+
+        # If the version isn't in the log, all we can do is send everything
+        if not feed["log"] or version < feed["log"][0][0] - 1 or\
+                version > feed["version"]:
+            return dict(feed["state"], version=feed["version"])
+
+        # Merge the changes, sending each chamber as it is now
+        messages = [message for logged, message in feed["log"]
+                    if logged > version]
+        chamber_ids = sorted({chamber_id for message in messages
+                              for chamber_id in message["ids"]})
+
+        # A chamber that changed may have been removed since, so send
+        # everything
+        chambers = feed["state"]["chambers"]
+        if chamber_ids and chamber_ids[-1] >= len(chambers):
+            return dict(feed["state"], version=feed["version"])
+        result = {
+            "version": feed["version"],
+            "ids": chamber_ids,
+            "chambers": [chambers[chamber_id] for chamber_id in chamber_ids]
+        }
+        if any("run" in message for message in messages):
+            result["run"] = feed["state"]["run"]
+        return result
+
+
+def wait_for_change(version, timeout):
+    """Wait up to timeout seconds for a version newer than the given one."""
+    with feed["condition"]:
+        feed["condition"].wait_for(lambda: feed["version"] != version,
+                                   timeout)
+
+
+def _on_message():
+    """Apply the changes the daemon has sent to the copy of its state.
+
+    This is the client's listener, so it is called from the client's thread.
+    """
+    with feed["condition"]:
+        # Leave the changes waiting until the full state has arrived
+        if feed["state"] is None:
+            return
+        while not feed["client"].changes.empty():
+            message = feed["client"].changes.get()
+            chambers = feed["state"]["chambers"]
+            for chamber_id, chamber in zip(message["ids"],
+                                           message["chambers"]):
+                while len(chambers) <= chamber_id:
+                    chambers.append(None)
+                chambers[chamber_id] = chamber
+            if "run" in message:
+                feed["state"]["run"] = message["run"]
+
+            feed["version"] += 1
+            feed["log"].append((feed["version"], {
+                key: value for key, value in message.items()
+                if key in ("ids", "run")
+            }))
+        feed["condition"].notify_all()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Answer the requests for the API."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        """Send the state, the changes or the event stream."""
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == "/state":
+            with feed["condition"]:
+                version = feed["version"]
+                state = dict(feed["state"], version=version,
+                             chambers=list(feed["state"]["chambers"]))
+            if self.headers.get("If-None-Match") == _etag(version):
+                self._send_status(304, version)
+            else:
+                self._send_json(200, state, version)
+
+        elif url.path == "/changes":
+            try:
+                version = int(query.get("since", ["0"])[0])
+                wait = min(float(query.get("wait", ["0"])[0]),
+                           vessegen.API_MAX_WAIT)
+            except ValueError:
+                self._send_json(400, {"error": "since and wait must be "
+                                      "numbers"})
+                return
+            wait_for_change(version, max(wait, 0))
+            changes = changes_since(version)
+            if changes is None:
+                self._send_status(304, version)
+            else:
+                self._send_json(200, changes, changes["version"])
+
+        elif url.path == "/events":
+            self._stream_events()
+
+        elif url.path == "/metrics":
+            data = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        elif url.path == "/history":
+            arguments = {key: values[0] for key, values in query.items()
+                         if key in ("start", "end", "kind", "resolution",
+                                    "limit", "skip")}
+            try:
+                if "chamber" in query:
+                    arguments["chamber"] = int(query["chamber"][0])
+                self._send_json(200, feed["client"].request("history",
+                                                            **arguments))
+            except ValueError as error:
+                self._send_json(400, {"error": str(error)})
+            except ConnectionError as error:
+                self._send_json(503, {"error": str(error)})
+
+        else:
+            self._send_json(404, {"error": "Not found: " + url.path})
+
+    def do_POST(self):
+        """Make one of the daemon's requests."""
+        op = urllib.parse.urlsplit(self.path).path.strip("/")
+        if vessegen.API_TOKEN and self.headers.get("Authorization") !=\
+                "Bearer " + vessegen.API_TOKEN:
+            self._send_json(401, {"error": "Not authorized"})
+            return
+        if op not in OPS:
+            self._send_json(404, {"error": "Unknown op: " + op})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            arguments = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(arguments, dict):
+                raise ValueError("The body must be a JSON object")
+            arguments.pop("op", None)
+            arguments.pop("id", None)
+            result = feed["client"].request(op, **arguments)
+        except ValueError as error:
+            self._send_json(400, {"error": str(error)})
+        except ConnectionError as error:
+            self._send_json(503, {"error": str(error)})
+        else:
+            self._send_json(200, {"result": result})
+
+    def log_message(self, format, *args):
+        """Keep quiet rather than logging every request to stderr."""
+
+    def _stream_events(self):
+        """Send a server-sent event for every change until the client goes."""
+        try:
+            version = int(self.headers.get("Last-Event-ID", "0"))
+        except ValueError:
+            version = 0
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        try:
+            while feed["server"] is not None:
+                wait_for_change(version, vessegen.API_MAX_WAIT)
+                changes = changes_since(version)
+                if changes is None:
+                    # Let the client (and any proxies) know we're still here
+                    self.wfile.write(b": keep-alive\n\n")
+                else:
+                    version = changes["version"]
+                    self.wfile.write(("id: " + str(version) +
+                                      "\nevent: changed\ndata: " +
+                                      json.dumps(changes) +
+                                      "\n\n").encode("utf-8"))
+                self.wfile.flush()
+        except OSError:
+            pass
+
+    def _send_json(self, status, body, version=None):
+        """Send a JSON response."""
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "no-cache")
+        if version is not None:
+            self.send_header("ETag", _etag(version))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_status(self, status, version=None):
+        """Send a response with no body."""
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        if version is not None:
+            self.send_header("ETag", _etag(version))
+        self.end_headers()
+
+
+def _etag(version):
+    """Return the ETag for a version."""
+    return '"' + str(version) + '"'
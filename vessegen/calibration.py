@@ -0,0 +1,363 @@
+"""Calibrate how much media each chamber's valves move in a given time.
+
+Without a calibration, the valves are timed by the drain model in
+vessegen/flow.py, which is the same for every chamber. To calibrate a valve,
+it is opened for a few test pulses (vessegen.CALIBRATION_PULSES), the media
+each pulse moves is measured by hand, and a flow model is fitted to the
+volumes by least squares against how long the valve was actually open. The
+fitted model is turned into a table of how long to open the valve for each
+volume, every vessegen.CALIBRATION_STEP mL, so timing a valve is a lookup
+rather than solving the model.
+
+The fitted models are kept in calibration.json in the data directory, and
+the tables are made again from them when they are loaded. The calibration
+can be run from the command line with vessegen-calibrate, e.g.
+
+    vessegen-calibrate 3 --valve add
+
+which opens chamber 3's add valve for each test pulse in turn and asks for
+the volume it moved.
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+import vessegen
+from vessegen import client
+
+# The valves of a chamber that can be calibrated
+VALVES = ("add", "remove")
+
+# Keep track of the file the calibration is kept in, the fitted models and
+# lookup tables by (chamber ID, valve), and how long each valve was open for
+# the test pulses that haven't been fitted yet
+calibration = {
+    "path": None,
+    "models": {},
+    "tables": {},
+    "pulses": {}
+}
+
+
+def load(path=None):
+    """Load the fitted models and make their lookup tables."""
+    calibration["path"] = path or os.path.join(vessegen.DATA_DIR,
+                                               "calibration.json")
+    calibration["models"].clear()
+    calibration["tables"].clear()
+    try:
+        with open(calibration["path"], encoding="utf-8") as saved:
+            models = json.load(saved)["models"]
+    except FileNotFoundError:
+        return
+    for model in models:
+        key = (model["chamber_id"], model["valve"])
+        try:
+            calibration["tables"][key] = build_table(model["coefficients"])
+        except ValueError as error:
+            # Leave a model that can't be used to the drain model, rather
+            # than refusing to start
+            sys.stderr.write("vessegen: ignoring the calibration of chamber " +
+                             str(key[0] + 1) + "'s " + key[1] + " valve: " +
+                             str(error) + "\n")
+            continue
+        calibration["models"][key] = model
+
+
+def save():
+    """Write the fitted models without ever leaving the file half written."""
+    path = calibration["path"]
+    if path is None:
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as saved:
+        json.dump({"models": [calibration["models"][key] for key in
+                              sorted(calibration["models"])]}, saved,
+                  indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def record_progress(progress):
+    """Note how long a test pulse was open, given its valves.progress."""
+    if progress.get("kind") != "calibration" or\
+            progress["event"] != "done" or "achieved" not in progress:
+        return
+    chamber_id = progress["chamber_id"]
+    valve = "add" if progress["pin"] ==\
+        vessegen.GPIO_PINS[chamber_id]["add"] else "remove"
+    calibration["pulses"].setdefault((chamber_id, valve), []).append(
+        progress["achieved"])
+
+
+def fit_pulses(chamber_id, valve, volumes):
+    """Fit a valve's model to the volumes moved by its latest test pulses.
+
+    The volumes (in mL) are for the most recent test pulses, in order, and
+    any earlier pulses are left out. Returns the fitted model (as in
+    summary), which is also saved and used for the valve from now on.
+    """
+    try:
+        volumes = [float(volume) for volume in volumes]
+    except (TypeError, ValueError) as error:
+        raise ValueError("The volumes must be a list of numbers") from error
+    if not all(math.isfinite(volume) and volume >= 0 for volume in volumes):
+        raise ValueError("The volumes must be zero or more")
+
+    key = (chamber_id, valve)
+    opened = calibration["pulses"].get(key, [])
+    if not volumes or len(volumes) > len(opened):
+        raise ValueError("Chamber " + str(chamber_id + 1) + "'s " + valve +
+                         " valve has had " + str(len(opened)) +
+                         " test pulses, so between 1 and " +
+                         str(len(opened)) + " volumes are needed")
+
+    pulses = [[seconds, volume] for seconds, volume in
+              zip(opened[-len(volumes):], volumes)]
+    coefficients = fit(pulses)
+    model = {
+        "chamber_id": chamber_id,
+        "valve": valve,
+        "pulses": pulses,
+        "coefficients": coefficients,
+        "error": math.sqrt(sum((volume - volume_for(coefficients, seconds))
+                               ** 2 for seconds, volume in pulses) /
+                           len(pulses))
+    }
+    calibration["models"][key] = model
+    calibration["tables"][key] = build_table(coefficients)
+    del calibration["pulses"][key]
+    save()
+    return _describe(key)
+
+
+def fit(pulses):
+    """Fit the volume moved against how long the valve was open.
+
+    pulses is a list of (seconds, mL) pairs. The model is
+    a + b * t + c * t^2, fitted by least squares. a is usually negative,
+    since media only starts to flow once the valve has opened, and c lets
+    the flow slow down as the reservoir empties. With fewer than three
+    different pulse lengths, or if the curve would stop rising before the
+    volumes the tables cover, the straight line a + b * t is fitted instead
+    (so c is 0). Returns the coefficients [a, b, c].
+    """
+    lengths = len({seconds for seconds, _ in pulses})
+    if lengths < 2:
+        raise ValueError("At least two different pulse lengths are needed")
+
+    if lengths >= 3:
+        coefficients = _least_squares(pulses, 2)
+        if _rise_time(coefficients) is not None:
+            return coefficients
+
+    a, b = _least_squares(pulses, 1)
+    if b <= 0:
+        raise ValueError("The volumes don't go up with the pulse lengths")
+    return [a, b, 0.0]
+
+
+def volume_for(coefficients, seconds):
+    """Return the volume a fitted model moves in the given time (in mL)."""
+    a, b, c = coefficients
+    return a + b * seconds + c * seconds * seconds
+
+
+def build_table(coefficients):
+    """Return how long to open a valve for each volume, by solving its model.
+
+    The table holds the time (in seconds) for every vessegen.CALIBRATION_STEP
+    mL, from nothing up to twice the volume of a media change. The model
+    rises over the whole table (see fit), so each time is found by bisection.
+    A ValueError is raised if the model never reaches the top of the table.
+    """
+    top = 2 * vessegen.MEDIA_VOL
+    longest = _rise_time(coefficients)
+    if longest is None:
+        raise ValueError("The model never moves " + format(top, "g") +
+                         " mL")
+
+    table = []
+    for index in range(math.ceil(top / vessegen.CALIBRATION_STEP) + 1):
+        volume = index * vessegen.CALIBRATION_STEP
+        low, high = 0.0, longest
+        if volume_for(coefficients, low) >= volume:
+            high = low
+        while high - low > 1e-6:
+            middle = (low + high) / 2
+            if volume_for(coefficients, middle) < volume:
+                low = middle
+            else:
+                high = middle
+        table.append(high)
+    return table
+
+
+def duration_for(chamber_id, valve, volume):
+    """Return how long to open a valve to move a volume (in seconds).
+
+    The time is looked up in the valve's table, going between the nearest
+    entries, and following on from the last two past the end. Returns None
+    if the valve hasn't been calibrated.
+    """
+    table = calibration["tables"].get((chamber_id, valve))
+    if table is None:
+        return None
+    if volume <= 0:
+        return 0.0
+    position = volume / vessegen.CALIBRATION_STEP
+    index = min(int(position), len(table) - 2)
+    return table[index] + (table[index + 1] - table[index]) *\
+        (position - index)
+
+
+def summary():
+    """Return the fitted models and the test pulses waiting to be fitted.
+
+    Each model holds the "chamber_id", the "valve", the "pulses" it was
+    fitted to as (seconds, mL) pairs, its "coefficients" (see fit), the
+    root mean square "error" of the fit (in mL), and how long a media change
+    opens the valve for ("media_change_time", in seconds).
+    """
+    return {
+        "models": [_describe(key) for key in sorted(calibration["models"])],
+        "pulses": [{"chamber_id": chamber_id, "valve": valve,
+                    "achieved": achieved}
+                   for (chamber_id, valve), achieved in
+                   sorted(calibration["pulses"].items())]
+    }
+
+
+def _describe(key):
+    """Return a fitted model along with how long a media change takes."""
+    return dict(calibration["models"][key],
+                media_change_time=duration_for(*key, vessegen.MEDIA_VOL))
+
+
+def _rise_time(coefficients):
+    """Return a time by which a model has risen to the top of the table.
+
+    The model must rise from the start. If it bends over, the time is where
+    it peaks, so the bisection in build_table never looks past it. Returns
+    None if the model doesn't rise as far as the top of the table (or isn't
+    made of numbers at all).
+    """
+    a, b, c = coefficients
+    top = 2 * vessegen.MEDIA_VOL
+    if not all(math.isfinite(value) for value in coefficients) or b <= 0:
+        return None
+    if c < 0:
+        peak = -b / (2 * c)
+        return peak if volume_for(coefficients, peak) >= top else None
+
+    # Otherwise the model keeps rising, so double the time until it's enough
+    longest = 1.0
+    while volume_for(coefficients, longest) < top:
+        longest *= 2
+    return longest
+
+
+def _least_squares(pulses, degree):
+    """Fit a polynomial of the given degree to the pulses by least squares.
+
+    This solves the normal equations by Gaussian elimination, returning the
+    coefficients from the constant up.
+    """
+    size = degree + 1
+    rows = [[sum(seconds ** (row + column) for seconds, _ in pulses)
+             for column in range(size)] +
+            [sum(volume * seconds ** row for seconds, volume in pulses)]
+            for row in range(size)]
+    for column in range(size):
+        pivot = max(range(column, size),
+                    key=lambda row: abs(rows[row][column]))
+        if abs(rows[pivot][column]) < 1e-12:
+            raise ValueError("The pulses can't be fitted")
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        for row in range(column + 1, size):
+            factor = rows[row][column] / rows[column][column]
+            rows[row] = [value - factor * pivot_value for value, pivot_value
+                         in zip(rows[row], rows[column])]
+
+    coefficients = [0.0] * size
+    for row in reversed(range(size)):
+        coefficients[row] = (rows[row][size] -
+                             sum(rows[row][column] * coefficients[column]
+                                 for column in range(row + 1, size))) /\
+            rows[row][row]
+    return coefficients
+
+
+def _count_pulses(daemon, chamber_id, valve):
+    """Ask the daemon how many test pulses a valve has had since its fit."""
+    for pulses in daemon.request("calibration")["pulses"]:
+        if pulses["chamber_id"] == chamber_id and pulses["valve"] == valve:
+            return len(pulses["achieved"])
+    return 0
+
+
+def main():
+    """Calibrate a chamber's valve from the command line."""
+    parser = argparse.ArgumentParser(
+        prog="vessegen-calibrate",
+        description="Calibrate how much media a chamber's valve moves in "
+        "Vessegen's Bioreactor.")
+    parser.add_argument("chamber", type=int,
+                        help="the chamber to calibrate (numbered from 1)")
+    parser.add_argument("--valve", choices=VALVES, default="add",
+                        help="the valve to calibrate (defaults to add)")
+    parser.add_argument("--pulses", type=float, nargs="+",
+                        default=vessegen.CALIBRATION_PULSES,
+                        help="how long to open the valve for each test pulse "
+                        "(in seconds)")
+    parser.add_argument("--socket",
+                        help="the daemon's socket (defaults to the "
+                        "VESSEGEN_SOCKET environment variable, or "
+                        "~/.vessegen/vessegen.sock)")
+    args = parser.parse_args()
+    chamber_id = args.chamber - 1
+
+    try:
+        daemon = client.Client(args.socket)
+    except OSError as error:
+        parser.exit(1, "vessegen-calibrate: The daemon isn't running (" +
+                    str(error) + ")\n")
+
+    volumes = []
+    try:
+        for number, seconds in enumerate(args.pulses):
+            input("Pulse " + str(number + 1) + " of " + str(len(args.pulses)) +
+                  ": put an empty measuring cylinder under chamber " +
+                  str(args.chamber) + "'s " + args.valve +
+                  " line and press Enter.")
+            # Open the valve, and wait for the daemon to say it has closed
+            count = _count_pulses(daemon, chamber_id, args.valve) + 1
+            daemon.request("calibrate", chambers=[chamber_id],
+                           valve=args.valve, duration=seconds)
+            give_up = time.monotonic() + seconds + 60
+            while _count_pulses(daemon, chamber_id, args.valve) < count:
+                if time.monotonic() > give_up:
+                    parser.exit(1, "vessegen-calibrate: The test pulse "
+                                "didn't finish, is the chamber busy?\n")
+                time.sleep(0.2)
+            volumes.append(float(input("How much media moved (in mL)? ")))
+
+        model = daemon.request("fit_calibration", chamber=chamber_id,
+                               valve=args.valve, volumes=volumes)
+    except (ConnectionError, ValueError) as error:
+        parser.exit(1, "vessegen-calibrate: " + str(error) + "\n")
+    finally:
+        daemon.close()
+
+    a, b, c = model["coefficients"]
+    sys.stdout.write("Fitted volume = " + format(a, ".4g") + " + " +
+                     format(b, ".4g") + " * t + " + format(c, ".4g") +
+                     " * t^2, within " + format(model["error"], ".2g") +
+                     " mL\n")
+    sys.stdout.write("A media change now opens the valve for " +
+                     format(model["media_change_time"], ".2f") + " s\n")
+
+
+if __name__ == "__main__":
+    main()
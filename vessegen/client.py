@@ -0,0 +1,178 @@
+"""Talk to the daemon over its Unix socket.
+
+See vessegen/daemon.py for the requests that can be made. A client that
+subscribes keeps vessegen.control up to date with the daemon's chambers, so
+the windows can show them just like they would if they ran the valves
+themselves.
+"""
+import json
+import queue
+import socket
+import threading
+import time
+import vessegen
+from vessegen import control
+from vessegen import gpio
+
+
+class Client:
+    """A connection to the daemon."""
+
+    def __init__(self, path=None):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path or vessegen.SOCKET_PATH)
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.replies = {}
+        self.next_id = 1
+        self.closed = False
+
+        # Changes sent by the daemon wait here until they are applied, and
+        # the listener (if there is one) is told when one arrives
+        self.changes = queue.Queue()
+        self.listener = None
+
+        self.thread = threading.Thread(target=self._read,
+                                       name="vessegen-client", daemon=True)
+        self.thread.start()
+
+    def request(self, op, **arguments):
+        """Make a request and wait for its result.
+
+        A ValueError is raised if the daemon turns the request down, and a
+        ConnectionError if the daemon goes away.
+        """
+        with self.condition:
+            request_id = self.next_id
+            self.next_id += 1
+
+        message = dict(arguments, id=request_id, op=op)
+        try:
+            with self.lock:
+                self.socket.sendall(json.dumps(message).encode("utf-8") +
+                                    b"\n")
+        except OSError as error:
+            raise ConnectionError("Lost the connection to the daemon") from\
+                error
+
+        with self.condition:
+            self.condition.wait_for(lambda: request_id in self.replies or
+                                    self.closed)
+            if request_id not in self.replies:
+                raise ConnectionError("Lost the connection to the daemon")
+            reply = self.replies.pop(request_id)
+
+        if "error" in reply:
+            raise ValueError(reply["error"])
+        return reply.get("result")
+
+    def subscribe(self):
+        """Copy the daemon's run and chambers into vessegen.control.
+
+        From then on, apply_changes keeps them up to date.
+        """
+        control.apply_state(self.request("subscribe"))
+
+    def apply_changes(self):
+        """Apply the changes the daemon has sent to vessegen.control.
+
+        This should be called from the thread that uses vessegen.control (the
+        GUI thread), e.g. when the listener says there are changes waiting.
+        """
+        while not self.changes.empty():
+            control.apply_state(self.changes.get())
+
+    def set_listener(self, listener):
+        """Set the function that is told when the daemon sends something.
+
+        The listener is called with no arguments from the client's own
+        thread, so like an actuator listener it should hand over to the GUI
+        thread, e.g. with window.write_event_value.
+        """
+        self.listener = listener
+
+    def close(self):
+        """Close the connection."""
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        self.thread.join()
+
+    def _read(self):
+        """Read replies and changes from the daemon until it goes away."""
+        with self.socket.makefile("rb") as lines:
+            try:
+                for line in lines:
+                    try:
+                        message = json.loads(line)
+                    except ValueError:
+                        continue
+                    if message.get("event") == "changed":
+                        self.changes.put(message)
+                        self._notify()
+                    else:
+                        with self.condition:
+                            self.replies[message.get("id")] = message
+                            self.condition.notify_all()
+            except OSError:
+                pass
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self._notify()
+
+    def _notify(self):
+        """Tell the listener (if there is one) that something arrived."""
+        if self.listener is not None:
+            self.listener()
+
+
+def connect(path=None, spawn=None, timeout=10.0):
+    """Connect to the daemon, starting it first if it isn't running.
+
+    spawn is called to start the daemon if it can't be reached, and then the
+    connection is retried until the timeout (in seconds) runs out.
+    """
+    try:
+        return Client(path)
+    except OSError:
+        if spawn is None:
+            raise
+    spawn()
+
+    give_up = time.monotonic() + timeout
+    while True:
+        try:
+            return Client(path)
+        except OSError:
+            if time.monotonic() > give_up:
+                raise
+            time.sleep(0.1)
+
+
+def add_arguments(parser):
+    """Add the command line options for the daemon to a parser.
+
+    These are here rather than in vessegen/daemon.py so the windows can read
+    them without loading the daemon, which they only need if it has to be
+    started.
+    """
+    parser.add_argument("--gpio", choices=sorted(gpio.BACKENDS),
+                        help="the GPIO board to drive (defaults to the "
+                        "VESSEGEN_GPIO environment variable, or rpi)")
+    parser.add_argument("--pin-map",
+                        help="the pin map to use (defaults to the one in the "
+                        "configuration file, or default)")
+    parser.add_argument("--socket",
+                        help="the socket to listen on (defaults to the "
+                        "VESSEGEN_SOCKET environment variable, or "
+                        "vessegen.sock in the data directory)")
+    parser.add_argument("--http", metavar="[HOST:]PORT",
+                        help="also serve the HTTP API, on localhost unless a "
+                        "host is given")
+    parser.add_argument("--profile", action="store_true",
+                        help="measure how long things take, writing the "
+                        "results to the data directory")
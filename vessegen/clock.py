@@ -0,0 +1,130 @@
+"""Tell the time through a clock that can be swapped for a virtual one.
+
+Everything that needs the time goes through this module, so a simulation can
+replace the real clock with a VirtualClock and run days of an experiment in
+seconds.
+
+There are two kinds of time. The wall clock (time and now) is for things
+people see and plan by, like when a media change is due. The monotonic clock
+(monotonic_ns) never jumps when the computer's time is corrected, so it is
+used to time the valves, counting whole nanoseconds.
+"""
+import datetime
+import time as system_time
+import vessegen
+
+
+class SystemClock:
+    """The real clock of the computer."""
+
+    def time(self):
+        """Return the current time in seconds since the epoch."""
+        return system_time.time()
+
+    def now(self):
+        """Return the current time as a datetime."""
+        return datetime.datetime.now()
+
+    def sleep(self, seconds):
+        """Wait for the given number of seconds."""
+        system_time.sleep(seconds)
+
+    def monotonic_ns(self):
+        """Return the monotonic time in nanoseconds."""
+        return system_time.monotonic_ns()
+
+    def sleep_until_ns(self, deadline):
+        """Wait until the given monotonic time (in nanoseconds).
+
+        Sleeping can wake up late, so this sleeps until shortly before the
+        deadline and then spins for the last vessegen.VALVE_SPIN_TIME seconds.
+        """
+        spin = round(vessegen.VALVE_SPIN_TIME * 1e9)
+        remaining = deadline - system_time.monotonic_ns()
+        if remaining > spin:
+            system_time.sleep((remaining - spin) / 1e9)
+        while system_time.monotonic_ns() < deadline:
+            pass
+
+
+class VirtualClock:
+    """A clock that only moves forward when it is told to."""
+
+    def __init__(self, start=None):
+        """Start the clock at the given time, or the real time if None."""
+        self.current = system_time.time() if start is None else start
+        self.ticks = 0
+
+    def time(self):
+        """Return the current virtual time in seconds since the epoch."""
+        return self.current
+
+    def now(self):
+        """Return the current virtual time as a datetime."""
+        return datetime.datetime.fromtimestamp(self.current)
+
+    def sleep(self, seconds):
+        """Move the clock forward instead of waiting."""
+        self.advance(seconds)
+
+    def monotonic_ns(self):
+        """Return the nanoseconds the virtual clock has moved forward."""
+        return self.ticks
+
+    def sleep_until_ns(self, deadline):
+        """Move the clock forward instead of waiting."""
+        self.advance_to_ns(deadline)
+
+    def advance(self, seconds):
+        """Move the clock forward by the given number of seconds."""
+        self.current += max(seconds, 0)
+        self.ticks += max(round(seconds * 1e9), 0)
+
+    def advance_to(self, when):
+        """Move the clock forward to the given time, if it is in the future."""
+        if when > self.current:
+            self.ticks += round((when - self.current) * 1e9)
+            self.current = when
+
+    def advance_to_ns(self, deadline):
+        """Move the clock forward to a monotonic time, if it is later."""
+        if deadline > self.ticks:
+            self.current += (deadline - self.ticks) / 1e9
+            self.ticks = deadline
+
+
+# Keep track of the clock in use
+clock = {
+    "current": SystemClock()
+}
+
+
+def use(new_clock):
+    """Use the given clock for all timing, returning it."""
+    clock["current"] = new_clock
+    return new_clock
+
+
+def time():
+    """Return the current time in seconds since the epoch."""
+    return clock["current"].time()
+
+
+def now():
+    """Return the current time as a datetime."""
+    return clock["current"].now()
+
+
+def sleep(seconds):
+    """Wait for the given number of seconds."""
+    clock["current"].sleep(seconds)
+
+
+def monotonic_ns():
+    """Return the monotonic time in nanoseconds."""
+    return clock["current"].monotonic_ns()
+
+
+def sleep_until_ns(deadline):
+    """Wait until the given monotonic time (in nanoseconds)."""
+    clock["current"].sleep_until_ns(deadline)
@@ -0,0 +1,124 @@
+"""Load the rig configuration: which pin map to use and how many chambers.
+
+The configuration is a JSON file at vessegen.CONFIG_PATH, e.g.
+
+    {
+        "pin_map": "expander",
+        "pin_maps": {
+            "expander": [{"add": 100, "remove": 101},
+                         {"add": 102, "remove": 103}]
+        },
+        "chambers": 2,
+        "max_open_valves": 2,
+        "wash_cycles": 2,
+        "wash_soak_time": 600
+    }
+
+"pin_map" chooses one of vessegen.PIN_MAPS or one of the "pin_maps" given in
+the file, and "chambers" optionally uses only the first few chambers of it.
+"max_open_valves" replaces vessegen.MAX_OPEN_VALVES for rigs with a bigger or
+smaller power supply, and "wash_cycles" and "wash_soak_time" replace
+vessegen.WASH_CYCLES and vessegen.WASH_SOAK_TIME. Everything is optional, and
+without a file the default pin map is used. Each of these is checked when the
+file is loaded, so a mistake is reported when the daemon starts rather than
+when the valves are next used.
+"""
+import json
+import math
+import vessegen
+from vessegen import control
+
+# The settings that replace one of the limits in vessegen, as (setting,
+# name in vessegen, smallest value allowed, whether it must be whole)
+LIMITS = (
+    ("max_open_valves", "MAX_OPEN_VALVES", 1, True),
+    ("wash_cycles", "WASH_CYCLES", 1, True),
+    ("wash_soak_time", "WASH_SOAK_TIME", 0, False)
+)
+
+
+def load(path=None):
+    """Load the configuration file, returning an empty one if there is none."""
+    try:
+        with open(path or vessegen.CONFIG_PATH, encoding="utf-8") as config:
+            return json.load(config)
+    except FileNotFoundError:
+        return {}
+
+
+def pins_for(config, pin_map=None):
+    """Return the pins to use for a configuration.
+
+    The pin map named by pin_map is used if given, otherwise the one named in
+    the configuration. A ValueError is raised if the pin map is unknown, if
+    a pin is used twice or if the number of chambers isn't a whole number of
+    at least 1.
+    """
+    pin_maps = dict(vessegen.PIN_MAPS)
+    pin_maps.update(config.get("pin_maps", {}))
+
+    name = pin_map or config.get("pin_map", "default")
+    if name not in pin_maps:
+        raise ValueError("Unknown pin map: " + name + " (choose from " +
+                         ", ".join(sorted(pin_maps)) + ")")
+    chambers = config.get("chambers")
+    if chambers is not None and not _is_number(chambers, 1, True):
+        raise ValueError('"chambers" in the configuration should be a whole '
+                         'number of at least 1')
+    pins = pin_maps[name][:chambers]
+
+    # Make sure no two valves share a pin
+    used = [chamber[valve] for chamber in pins for valve in ("add", "remove")]
+    if len(used) != len(set(used)):
+        raise ValueError("Pin map " + name + " uses a pin more than once")
+    return pins
+
+
+def limits_for(config):
+    """Return the limits a configuration replaces, keyed by name in vessegen.
+
+    A ValueError is raised if one of them isn't a number, is less than it
+    can be, or isn't whole when it has to be.
+    """
+    limits = {}
+    for setting, name, smallest, whole in LIMITS:
+        if setting not in config:
+            continue
+        if not _is_number(config[setting], smallest, whole):
+            raise ValueError('"' + setting + '" in the configuration should '
+                             'be a ' + ("whole " if whole else "") +
+                             'number of at least ' + str(smallest))
+        limits[name] = config[setting]
+    return limits
+
+
+def _is_number(value, smallest, whole):
+    """Return True if a value is a number of at least the smallest allowed.
+
+    If whole is True, the number must be a whole number too. True and False
+    are not numbers here, even though Python counts them as 1 and 0.
+    """
+    if isinstance(value, bool) or\
+            not isinstance(value, int if whole else (int, float)):
+        return False
+    return math.isfinite(value) and value >= smallest
+
+
+def use_pins(pins):
+    """Drive the chambers with the given pins, one chamber for each entry."""
+    vessegen.GPIO_PINS[:] = pins
+    control.resize(len(pins))
+
+
+def configure(path=None, pin_map=None):
+    """Load the configuration and use the pins and limits it asks for.
+
+    Everything is checked before anything is used, so a ValueError leaves
+    the pins and limits as they were.
+    """
+    config = load(path)
+    pins = pins_for(config, pin_map)
+    limits = limits_for(config)
+    use_pins(pins)
+    for name, value in limits.items():
+        setattr(vessegen, name, value)
@@ -0,0 +1,521 @@
+"""Keep track of the chambers and control their media.
+
+This holds the state of the chambers and the actions that can be taken on
+them, separate from the GUI, so the same control logic can be driven by the
+windows or by a headless simulation.
+"""
+import datetime
+import vessegen
+from vessegen import actuator
+from vessegen import clock
+from vessegen import flow
+from vessegen import valves
+from vessegen.status import Status
+
+
+class Chamber:
+    """The information kept for a single chamber.
+
+    The fields are slots rather than dictionary keys, so each chamber is a
+    small fixed record and a mistyped field fails straight away. The status
+    is always a Status, and the detail says more about it when there is more
+    to say, e.g. which cycle of a wash the chamber is in (see
+    vessegen/status.py).
+    """
+
+    __slots__ = ("chamber_id", "is_in_use", "last_changed",
+                 "media_in_chamber", "status", "detail")
+
+    def __init__(self, chamber_id):
+        """Create the information for an unused chamber."""
+        self.chamber_id = chamber_id
+        self.is_in_use = False
+        self.last_changed = None
+        self.media_in_chamber = 0
+        self.status = Status.UNUSED
+        self.detail = None
+
+    def saved(self):
+        """Return the chamber in a form that can be written as JSON."""
+        return {
+            "chamber_id": self.chamber_id,
+            "is_in_use": self.is_in_use,
+            "last_changed": None if self.last_changed is None else
+            self.last_changed.isoformat(),
+            "media_in_chamber": self.media_in_chamber,
+            "status": self.status,
+            "detail": self.detail
+        }
+
+    def settle(self):
+        """Show the chamber as running if it is in use, or unused if not."""
+        self.status = Status.RUNNING if self.is_in_use else Status.UNUSED
+        self.detail = None
+
+
+# Initialize a structure to keep track of chambers, with one chamber for each
+# entry in the pin map
+chambers = [Chamber(n + 1) for n in range(len(vessegen.GPIO_PINS))]
+
+# Keep track of the IDs of the chambers in use, so they don't have to be
+# looked for every time they are needed. This is kept up to date by every
+# function that puts chambers in or out of use.
+using = set()
+
+# Keep track of the run in progress. The length of the run and the time
+# between automatic media changes are in seconds, and are None if not set. The
+# wash is None until the chambers are washed (see wash_jobs).
+run = {
+    "active": False,
+    "start_time": None,
+    "length": None,
+    "change_interval": None,
+    "wash": None
+}
+
+# Functions to call whenever the run or the chambers change. Each is called
+# with the kind of change ("run" or "chamber") and a list of the IDs of the
+# chambers that changed.
+listeners = []
+
+
+def _changed(kind, chamber_ids=()):
+    """Tell the listeners that the run or some chambers have changed."""
+    for listener in listeners:
+        listener(kind, list(chamber_ids))
+
+
+def reset_chambers():
+    """Reset the chambers if requested.
+
+    This is useful since the software is set up to run on a loop until told to
+    stop, meaning there may be multiple trials run in between stopping the
+    software. Thus, the chambers need to be reset in between trials.
+    """
+    for chamber in chambers:
+        chamber.is_in_use = False
+        chamber.last_changed = None
+        chamber.media_in_chamber = 0
+        chamber.settle()
+    using.clear()
+    run["active"] = False
+    run["start_time"] = None
+    run["length"] = None
+    run["change_interval"] = None
+    run["wash"] = None
+
+    # Make sure none of the valves are left open
+    actuator.close_all()
+    _changed("run", range(len(chambers)))
+
+
+def resize(count):
+    """Change the number of chambers, keeping the ones that remain."""
+    chambers[count:] = []
+    chambers.extend(Chamber(n + 1) for n in range(len(chambers), count))
+    using.difference_update(range(count, max(using, default=-1) + 1))
+    _changed("run", range(len(chambers)))
+
+
+def set_in_use(chamber_ids, is_in_use):
+    """Set whether some chambers will be used in the run."""
+    for chamber_id in chamber_ids:
+        chambers[chamber_id].is_in_use = is_in_use
+
+        # Make sure the status correlates to its is_in_use
+        chambers[chamber_id].settle()
+    if is_in_use:
+        using.update(chamber_ids)
+    else:
+        using.difference_update(chamber_ids)
+    _changed("chamber", chamber_ids)
+
+
+def start_run(length=None, change_interval=None):
+    """Start a new run, returning its start time.
+
+    The chambers are treated as if their media was just changed. The length
+    of the run and the time between automatic media changes are in seconds,
+    and can be left as None to run until finished and change media by hand.
+    """
+    start_time = clock.now()
+    for chamber in chambers:
+        chamber.last_changed = start_time
+    run["active"] = True
+    run["start_time"] = start_time
+    run["length"] = length
+    run["change_interval"] = change_interval
+    run["wash"] = None
+    _changed("run", range(len(chambers)))
+    return start_time
+
+
+def end_run():
+    """End the run in progress, keeping the chamber information."""
+    run["active"] = False
+    run["start_time"] = None
+    run["length"] = None
+    run["change_interval"] = None
+    _changed("run")
+
+
+def restore(state):
+    """Restore the run and chambers from a saved state.
+
+    The state is a dictionary like the one made by saved_state. Chambers that
+    were in the middle of a media change or a wash are set back to running,
+    since their valves were closed when the software stopped. Returns True if
+    a run was in progress.
+    """
+    if state is None:
+        return False
+
+    _load(state)
+    for chamber in chambers:
+        chamber.settle()
+    if run["wash"] is not None and run["wash"]["active"]:
+        _finish_wash(cancelled=True)
+    _changed("run", range(len(chambers)))
+    return run["active"]
+
+
+def apply_state(state):
+    """Copy a saved state into the run and chambers as it is.
+
+    This keeps a copy of the chambers up to date with the ones in another
+    process. The state is a dictionary like the one made by saved_state. If it
+    has the "ids" of the chambers it holds, only those chambers are replaced,
+    and if it has no "run", the run is left as it is. Otherwise the number of
+    chambers is changed to match the state.
+    """
+    if "ids" not in state:
+        resize(len(state["chambers"]))
+    _load(state)
+    _changed("run" if "run" in state else "chamber",
+             state.get("ids", range(len(chambers))))
+
+
+def _load(state):
+    """Copy a saved state into the run and chambers."""
+    for chamber_id, saved in zip(state.get("ids", range(len(chambers))),
+                                 state["chambers"]):
+        if chamber_id >= len(chambers):
+            continue
+        chamber = chambers[chamber_id]
+        chamber.is_in_use = saved["is_in_use"]
+        chamber.last_changed = None if saved["last_changed"] is None else\
+            datetime.datetime.fromisoformat(saved["last_changed"])
+        chamber.media_in_chamber = saved["media_in_chamber"]
+
+        # States saved before every status was a Status may hold the text of
+        # a wash step, which was over once the software stopped anyway
+        try:
+            chamber.status = Status(saved["status"])
+            chamber.detail = saved.get("detail")
+        except ValueError:
+            chamber.settle()
+        if chamber.is_in_use:
+            using.add(chamber_id)
+        else:
+            using.discard(chamber_id)
+
+    if "run" in state:
+        run["active"] = state["run"]["active"]
+        run["start_time"] = None if state["run"]["start_time"] is None else\
+            datetime.datetime.fromisoformat(state["run"]["start_time"])
+        run["length"] = state["run"].get("length")
+        run["change_interval"] = state["run"].get("change_interval")
+        run["wash"] = state["run"].get("wash")
+
+
+def saved_state(chamber_ids=None):
+    """Return the run and chambers in a form that can be written as JSON.
+
+    If chamber_ids is given, only those chambers are included.
+    """
+    if chamber_ids is None:
+        chamber_ids = range(len(chambers))
+    return {
+        "run": {
+            "active": run["active"],
+            "start_time": None if run["start_time"] is None else
+            run["start_time"].isoformat(),
+            "length": run["length"],
+            "change_interval": run["change_interval"],
+            "wash": None if run["wash"] is None else dict(run["wash"])
+        },
+        "chambers": [saved_chamber(chamber_id) for chamber_id in chamber_ids]
+    }
+
+
+def saved_chamber(chamber_id):
+    """Return a chamber in a form that can be written as JSON."""
+    return chambers[chamber_id].saved()
+
+
+def in_use():
+    """Return the IDs of the chambers that are in use, in order."""
+    return sorted(using)
+
+
+def add_media(chamber_ids, volume):
+    """Add media to the reservoirs of the specified chambers.
+
+    The chambers default to every chamber in use, so media can be added to
+    all of them in a single pass. The volume may be negative, but a
+    reservoir never goes below empty.
+    """
+    chamber_ids = in_use() if chamber_ids is None else chamber_ids
+    for chamber_id in chamber_ids:
+        chamber = chambers[chamber_id]
+        chamber.media_in_chamber = max(volume + chamber.media_in_chamber, 0)
+    _changed("chamber", chamber_ids)
+
+
+def empty_reservoirs(chamber_ids):
+    """Empty the reservoirs of the specified chambers (or those in use)."""
+    chamber_ids = in_use() if chamber_ids is None else chamber_ids
+    for chamber_id in chamber_ids:
+        chambers[chamber_id].media_in_chamber = 0
+    _changed("chamber", chamber_ids)
+
+
+def low_media(chamber_ids):
+    """Return the chambers that don't have enough media for a media change."""
+    return [i for i in chamber_ids
+            if chambers[i].media_in_chamber < vessegen.MEDIA_VOL]
+
+
+def media_change_jobs(chamber_ids):
+    """Create the valve jobs to change the media in the specified chambers.
+
+    Only chambers that have enough media and aren't already in the middle of a
+    media change get a job, so asking again for a chamber that is queued
+    does nothing. Those chambers are marked as queued until their first
+    valve opens.
+    """
+    jobs = []
+    for chamber_id in chamber_ids:
+        chamber = chambers[chamber_id]
+        if chamber.media_in_chamber < vessegen.MEDIA_VOL or\
+                chamber.status != Status.RUNNING:
+            continue
+
+        # Determine the time it will take to remove the media
+        time_to_remove, _ = flow.calculate_media_change_time(
+            vessegen.MEDIA_VOL, chamber_id=chamber_id)
+
+        # Calculate the time it will take to add the media as well as the
+        # volume we estimate to be removed
+        time_to_add, vol = flow.calculate_media_change_time(
+            chamber.media_in_chamber, True, chamber_id)
+
+        # Inform the user the chamber is queued for a valve
+        chamber.status = Status.QUEUED
+        jobs.append(valves.media_change_job(chamber_id, time_to_remove,
+                                            time_to_add, vol))
+    _changed("chamber", [job["chamber_id"] for job in jobs])
+    return jobs
+
+
+def wash_jobs(chamber_ids, cycles=None, soak=None):
+    """Create the valve jobs to wash the specified chambers.
+
+    Each chamber is drained, filled with wash media and left to soak for the
+    given number of cycles (vessegen.WASH_CYCLES by default), soaking for
+    the given number of seconds (vessegen.WASH_SOAK_TIME by default). The
+    jobs share the valves like media changes do, so one chamber fills while
+    another drains or soaks, never opening more solenoids than
+    vessegen.MAX_OPEN_VALVES allows. The progress of the wash is kept in the
+    run's "wash", along with an estimate of when it will be done.
+    """
+    cycles = vessegen.WASH_CYCLES if cycles is None else cycles
+    soak = vessegen.WASH_SOAK_TIME if soak is None else soak
+    if cycles < 1 or soak < 0:
+        raise ValueError("A wash needs at least one cycle and a soak time "
+                         "of zero or more")
+
+    jobs = []
+    for chamber_id in chamber_ids:
+        time_to_remove, _ = flow.calculate_media_change_time(
+            vessegen.MEDIA_VOL, chamber_id=chamber_id)
+
+        # The reservoir was filled with wash media, which may not have been
+        # entered, so assume there is enough for every cycle with a fill to
+        # spare
+        reservoir = max(chambers[chamber_id].media_in_chamber,
+                        vessegen.MEDIA_VOL * (cycles + 1))
+        times_to_add = []
+        volume = 0
+        for _ in range(cycles):
+            time_to_add, vol = flow.calculate_media_change_time(
+                reservoir, True, chamber_id)
+            times_to_add.append(time_to_add)
+            reservoir -= vol
+            volume += vol
+
+        chambers[chamber_id].status = Status.QUEUED
+        jobs.append(valves.wash_job(chamber_id, time_to_remove, times_to_add,
+                                    soak, volume))
+
+    # Keep track of how much valve time and how much time overall each
+    # chamber has left, for estimating when the wash will be done
+    run["wash"] = {
+        "active": bool(jobs),
+        "cancelled": False,
+        "chambers": [job["chamber_id"] for job in jobs],
+        "steps_done": 0,
+        "steps_total": sum(len(job["steps"]) for job in jobs),
+        "start_time": clock.now().isoformat(),
+        "end_time": None,
+        "left": [[sum(step["duration"] for step in job["steps"]),
+                  sum(step["duration"] + step.get("soak", 0) +
+                      vessegen.VALVE_SETTLE_TIME for step in job["steps"])]
+                 for job in jobs]
+    }
+    _estimate_wash()
+    _changed("run", [job["chamber_id"] for job in jobs])
+    return jobs
+
+
+def calibration_jobs(chamber_ids, valve, duration):
+    """Create the valve jobs for a test pulse on the specified chambers.
+
+    The valve ("add" or "remove") of each chamber that isn't busy is opened
+    for the given number of seconds, so the media it moves can be measured
+    (see vessegen/calibration.py). The time must be more than zero and no
+    more than vessegen.CALIBRATION_MAX_PULSE, which also turns away NaN and
+    infinity.
+    """
+    if valve not in ("add", "remove") or\
+            not 0 < duration <= vessegen.CALIBRATION_MAX_PULSE:
+        raise ValueError("A test pulse needs the add or remove valve and a "
+                         "time of more than zero and at most " +
+                         format(vessegen.CALIBRATION_MAX_PULSE, "g") +
+                         " seconds")
+
+    jobs = []
+    for chamber_id in chamber_ids:
+        if chambers[chamber_id].status not in (Status.UNUSED,
+                                               Status.RUNNING):
+            continue
+        chambers[chamber_id].status = Status.QUEUED
+        jobs.append(valves.calibration_job(chamber_id, valve, duration))
+    _changed("chamber", [job["chamber_id"] for job in jobs])
+    return jobs
+
+
+def _estimate_wash():
+    """Estimate when the wash will be done from the time the chambers need.
+
+    The wash takes at least as long as the chamber with the most time left,
+    and at least as long as the valve time left when only
+    vessegen.MAX_OPEN_VALVES valves can be open at once.
+    """
+    wash = run["wash"]
+    left = max([0.0] + [total for _, total in wash["left"]] +
+               [sum(valve for valve, _ in wash["left"]) /
+                max(vessegen.MAX_OPEN_VALVES, 1)])
+    wash["end_time"] = (clock.now() +
+                        datetime.timedelta(seconds=left)).isoformat()
+
+
+def _finish_wash(cancelled=False):
+    """Mark the wash as done once no chamber has anything left to do.
+
+    If cancelled is True, the whole wash was stopped, so every chamber is
+    done.
+    """
+    wash = run["wash"]
+    wash["cancelled"] = wash["cancelled"] or cancelled
+    if cancelled:
+        wash["left"] = [[0.0, 0.0] for _ in wash["left"]]
+    if all(total <= 0 for _, total in wash["left"]):
+        wash["active"] = False
+        wash["end_time"] = clock.now().isoformat()
+
+
+def _apply_wash_event(progress):
+    """Update the progress of the wash as a chamber's valves close."""
+    wash = run["wash"]
+    if wash is None or progress["chamber_id"] not in wash["chambers"]:
+        return
+    left = wash["left"][wash["chambers"].index(progress["chamber_id"])]
+
+    if progress["event"] in ("closed", "done"):
+        wash["steps_done"] += 1
+        left[0] = max(left[0] - progress.get("requested", 0), 0.0)
+        left[1] = max(left[1] - progress.get("requested", 0) -
+                      progress.get("soak", 0) - vessegen.VALVE_SETTLE_TIME,
+                      0.0)
+    # A chamber that is cancelled has nothing left to do, but the others
+    # carry on with the wash
+    if progress["event"] in ("done", "cancelled"):
+        left[:] = [0.0, 0.0]
+        wash["cancelled"] = wash["cancelled"] or\
+            progress["event"] == "cancelled"
+        _finish_wash()
+    if wash["active"]:
+        _estimate_wash()
+    _changed("run", [progress["chamber_id"]])
+
+
+def busy():
+    """Return the chambers in use that are queued, and those under way."""
+    queued = []
+    working = []
+    for chamber_id in in_use():
+        status = chambers[chamber_id].status
+        if status == Status.QUEUED:
+            queued.append(chamber_id)
+        elif status != Status.RUNNING:
+            working.append(chamber_id)
+    return queued, working
+
+
+def apply_valve_event(progress):
+    """Update the chamber information as valves open and close.
+
+    The progress is the dictionary made by valves.progress for a job event.
+    """
+    # Pins opened on their own don't belong to a chamber
+    if progress["chamber_id"] is None:
+        return
+    chamber = chambers[progress["chamber_id"]]
+
+    # Show what the valve is doing now that it has opened
+    if progress["event"] == "opened":
+        chamber.status = progress["status"]
+        chamber.detail = progress.get("detail")
+
+    # Between steps the chamber is waiting for its next valve, or soaking
+    elif progress["event"] == "closed":
+        chamber.status = Status.SOAKING if progress.get("soak") else\
+            Status.WAITING
+        chamber.detail = None
+
+    # Once washed or calibrated, the chamber is back to how it was, less the
+    # wash media taken from the reservoir
+    elif progress["event"] == "done" and\
+            progress.get("kind") in ("wash", "calibration"):
+        chamber.settle()
+        chamber.media_in_chamber =\
+            round(max(chamber.media_in_chamber - progress["volume"], 0), 1)
+
+    # Inform the user that we are running again, decrement the media removed
+    # from the reservoir
+    elif progress["event"] == "done":
+        chamber.status = Status.RUNNING
+        chamber.detail = None
+        chamber.last_changed = clock.now()
+        chamber.media_in_chamber =\
+            round(max(chamber.media_in_chamber - progress["volume"], 0), 1)
+
+    # If the media change or wash was stopped part way, the chamber is back
+    # to how it was
+    elif progress["event"] == "cancelled":
+        chamber.settle()
+
+    if progress.get("kind") == "wash":
+        _apply_wash_event(progress)
+    _changed("chamber", [progress["chamber_id"]])
@@ -0,0 +1,635 @@
+"""Run the bioreactor as a daemon that clients talk to over a Unix socket.
+
+The daemon owns the chambers, the valves, the journal and the automatic media
+changes, so a run keeps its timing no matter what the windows are doing, and
+the windows can be closed and opened again without disturbing it. Clients
+send one JSON object per line, e.g.
+
+    {"id": 1, "op": "change_media", "chambers": [0, 1]}
+
+and get back a line with the same id and either a "result" or an "error".
+Chambers are numbered from 0, and leaving out "chambers" means every chamber
+in use. A client that sends {"op": "subscribe"} gets the full state as the
+result, and is then sent a line every time the run or some chambers change.
+Each of those has "event": "changed" along with the new state of what changed
+in the form made by control.saved_state, with the "ids" of the chambers it
+holds, and without the "run" if only chambers changed.
+
+The ops are "state", "subscribe", "reset", "set_in_use", "start_run",
+"end_run", "add_media", "empty_reservoirs", "change_media", "wash",
+"cancel", "close_all", "calibrate", "fit_calibration", "calibration",
+"history" and "shutdown".
+"""
+import argparse
+import json
+import math
+import os
+import queue
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import vessegen
+from vessegen import actuator
+from vessegen import calibration
+from vessegen import client
+from vessegen import clock
+from vessegen import config
+from vessegen import control
+from vessegen import gpio
+from vessegen import journal
+from vessegen import metrics
+from vessegen import schedule
+from vessegen import telemetry
+from vessegen import valves
+from vessegen import watchdog
+
+# Keep track of the listening socket, the clients connected to it, the valve
+# progress waiting to be applied and the changes waiting to be sent out
+server = {
+    "socket": None,
+    "selector": None,
+    "wake": None,
+    "clients": {},
+    "progress": queue.Queue(),
+    "changes": [],
+    "running": False
+}
+
+
+def run(board=None, pin_map=None, path=None, http=None, profile=False):
+    """Start the valves and journal, and serve clients until told to stop.
+
+    An unfinished run left in the journal is resumed. If http is given as
+    "[HOST:]PORT", the HTTP API in vessegen/api.py is served there too. If
+    profile is True, the hot paths are measured (see vessegen/metrics.py).
+    """
+    if profile:
+        enable_profiling()
+    config.configure(pin_map=pin_map)
+    calibration.load()
+    if board:
+        gpio.use(board)
+    actuator.start()
+    watchdog.start(heartbeat=actuator.heartbeat)
+    control.restore(journal.start())
+    telemetry.start()
+
+    # Stop cleanly, closing the valves, when asked to by the system (which
+    # can only be listened for on the main thread)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop())
+
+    # Serve the HTTP API once the socket is up for it to connect to, only
+    # loading the HTTP server if it is asked for
+    if http:
+        # pylint: disable=import-outside-toplevel
+        from vessegen import api
+        host, _, port = http.rpartition(":")
+        api.start(int(port), host or "127.0.0.1", path)
+    try:
+        serve(path)
+    finally:
+        if http:
+            api.stop()
+        telemetry.stop()
+        metrics.disable()
+
+        # Stop the actuator (closing every valve) before the last of the
+        # journal is written, and make sure the valves are closed after. The
+        # watchdog goes first, so it doesn't take the actuator stopping for
+        # the actuator dying.
+        watchdog.stop()
+        actuator.stop()
+        journal.stop()
+        actuator.close_all()
+
+
+def serve(path=None):
+    """Answer clients and change the media automatically until stopped."""
+    path = path or vessegen.SOCKET_PATH
+    selector = selectors.DefaultSelector()
+    listener = _listen(path)
+    wake, server["wake"] = socket.socketpair()
+    wake.setblocking(False)
+    server["wake"].setblocking(False)
+    metrics.startup("daemon_startup")
+    selector.register(listener, selectors.EVENT_READ, "accept")
+    selector.register(wake, selectors.EVENT_READ, "wake")
+    server["socket"] = listener
+    server["selector"] = selector
+    server["running"] = True
+
+    # Hear about valve progress and changes to the chambers, and plan the
+    # automatic media changes
+    actuator.set_listener(_on_progress)
+    watchdog.set_listener(_on_progress)
+    control.listeners.append(_on_change)
+    schedule.start()
+
+    try:
+        while server["running"]:
+            # Wait for a client, but no longer than the next automatic media
+            # change
+            deadline = schedule.next_deadline()
+            timeout = None if deadline is None else\
+                max(deadline - clock.time(), 0)
+            events = selector.select(timeout)
+            if metrics.profile["enabled"] and deadline is not None and\
+                    clock.time() >= deadline:
+                metrics.observe("daemon_wake_lag", clock.time() - deadline)
+            for key, mask in events:
+                if key.data == "accept":
+                    _accept()
+                elif key.data == "wake":
+                    _drain(wake)
+                else:
+                    _serve_client(key.data, mask)
+
+            # Apply the valve progress reported by the actuator
+            while not server["progress"].empty():
+                progress = server["progress"].get()
+                telemetry.record_progress(progress)
+                calibration.record_progress(progress)
+                control.apply_valve_event(progress)
+
+            # Start any automatic media changes that are due
+            deadline = schedule.next_deadline()
+            if deadline is not None and deadline <= clock.time():
+                for job in control.media_change_jobs(
+                        schedule.take_due(clock.time())):
+                    actuator.submit(job)
+
+            _broadcast()
+    finally:
+        schedule.stop()
+        control.listeners.remove(_on_change)
+        actuator.set_listener(None)
+        for connected in list(server["clients"].values()):
+            # Give each client a moment to take what is waiting for it, such
+            # as the reply to a shutdown
+            try:
+                connected["socket"].settimeout(1)
+                connected["socket"].sendall(connected["outbox"])
+            except OSError:
+                pass
+            _disconnect(connected)
+        selector.close()
+        listener.close()
+        wake.close()
+        server["wake"].close()
+        server["socket"] = None
+        server["selector"] = None
+        server["wake"] = None
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def stop():
+    """Ask the daemon to stop. This is safe to call from any thread."""
+    server["running"] = False
+    _wake()
+
+
+def enable_profiling():
+    """Measure the daemon's hot paths, writing them to the data directory."""
+    metrics.enable(os.path.join(vessegen.DATA_DIR, "metrics-daemon.prom"))
+    metrics.instrument(sys.modules[__name__], "_handle", "_broadcast",
+                       prefix="daemon")
+    metrics.instrument(control, "media_change_jobs", "apply_valve_event")
+    metrics.instrument(gpio, "output", "output_many")
+    metrics.instrument(journal, "flush")
+    metrics.instrument(schedule, "take_due")
+    metrics.instrument(telemetry, "record")
+    metrics.instrument(valves, "poll")
+
+
+def spawn(board=None, pin_map=None, path=None, http=None, env=None,
+          profile=False):
+    """Start a daemon in a process of its own, returning the process.
+
+    env replaces the environment the daemon runs in, e.g. to give it its own
+    VESSEGEN_DATA_DIR.
+    """
+    # A frozen executable runs the daemon itself, otherwise run this module
+    # so the daemon doesn't need the GUI
+    command = [sys.executable, "--daemon"] if getattr(sys, "frozen", False)\
+        else [sys.executable, "-m", "vessegen.daemon"]
+    if profile:
+        command.append("--profile")
+    for option, value in (("--gpio", board), ("--pin-map", pin_map),
+                          ("--socket", path), ("--http", http)):
+        if value:
+            command.extend([option, value])
+    return subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, env=env,
+                            start_new_session=True)
+
+
+def _listen(path):
+    """Listen on the socket, replacing one left behind by a dead daemon."""
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            raise RuntimeError("A daemon is already listening on " + path)
+        finally:
+            probe.close()
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    os.chmod(path, 0o600)
+    listener.listen()
+    listener.setblocking(False)
+    return listener
+
+
+def _accept():
+    """Accept a new client."""
+    connection, _ = server["socket"].accept()
+    connection.setblocking(False)
+    client = {
+        "socket": connection,
+        "fileno": connection.fileno(),
+        "buffer": b"",
+        "outbox": bytearray(),
+        "subscribed": False
+    }
+    server["clients"][client["fileno"]] = client
+    server["selector"].register(connection, selectors.EVENT_READ, client)
+
+
+def _disconnect(client):
+    """Forget a client and close its connection."""
+    if server["clients"].pop(client["fileno"], None) is None:
+        return
+    server["selector"].unregister(client["socket"])
+    client["socket"].close()
+
+
+def _serve_client(client, mask):
+    """Read requests from a client and send it what is waiting."""
+    if mask & selectors.EVENT_READ:
+        try:
+            data = client["socket"].recv(65536)
+        except OSError:
+            data = b""
+        if not data:
+            _disconnect(client)
+            return
+        client["buffer"] += data
+        *lines, client["buffer"] = client["buffer"].split(b"\n")
+        for line in lines:
+            if line.strip():
+                _send(client, _handle(client, line))
+
+    if client["fileno"] not in server["clients"]:
+        return
+    if mask & selectors.EVENT_WRITE and client["outbox"]:
+        try:
+            sent = client["socket"].send(client["outbox"])
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            _disconnect(client)
+            return
+        del client["outbox"][:sent]
+        if not client["outbox"]:
+            server["selector"].modify(client["socket"],
+                                      selectors.EVENT_READ, client)
+
+
+def _send(client, message):
+    """Queue a message to be sent to a client.
+
+    A client that lets too much pile up is disconnected, so it can't hold up
+    the daemon.
+    """
+    if client["fileno"] not in server["clients"]:
+        return
+    if not client["outbox"]:
+        server["selector"].modify(client["socket"], selectors.EVENT_READ |
+                                  selectors.EVENT_WRITE, client)
+    client["outbox"] += json.dumps(message).encode("utf-8") + b"\n"
+    if len(client["outbox"]) > vessegen.SOCKET_BACKLOG_LIMIT:
+        _disconnect(client)
+
+
+def _handle(client, line):
+    """Carry out a request, returning the reply to send."""
+    try:
+        request = json.loads(line)
+    except ValueError:
+        return {"id": None, "error": "Requests must be JSON"}
+    if not isinstance(request, dict):
+        return {"id": None, "error": "Requests must be JSON objects"}
+
+    reply = {"id": request.get("id")}
+    try:
+        op = OPS.get(request.get("op"))
+        if op is None:
+            raise ValueError("Unknown op: " + str(request.get("op")))
+        reply["result"] = op(client, request)
+    except (ValueError, TypeError, KeyError) as error:
+        reply = {"id": request.get("id"), "error": str(error)}
+
+    # Send out what the request changed before the reply, so a subscribed
+    # client sees the changes by the time it has its answer
+    _broadcast()
+    return reply
+
+
+def _chamber_ids(request):
+    """Return the chambers a request is for, checking that they exist."""
+    if "chambers" not in request:
+        return control.in_use()
+    chamber_ids = request["chambers"]
+    for chamber_id in chamber_ids:
+        if not isinstance(chamber_id, int) or\
+                not 0 <= chamber_id < len(control.chambers):
+            raise ValueError("Unknown chamber: " + str(chamber_id))
+    return list(chamber_ids)
+
+
+def _seconds(request, key):
+    """Return a length of time (in seconds) from a request, or None.
+
+    A ValueError is raised unless it is left out, None or a finite number of
+    zero or more.
+    """
+    value = request.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or\
+            not math.isfinite(value) or value < 0:
+        raise ValueError("The " + key + " must be a number of seconds of "
+                         "zero or more")
+    return value
+
+
+def _state(client, request):
+    """Return the run and every chamber."""
+    return control.saved_state()
+
+
+def _subscribe(client, request):
+    """Send the client every change from now on, returning the full state."""
+    client["subscribed"] = True
+    return control.saved_state()
+
+
+def _reset(client, request):
+    """Reset the chambers for a new run."""
+    if control.run["active"]:
+        raise ValueError("A run is in progress")
+    control.reset_chambers()
+
+
+def _set_in_use(client, request):
+    """Set whether some chambers will be used in the run."""
+    control.set_in_use(_chamber_ids(request), bool(request["in_use"]))
+
+
+def _start_run(client, request):
+    """Start a new run, returning its start time."""
+    if control.run["active"]:
+        raise ValueError("A run is in progress")
+
+    # Check the times before anything changes, so a bad one can't leave the
+    # run half started
+    length = _seconds(request, "length")
+    change_interval = _seconds(request, "change_interval")
+    return control.start_run(length, change_interval).isoformat()
+
+
+def _end_run(client, request):
+    """Stop any media changes and end the run."""
+    actuator.close_all()
+    control.end_run()
+
+
+def _add_media(client, request):
+    """Add media to some reservoirs."""
+    volume = float(request["volume"])
+    if not math.isfinite(volume):
+        raise ValueError("The volume must be a number")
+    control.add_media(_chamber_ids(request), volume)
+
+
+def _empty_reservoirs(client, request):
+    """Empty some reservoirs."""
+    control.empty_reservoirs(_chamber_ids(request))
+
+
+def _change_media(client, request):
+    """Start changing the media in some chambers.
+
+    Returns the chambers that were skipped for being low on media, so the
+    client can warn the user about them.
+    """
+    chamber_ids = _chamber_ids(request)
+    for job in control.media_change_jobs(chamber_ids):
+        actuator.submit(job)
+    return {"low_media": control.low_media(chamber_ids)}
+
+
+def _wash(client, request):
+    """Start washing some chambers once a run is over.
+
+    The number of "cycles" and how long to "soak" (in seconds) can be given,
+    and default to the configured ones. The progress is sent out in the
+    run's "wash", and close_all stops the wash.
+    """
+    if control.run["active"]:
+        raise ValueError("A run is in progress")
+    if control.run["wash"] is not None and control.run["wash"]["active"]:
+        raise ValueError("A wash is in progress")
+    for job in control.wash_jobs(_chamber_ids(request), request.get("cycles"),
+                                 request.get("soak")):
+        actuator.submit(job)
+
+
+def _cancel(client, request):
+    """Stop the media changes or wash of some chambers, queued or not."""
+    actuator.cancel(_chamber_ids(request))
+
+
+def _close_all(client, request):
+    """Close every valve, stopping the media changes that are running."""
+    actuator.close_all()
+
+
+def _calibrate(client, request):
+    """Open the "valve" of some chambers for a test pulse.
+
+    The pulse lasts "duration" seconds. Once the media it moved has been
+    measured, fit_calibration fits the valve's model.
+    """
+    if control.run["active"]:
+        raise ValueError("A run is in progress")
+    try:
+        jobs = control.calibration_jobs(_chamber_ids(request),
+                                        request["valve"],
+                                        float(request["duration"]))
+    except KeyError as error:
+        raise ValueError("Missing " + str(error)) from error
+    except TypeError as error:
+        raise ValueError("The duration must be a number") from error
+    for job in jobs:
+        actuator.submit(job)
+
+
+def _fit_calibration(client, request):
+    """Fit a valve's model to the volumes its latest test pulses moved.
+
+    The "chamber", "valve" and measured "volumes" (in mL, one for each of
+    the latest test pulses) are needed. Returns the fitted model, in the
+    form made by calibration.summary.
+    """
+    try:
+        chamber_id = request["chamber"]
+        valve = request["valve"]
+        volumes = request["volumes"]
+    except KeyError as error:
+        raise ValueError("Missing " + str(error)) from error
+    if valve not in calibration.VALVES:
+        raise ValueError("Unknown valve: " + str(valve))
+    return calibration.fit_pulses(_chamber_ids({"chambers": [chamber_id]})[0],
+                                  valve, volumes)
+
+
+def _calibration(client, request):
+    """Return the fitted models and the test pulses waiting to be fitted."""
+    return calibration.summary()
+
+
+def _history(client, request):
+    """Return the history of the chambers between two times.
+
+    The arguments and result are those of telemetry.query, with the "start"
+    and "end" as timestamps, and an optional "chamber", "kind",
+    "resolution", "limit" and "skip". The columns are returned as lists. At
+    most vessegen.HISTORY_PAGE records are returned at once, so a long
+    history doesn't swamp the client, and if there are more, the result
+    holds the arguments for the "next" page.
+    """
+    try:
+        limit = min(int(request.get("limit", vessegen.HISTORY_PAGE)),
+                    vessegen.HISTORY_PAGE)
+        result = telemetry.query(float(request["start"]),
+                                 float(request["end"]),
+                                 request.get("chamber"), request.get("kind"),
+                                 float(request.get("resolution", 0)),
+                                 max(limit, 1), int(request.get("skip", 0)))
+    except KeyError as error:
+        raise ValueError("Missing " + str(error)) from error
+    return {name: column if name in ("resolution", "next") else
+            column.tolist() for name, column in result.items()}
+
+
+def _shutdown(client, request):
+    """Stop the daemon once the reply is sent."""
+    stop()
+
+
+# The requests clients can make, keyed by op
+OPS = {
+    "state": _state,
+    "subscribe": _subscribe,
+    "reset": _reset,
+    "set_in_use": _set_in_use,
+    "start_run": _start_run,
+    "end_run": _end_run,
+    "add_media": _add_media,
+    "empty_reservoirs": _empty_reservoirs,
+    "change_media": _change_media,
+    "wash": _wash,
+    "cancel": _cancel,
+    "close_all": _close_all,
+    "calibrate": _calibrate,
+    "fit_calibration": _fit_calibration,
+    "calibration": _calibration,
+    "history": _history,
+    "shutdown": _shutdown
+}
+
+
+def _on_progress(progress):
+    """Hand valve progress from the actuator thread to the daemon loop."""
+    server["progress"].put(progress)
+    _wake()
+
+
+def _on_change(kind, chamber_ids):
+    """Remember a change to the run or chambers so it can be sent out.
+
+    This is a control listener, so it is called with the kind of change and
+    the IDs of the chambers that changed.
+    """
+    server["changes"].append((kind, chamber_ids))
+
+
+def _broadcast():
+    """Send the changes since last time to the subscribed clients.
+
+    The changes are merged, so each chamber is sent at most once.
+    """
+    changes, server["changes"] = server["changes"], []
+    subscribers = [connected for connected in server["clients"].values()
+                   if connected["subscribed"]]
+    if not changes or not subscribers:
+        return
+
+    chamber_ids = sorted({chamber_id for _, ids in changes
+                          for chamber_id in ids
+                          if chamber_id < len(control.chambers)})
+    message = control.saved_state(chamber_ids)
+    if all(kind != "run" for kind, _ in changes):
+        del message["run"]
+    message["ids"] = chamber_ids
+    message["event"] = "changed"
+    for subscriber in subscribers:
+        _send(subscriber, message)
+
+
+def _wake():
+    """Wake the daemon loop up from another thread."""
+    try:
+        server["wake"].send(b"\0")
+    except (AttributeError, OSError):
+        pass
+
+
+def _drain(wake):
+    """Read everything sent to wake the daemon loop up."""
+    try:
+        while wake.recv(4096):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def main():
+    """Run the daemon from the command line."""
+    parser = argparse.ArgumentParser(
+        prog="vessegen-daemon",
+        description="Run Vessegen's Bioreactor without the windows.")
+    client.add_arguments(parser)
+    parser.add_argument("--stop", action="store_true",
+                        help="stop the daemon that is running")
+    args = parser.parse_args()
+
+    if args.stop:
+        client.Client(args.socket).request("shutdown")
+        return
+    run(args.gpio, args.pin_map, args.socket, args.http, args.profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""Export the history of the chambers to CSV or Parquet files.
+
+The history recorded by vessegen.telemetry is read a record at a time and
+written out as it goes, so even a run of several weeks is exported in a small,
+fixed amount of memory. Raw records become rows of (time, timestamp, chamber,
+kind, value, status), and rollups (when a resolution is asked for, or the raw
+records don't go back far enough) become rows of (time, timestamp, chamber,
+kind, count, total, minimum, maximum, last). Chambers are numbered from 1,
+like they are on the screen.
+
+Writing Parquet files needs pyarrow, which isn't installed by default.
+"""
+import argparse
+import csv
+import datetime
+import itertools
+import math
+import sys
+import vessegen
+from vessegen import telemetry
+
+# The formats that can be written
+FORMATS = ("csv", "parquet")
+
+# The columns of the rows for raw records and for rollups
+RECORD_HEADER = ("time", "timestamp", "chamber", "kind", "value", "status")
+ROLLUP_HEADER = ("time", "timestamp", "chamber", "kind", "count", "total",
+                 "minimum", "maximum", "last")
+
+
+def rows(start=0.0, end=math.inf, chamber_id=None, resolution=0):
+    """Return the header and a generator of rows for the history.
+
+    The history must be open, either because it is being recorded or from
+    telemetry.open_history.
+    """
+    resolution = telemetry.choose_resolution(start, resolution)
+    records = telemetry.scan(start, end, chamber_id, resolution=resolution)
+    if resolution:
+        return ROLLUP_HEADER, (_rollup_row(values) for values in records)
+    return RECORD_HEADER, (_record_row(values) for values in records)
+
+
+def export(path, start=0.0, end=math.inf, chamber_id=None, resolution=0,
+           file_format=None):
+    """Write the history between two times to a file.
+
+    The format is taken from the file's extension if it isn't given. The
+    history is opened from the data directory if it isn't open already.
+    Returns the number of rows written.
+    """
+    file_format = file_format or path.rsplit(".", 1)[-1].lower()
+    if file_format not in FORMATS:
+        raise ValueError("Unknown format: " + file_format + " (choose from " +
+                         ", ".join(FORMATS) + ")")
+
+    opened = telemetry.store["raw"] is None
+    if opened:
+        telemetry.open_history()
+    try:
+        header, table = rows(start, end, chamber_id, resolution)
+        if file_format == "parquet":
+            return write_parquet(path, header, table)
+        return write_csv(path, header, table)
+    finally:
+        if opened:
+            telemetry.close_history()
+
+
+def write_csv(path, header, table):
+    """Write rows to a CSV file, returning the number of rows written."""
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as output:
+        writer = csv.writer(output)
+        writer.writerow(header)
+        for row in table:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_parquet(path, header, table):
+    """Write rows to a Parquet file, returning the number of rows written.
+
+    The rows are written in groups of vessegen.EXPORT_BATCH, so only one
+    group is held in memory at a time.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError("Exporting to Parquet needs pyarrow, which can be "
+                          "installed with: pip install pyarrow") from error
+
+    count = 0
+    writer = None
+    try:
+        while True:
+            batch = list(itertools.islice(table, vessegen.EXPORT_BATCH))
+            if not batch:
+                break
+            columns = {name: [row[index] for row in batch]
+                       for index, name in enumerate(header)}
+            group = pyarrow.table(columns)
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(path, group.schema)
+            writer.write_table(group)
+            count += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+
+def _time(timestamp):
+    """Return a timestamp as a date and time that people can read."""
+    return datetime.datetime.fromtimestamp(timestamp).isoformat(
+        timespec="milliseconds")
+
+
+def _record_row(values):
+    """Turn a raw record into a row."""
+    when, value, chamber_id, kind = values
+    kind = telemetry.KINDS[kind]
+    status = ""
+    if kind == "status":
+        status = telemetry.STATUSES[int(value)] if\
+            int(value) < len(telemetry.STATUSES) else "Other"
+    return (_time(when), when, chamber_id + 1, kind, round(value, 3), status)
+
+
+def _rollup_row(values):
+    """Turn a rollup record into a row."""
+    when, chamber_id, kind, count, total, minimum, maximum, last = values
+    return (_time(when), when, chamber_id + 1, telemetry.KINDS[kind], count,
+            round(total, 3), round(minimum, 3), round(maximum, 3),
+            round(last, 3))
+
+
+def _parse_time(text):
+    """Read a time given on the command line as a date and time."""
+    return datetime.datetime.fromisoformat(text).timestamp()
+
+
+def main():
+    """Export the history from the command line."""
+    parser = argparse.ArgumentParser(
+        prog="vessegen-export",
+        description="Export the history of Vessegen's Bioreactor.")
+    parser.add_argument("output",
+                        help="the file to write, ending in .csv or .parquet")
+    parser.add_argument("--format", choices=FORMATS,
+                        help="the format to write (defaults to the output's "
+                        "extension)")
+    parser.add_argument("--start", type=_parse_time,
+                        help="the date and time to start from, e.g. "
+                        "2024-05-01T09:00 (defaults to the beginning)")
+    parser.add_argument("--end", type=_parse_time,
+                        help="the date and time to end at (defaults to now)")
+    parser.add_argument("--chamber", type=int,
+                        help="only export this chamber (numbered from 1)")
+    parser.add_argument("--resolution", type=float, default=0,
+                        help="export rollups at least this coarse (in "
+                        "seconds) rather than every record")
+    args = parser.parse_args()
+
+    try:
+        count = export(args.output, args.start or 0.0,
+                       math.inf if args.end is None else args.end,
+                       None if args.chamber is None else args.chamber - 1,
+                       args.resolution, args.format)
+    except (ImportError, OSError, ValueError) as error:
+        parser.exit(1, "vessegen-export: " + str(error) + "\n")
+    sys.stderr.write("Exported " + str(count) + " rows to " + args.output +
+                     "\n")
+
+
+if __name__ == "__main__":
+    main()
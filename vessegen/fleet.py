@@ -0,0 +1,337 @@
+"""Watch many bioreactors at once by merging their HTTP APIs into one view.
+
+Each rig is followed with the /changes long-poll of its API (see
+vessegen/api.py), so only what changed is sent over the network no matter how
+many chambers there are. The merged view is served over HTTP in the same way:
+
+    GET /state
+        Every rig, with its "url", whether it is "connected", its "run" and
+        its "chambers", keyed by the rig's name. The version is the ETag.
+
+    GET /changes?since=VERSION&wait=SECONDS
+        The "version" and the "rigs" that changed after the given version,
+        each with the "ids" of the chambers that changed and their
+        "chambers", and the "run" and "connected" if they changed. If the
+        version is too old to tell what changed, the full state is sent. If
+        nothing changed in time, the response is 304 Not Modified.
+
+With --watch, each merged change is also printed as a line of JSON. To try
+it out on one computer, --simulate starts a number of daemons driving
+simulated boards, each with its own data directory and API port.
+"""
+import argparse
+import collections
+import http.server
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import vessegen
+from vessegen import daemon
+
+# Keep track of the rigs being followed, the version of the merged view, and
+# the recent changes (as (version, rig name, change) tuples) for clients that
+# are catching up
+fleet = {
+    "rigs": {},
+    "version": 0,
+    "log": collections.deque(maxlen=vessegen.API_HISTORY),
+    "condition": threading.Condition(),
+    "server": None
+}
+
+
+def follow(name, url):
+    """Start following a rig's API on a thread of its own."""
+    with fleet["condition"]:
+        fleet["rigs"][name] = {
+            "url": url.rstrip("/"),
+            "connected": False,
+            "run": None,
+            "chambers": []
+        }
+    thread = threading.Thread(target=_follow, args=(name,),
+                              name="vessegen-fleet-" + name, daemon=True)
+    thread.start()
+    return thread
+
+
+def changes_since(version):
+    """Return what changed after a version, or None if nothing has.
+
+    This is in the form described for GET /changes.
+    """
+    with fleet["condition"]:
+        if version == fleet["version"]:
+            return None
+        if not fleet["log"] or version < fleet["log"][0][0] - 1 or\
+                version > fleet["version"]:
+            return snapshot()
+
+        # Merge the changes for each rig, sending each chamber as it is now
+        merged = {}
+        for logged, name, change in fleet["log"]:
+            if logged <= version:
+                continue
+            rig = merged.setdefault(name, {"ids": set()})
+            rig["ids"].update(change.get("ids", ()))
+            for key in ("run", "connected"):
+                if key in change:
+                    rig[key] = fleet["rigs"][name][key]
+
+        for name, rig in merged.items():
+            rig["ids"] = sorted(rig["ids"])
+            rig["chambers"] = [fleet["rigs"][name]["chambers"][chamber_id]
+                               for chamber_id in rig["ids"]]
+        return {"version": fleet["version"], "rigs": merged}
+
+
+def snapshot():
+    """Return every rig, in the form described for GET /state."""
+    with fleet["condition"]:
+        return {
+            "version": fleet["version"],
+            "rigs": {name: dict(rig, chambers=list(rig["chambers"]))
+                     for name, rig in fleet["rigs"].items()}
+        }
+
+
+def wait_for_change(version, timeout):
+    """Wait up to timeout seconds for a version newer than the given one."""
+    with fleet["condition"]:
+        fleet["condition"].wait_for(lambda: fleet["version"] != version,
+                                    timeout)
+
+
+def _follow(name):
+    """Keep a rig's copy up to date, reconnecting whenever it goes away."""
+    url = fleet["rigs"][name]["url"]
+    version = 0
+    retry = 1
+    while True:
+        try:
+            with urllib.request.urlopen(
+                    url + "/changes?since=" + str(version) + "&wait=" +
+                    str(vessegen.API_MAX_WAIT),
+                    timeout=vessegen.API_MAX_WAIT + 10) as response:
+                changes = json.load(response)
+        except urllib.error.HTTPError as error:
+            # Nothing changed while we waited
+            if error.code == 304:
+                continue
+            _record(name, {"connected": False})
+        except (OSError, ValueError):
+            _record(name, {"connected": False})
+        else:
+            version = changes.pop("version")
+            changes["connected"] = True
+            _record(name, changes)
+            retry = 1
+            continue
+
+        # Wait a little longer each time the rig can't be reached
+        time.sleep(retry)
+        retry = min(retry * 2, vessegen.API_MAX_WAIT)
+        version = 0
+
+
+def _record(name, change):
+    """Apply a change (in the form sent by /changes) to a rig's copy."""
+    with fleet["condition"]:
+        rig = fleet["rigs"][name]
+        if change.get("connected") == rig["connected"]:
+            change = dict(change)
+            del change["connected"]
+        if not change:
+            return
+
+        # A change without ids holds every chamber
+        if "ids" not in change and "chambers" in change:
+            rig["chambers"] = list(change["chambers"])
+            change = dict(change, ids=list(range(len(rig["chambers"]))))
+        else:
+            for chamber_id, chamber in zip(change.get("ids", ()),
+                                           change.get("chambers", ())):
+                while len(rig["chambers"]) <= chamber_id:
+                    rig["chambers"].append(None)
+                rig["chambers"][chamber_id] = chamber
+        for key in ("run", "connected"):
+            if key in change:
+                rig[key] = change[key]
+
+        fleet["version"] += 1
+        fleet["log"].append((fleet["version"], name, {
+            key: value for key, value in change.items()
+            if key in ("ids", "run", "connected")
+        }))
+        fleet["condition"].notify_all()
+
+
+def watch():
+    """Print every merged change as a line of JSON until interrupted."""
+    version = fleet["version"]
+    while True:
+        wait_for_change(version, None)
+        changes = changes_since(version)
+        if changes is not None:
+            version = changes["version"]
+            sys.stdout.write(json.dumps(changes) + "\n")
+            sys.stdout.flush()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Answer the requests for the merged view."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        """Send the merged state or the changes to it."""
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == "/state":
+            state = snapshot()
+            if self.headers.get("If-None-Match") ==\
+                    '"' + str(state["version"]) + '"':
+                self._send(304, None, state["version"])
+            else:
+                self._send(200, state, state["version"])
+
+        elif url.path == "/changes":
+            try:
+                version = int(query.get("since", ["0"])[0])
+                wait = min(float(query.get("wait", ["0"])[0]),
+                           vessegen.API_MAX_WAIT)
+            except ValueError:
+                self._send(400, {"error": "since and wait must be numbers"})
+                return
+            wait_for_change(version, max(wait, 0))
+            changes = changes_since(version)
+            if changes is None:
+                self._send(304, None, version)
+            else:
+                self._send(200, changes, changes["version"])
+
+        else:
+            self._send(404, {"error": "Not found: " + url.path})
+
+    def log_message(self, format, *args):
+        """Keep quiet rather than logging every request to stderr."""
+
+    def _send(self, status, body, version=None):
+        """Send a response, with a JSON body if there is one."""
+        data = b"" if body is None else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "no-cache")
+        if version is not None:
+            self.send_header("ETag", '"' + str(version) + '"')
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def simulate(count, directory, first_port=8100):
+    """Start daemons driving simulated boards, returning their rigs.
+
+    Each daemon gets its own data directory inside the given one, its own
+    socket and its own API port, and the rigs are returned as (name, url,
+    process) tuples.
+    """
+    rigs = []
+    for number in range(count):
+        name = "sim" + str(number + 1)
+        data_dir = os.path.join(directory, name)
+        os.makedirs(data_dir)
+        port = first_port + number
+        process = daemon.spawn(
+            "simulated", path=os.path.join(data_dir, "vessegen.sock"),
+            http="127.0.0.1:" + str(port),
+            env=dict(os.environ, VESSEGEN_DATA_DIR=data_dir))
+        rigs.append((name, "http://127.0.0.1:" + str(port), process))
+    return rigs
+
+
+def parse_rig(rig, number):
+    """Return the name and URL of a rig given as [NAME=]URL.
+
+    The name comes before the first "=", unless that "=" is part of the URL
+    (e.g. in its query), in which case the rig is named after the URL's host,
+    or by its number if the URL has none.
+    """
+    name, separator, url = rig.partition("=")
+    if not separator or "/" in name:
+        name, url = "", rig
+    return name or urllib.parse.urlsplit(url).netloc or\
+        "rig" + str(number + 1), url
+
+
+def main():
+    """Follow rigs from the command line."""
+    parser = argparse.ArgumentParser(
+        prog="vessegen-fleet",
+        description="Watch many of Vessegen's Bioreactors at once.")
+    parser.add_argument("rigs", nargs="*", metavar="[NAME=]URL",
+                        help="the HTTP API of each rig to follow")
+    parser.add_argument("--http", metavar="[HOST:]PORT",
+                        help="serve the merged view, on localhost unless a "
+                        "host is given")
+    parser.add_argument("--watch", action="store_true",
+                        help="print every change as a line of JSON")
+    parser.add_argument("--simulate", type=int, default=0, metavar="COUNT",
+                        help="start this many simulated rigs to follow")
+    args = parser.parse_args()
+
+    if not args.rigs and args.simulate <= 0:
+        parser.error("give at least one rig to follow")
+    if not args.http and not args.watch:
+        parser.error("give --http or --watch to see the rigs")
+
+    # The simulated rigs keep their data in a directory of their own, which
+    # is removed along with them
+    processes = []
+    directory = tempfile.mkdtemp(prefix="vessegen-fleet-") if\
+        args.simulate > 0 else None
+
+    # Stop the simulated rigs too when asked to stop by the system
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        if directory is not None:
+            for name, url, process in simulate(args.simulate, directory):
+                args.rigs.append(name + "=" + url)
+                processes.append(process)
+
+        for number, rig in enumerate(args.rigs):
+            follow(*parse_rig(rig, number))
+
+        if args.http:
+            host, _, port = args.http.rpartition(":")
+            fleet["server"] = http.server.ThreadingHTTPServer(
+                (host or "127.0.0.1", int(port)), Handler)
+            fleet["server"].daemon_threads = True
+            if args.watch:
+                threading.Thread(target=watch, name="vessegen-fleet-watch",
+                                 daemon=True).start()
+            fleet["server"].serve_forever()
+        else:
+            watch()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Estimate how long the solenoids need to be open to move media."""
+import functools
+import math
+import vessegen
+from vessegen import calibration
+
+# The smallest volume the drain model moves in a single second (in mL)
+MIN_FLOW = 0.0001
+
+
+def calculate_media_change_time(media_in_res, add=False, chamber_id=None):
+    """Calculate the estimated time to complete a media change.
+
+    This function defaults to removing media (add is False). To calculate time
+    for adding media, simply set add to True. It returns the time in seconds
+    along with the volume we estimate will be moved. If the chamber's valve
+    has been calibrated, the time is looked up in its calibration instead of
+    being estimated by the drain model.
+    """
+    if chamber_id is not None:
+        volume = min(vessegen.MEDIA_VOL, media_in_res)
+        duration = calibration.duration_for(chamber_id,
+                                            "add" if add else "remove",
+                                            volume)
+        if duration is not None:
+            return duration, volume
+
+    # The diameters of the tubes change depending on if it is the adding or
+    # removing solenoid.
+    diameter = 1.0 if add else 0.5
+    return solve_drain(vessegen.MEDIA_VOL, media_in_res, diameter)
+
+
+@functools.lru_cache(maxsize=256)
+def solve_drain(target, media_in_res, diameter):
+    """Solve the drain model for the time it takes to move the target volume.
+
+    The model drains the bulk in one second steps. Each step moves
+    bulk * (diameter / 2)^2 of media, but never less than MIN_FLOW, so the
+    bulk shrinks geometrically until the steps bottom out at MIN_FLOW. Rather
+    than stepping through every second, this solves the geometric part and the
+    constant part in closed form. The result is memoized, since the same
+    volumes and tubes come up over and over during a run.
+    """
+    # If there is nothing to move, it takes no time at all
+    if target <= 0:
+        return 0, 0
+
+    # The fraction of the bulk that drains every second
+    rate = (diameter / 2) * (diameter / 2)
+
+    # Count the steps that move more than the minimum flow. After that, every
+    # step moves exactly the minimum flow.
+    if media_in_res * rate < MIN_FLOW:
+        geometric_steps = 0
+    elif rate >= 1:
+        geometric_steps = 1
+    else:
+        geometric_steps = math.floor(math.log(MIN_FLOW /
+                                              (media_in_res * rate)) /
+                                     math.log(1 - rate)) + 1
+
+    # The volume moved once the geometric steps are done
+    geometric_volume = media_in_res * (1 - (1 - rate) ** geometric_steps)
+
+    # If the target is reached during the geometric steps, find the first step
+    # that reaches it
+    if geometric_volume >= target:
+        if rate >= 1:
+            steps = 1
+        else:
+            steps = max(math.ceil(math.log(1 - target / media_in_res) /
+                                  math.log(1 - rate)), 1)
+        return steps, media_in_res * (1 - (1 - rate) ** steps)
+
+    # Otherwise, make up the rest of the volume at the minimum flow
+    extra_steps = math.ceil((target - geometric_volume) / MIN_FLOW)
+    return (geometric_steps + extra_steps,
+            geometric_volume + extra_steps * MIN_FLOW)
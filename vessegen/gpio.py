@@ -0,0 +1,171 @@
+"""Talk to the GPIO pins through either a real or a simulated board.
+
+The board is chosen once at startup with use(). If nothing is chosen, the
+VESSEGEN_GPIO environment variable is checked, falling back to the real
+Raspberry Pi board. Pins are only set up the first time they are written to,
+so importing vessegen never touches the hardware.
+
+Groups of pins should be written with output_many, which switches them all in
+one call to the board rather than one pin at a time.
+"""
+import os
+import threading
+from vessegen import clock
+
+# The values a pin can be set to
+LOW = 0
+HIGH = 1
+
+
+class RPiBoard:
+    """The GPIO pins of a real Raspberry Pi, driven through RPi.GPIO."""
+
+    name = "rpi"
+
+    def __init__(self):
+        """Import RPi.GPIO and set the pin numbering to the board layout."""
+        # Only import RPi.GPIO once we know we are running on a Raspberry Pi
+        # pylint: disable=import-outside-toplevel,import-error
+        import RPi.GPIO as GPIO  # pylint: disable=consider-using-from-import
+        self.gpio = GPIO
+
+        # Disable GPIO warnings (very common to do)
+        self.gpio.setwarnings(False)  # pylint: disable=no-member
+        self.gpio.setmode(self.gpio.BOARD)  # pylint: disable=no-member
+
+    def setup(self, pin):
+        """Set the pin up as an output that starts LOW."""
+        # pylint: disable=no-member
+        self.gpio.setup(pin, self.gpio.OUT, initial=self.gpio.LOW)
+
+    def output(self, pin, value):
+        """Set the pin HIGH or LOW."""
+        # pylint: disable=no-member
+        self.gpio.output(pin, self.gpio.HIGH if value else self.gpio.LOW)
+
+    def setup_many(self, pins):
+        """Set the pins up as outputs that start LOW, in one call."""
+        # pylint: disable=no-member
+        self.gpio.setup(list(pins), self.gpio.OUT, initial=self.gpio.LOW)
+
+    def output_many(self, pins, values):
+        """Set each pin HIGH or LOW, in one call."""
+        # pylint: disable=no-member
+        self.gpio.output(list(pins), [self.gpio.HIGH if value else
+                                      self.gpio.LOW for value in values])
+
+
+class SimulatedBoard:
+    """An in-memory board that records every pin transition.
+
+    The transitions are kept as (timestamp, pin, value) tuples so that a run
+    can be checked or replayed without any hardware.
+    """
+
+    name = "simulated"
+
+    def __init__(self):
+        """Start with every pin LOW and no transitions."""
+        self.lock = threading.Lock()
+        self.state = {}
+        self.transitions = []
+
+    def setup(self, pin):
+        """Set the pin up as an output that starts LOW."""
+        with self.lock:
+            self.state[pin] = LOW
+
+    def output(self, pin, value):
+        """Set the pin HIGH or LOW, recording the transition if it changed."""
+        self.output_many((pin,), (value,))
+
+    def setup_many(self, pins):
+        """Set the pins up as outputs that start LOW."""
+        with self.lock:
+            for pin in pins:
+                self.state[pin] = LOW
+
+    def output_many(self, pins, values):
+        """Set each pin HIGH or LOW at the same moment."""
+        with self.lock:
+            now = clock.time()
+            for pin, value in zip(pins, values):
+                value = HIGH if value else LOW
+                if self.state.get(pin) != value:
+                    self.transitions.append((now, pin, value))
+                self.state[pin] = value
+
+
+# The backends that can be chosen, keyed by name
+BACKENDS = {
+    RPiBoard.name: RPiBoard,
+    SimulatedBoard.name: SimulatedBoard
+}
+
+# Keep track of the board in use and which of its pins have been set up
+board = {
+    "backend": None,
+    "configured": set(),
+    "lock": threading.Lock()
+}
+
+
+def use(name):
+    """Choose the board to drive, returning it.
+
+    This should be done once at startup, before any pins are written to.
+    """
+    if name not in BACKENDS:
+        raise ValueError("Unknown GPIO backend: " + name + " (choose from " +
+                         ", ".join(BACKENDS) + ")")
+    with board["lock"]:
+        board["backend"] = BACKENDS[name]()
+        board["configured"] = set()
+    return board["backend"]
+
+
+def get_board():
+    """Return the board in use, choosing the default one if needed."""
+    if board["backend"] is None:
+        use(os.environ.get("VESSEGEN_GPIO", RPiBoard.name))
+    return board["backend"]
+
+
+def setup(pins):
+    """Set up any of the pins that haven't been, all in one call.
+
+    Pins are set up when they are first written to anyway, but setting them
+    all up at startup keeps that out of the way of the first valve to open.
+    """
+    backend = get_board()
+    with board["lock"]:
+        pins = [pin for pin in dict.fromkeys(pins)
+                if pin not in board["configured"]]
+        if pins:
+            backend.setup_many(pins)
+            board["configured"].update(pins)
+    return backend
+
+
+def output(pin, value):
+    """Set a pin HIGH or LOW, setting the pin up first if needed."""
+    backend = get_board()
+    if pin not in board["configured"]:
+        setup((pin,))
+    backend.output(pin, value)
+
+
+def output_many(pins, value):
+    """Set several pins HIGH or LOW in one call, setting them up if needed.
+
+    The value is either one value for every pin, or a list with a value for
+    each pin.
+    """
+    pins = list(pins)
+    if not pins:
+        return
+    values = [value] * len(pins) if value in (LOW, HIGH) else list(value)
+    backend = get_board()
+    if not board["configured"].issuperset(pins):
+        setup(pins)
+    backend.output_many(pins, values)
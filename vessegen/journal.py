@@ -0,0 +1,171 @@
+"""Keep a crash-safe journal of the run so it can be resumed.
+
+Every change to the run or the chambers is appended to a journal file as a
+line of JSON holding the full state of what changed, so replaying the journal
+twice gives the same result. Changes are grouped and written every
+vessegen.JOURNAL_FLUSH_INTERVAL seconds, and once the journal holds
+vessegen.JOURNAL_COMPACT_EVERY changes it is compacted into a snapshot.
+"""
+import json
+import os
+import threading
+import vessegen
+from vessegen import control
+
+# Keep track of the journal files, the changes waiting to be written, and the
+# latest state of the run as the journal sees it
+journal = {
+    "directory": None,
+    "file": None,
+    "buffer": [],
+    "entries": 0,
+    "state": None,
+    "lock": threading.Lock(),
+    "wake": threading.Event(),
+    "thread": None
+}
+
+
+def start(directory=None):
+    """Open the journal and start recording changes.
+
+    Returns the state saved by the last session (in the form made by
+    control.saved_state), or None if there isn't one.
+    """
+    directory = directory or vessegen.DATA_DIR
+    os.makedirs(directory, exist_ok=True)
+    journal["directory"] = directory
+
+    # Load the state left behind by the last session
+    state = load(directory)
+    journal["state"] = state or control.saved_state()
+
+    # Compact what was loaded so the journal starts out empty
+    _write_snapshot()
+    journal["file"] = open(_path("journal.jsonl"), "w", encoding="utf-8")
+    journal["entries"] = 0
+
+    # Record changes as they happen and write them in the background
+    control.listeners.append(record)
+    journal["wake"].clear()
+    journal["thread"] = threading.Thread(target=_work, name="vessegen-journal",
+                                         daemon=True)
+    journal["thread"].start()
+    return state
+
+
+def stop():
+    """Write any waiting changes and stop recording."""
+    if journal["thread"] is None:
+        return
+    if record in control.listeners:
+        control.listeners.remove(record)
+    journal["wake"].set()
+    journal["thread"].join()
+    journal["thread"] = None
+    flush()
+    journal["file"].close()
+    journal["file"] = None
+
+
+def load(directory=None):
+    """Load the state saved in a journal directory, or None if there is none.
+
+    The snapshot is loaded first, and then the changes in the journal are
+    applied on top of it. A half-written line at the end of the journal (from
+    a crash or power cut) is ignored.
+    """
+    directory = directory or vessegen.DATA_DIR
+    state = None
+
+    try:
+        with open(os.path.join(directory, "snapshot.json"),
+                  encoding="utf-8") as snapshot:
+            state = json.load(snapshot)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open(os.path.join(directory, "journal.jsonl"),
+                  encoding="utf-8") as lines:
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                state = _apply(state, entry)
+    except OSError:
+        pass
+
+    return state
+
+
+def record(kind, chamber_ids):
+    """Record a change to the run or some chambers.
+
+    This is a control listener, so it is called with the kind of change and
+    the IDs of the chambers that changed.
+    """
+    entry = control.saved_state(chamber_ids)
+    if kind != "run":
+        del entry["run"]
+    entry["ids"] = list(chamber_ids)
+
+    with journal["lock"]:
+        journal["state"] = _apply(journal["state"], entry)
+        journal["buffer"].append(json.dumps(entry) + "\n")
+
+
+def flush():
+    """Write the waiting changes to disk, compacting the journal if needed."""
+    with journal["lock"]:
+        if not journal["buffer"] or journal["file"] is None:
+            return
+        journal["file"].write("".join(journal["buffer"]))
+        journal["file"].flush()
+        os.fsync(journal["file"].fileno())
+        journal["entries"] += len(journal["buffer"])
+        journal["buffer"] = []
+
+        # Once the journal gets long, fold it into the snapshot
+        if journal["entries"] >= vessegen.JOURNAL_COMPACT_EVERY:
+            _write_snapshot()
+            journal["file"].seek(0)
+            journal["file"].truncate()
+            journal["entries"] = 0
+
+
+def _apply(state, entry):
+    """Apply a journal entry to a state, returning the new state."""
+    if state is None:
+        state = control.saved_state()
+    if "run" in entry:
+        state["run"] = entry["run"]
+    for chamber_id, chamber in zip(entry.get("ids", []), entry["chambers"]):
+        # The number of chambers may have been changed in the configuration
+        while len(state["chambers"]) <= chamber_id:
+            state["chambers"].append(control.Chamber(
+                len(state["chambers"]) + 1).saved())
+        state["chambers"][chamber_id] = chamber
+    return state
+
+
+def _path(name):
+    """Return the path of a file in the journal directory."""
+    return os.path.join(journal["directory"], name)
+
+
+def _write_snapshot():
+    """Write the state to the snapshot file without ever leaving it broken."""
+    temporary = _path("snapshot.json.tmp")
+    with open(temporary, "w", encoding="utf-8") as snapshot:
+        json.dump(journal["state"], snapshot)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temporary, _path("snapshot.json"))
+
+
+def _work():
+    """Write the waiting changes every so often until told to stop."""
+    while not journal["wake"].wait(vessegen.JOURNAL_FLUSH_INTERVAL):
+        flush()
@@ -0,0 +1,170 @@
+"""Measure how long things take, to find out what slows the software down.
+
+Nothing is measured unless profiling is enabled (with --profile), so this
+costs next to nothing otherwise. Once enabled, functions on the hot paths are
+wrapped to time every call, and the loops record how late they wake up for
+their deadlines. Each measurement goes into a histogram, and the histograms
+are written every vessegen.METRICS_INTERVAL seconds to a text file in the
+Prometheus format, e.g.
+
+    vessegen_seconds_bucket{name="update_monitor",le="0.0016"} 118
+
+and are also served by the HTTP API at /metrics.
+"""
+import bisect
+import functools
+import os
+import threading
+import time
+import vessegen
+
+# The upper bounds of the histogram buckets (in seconds), doubling from a
+# tenth of a millisecond to about 26 seconds
+BUCKETS = tuple(0.0001 * 2 ** n for n in range(19))
+
+# When this module was imported, for measuring startup where /proc can't be
+# read
+IMPORTED = time.perf_counter()
+
+# Keep track of whether profiling is enabled, the histograms by name, and the
+# file they are written to
+profile = {
+    "enabled": False,
+    "histograms": {},
+    "lock": threading.Lock(),
+    "path": None,
+    "wake": threading.Event(),
+    "thread": None
+}
+
+
+def enable(path=None):
+    """Start profiling, writing the histograms to a file if one is given."""
+    profile["enabled"] = True
+    profile["path"] = path
+    if path is not None and profile["thread"] is None:
+        profile["wake"].clear()
+        profile["thread"] = threading.Thread(target=_work,
+                                             name="vessegen-metrics",
+                                             daemon=True)
+        profile["thread"].start()
+
+
+def disable():
+    """Stop profiling, writing the histograms one last time."""
+    profile["enabled"] = False
+    if profile["thread"] is not None:
+        profile["wake"].set()
+        profile["thread"].join()
+        profile["thread"] = None
+        write()
+
+
+def observe(name, seconds):
+    """Add a measurement (in seconds) to a histogram."""
+    if not profile["enabled"]:
+        return
+    with profile["lock"]:
+        histogram = profile["histograms"].get(name)
+        if histogram is None:
+            histogram = profile["histograms"][name] = {
+                "buckets": [0] * (len(BUCKETS) + 1),
+                "count": 0,
+                "sum": 0.0,
+                "max": 0.0
+            }
+        histogram["buckets"][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+        histogram["max"] = max(histogram["max"], seconds)
+
+
+def timed(name, function):
+    """Return a version of a function that measures every call."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            observe(name, time.perf_counter() - start)
+    return wrapper
+
+
+def instrument(owner, *names, prefix=None):
+    """Measure every call to some functions of a module or class.
+
+    The functions are replaced where they are looked up, so this should be
+    called before they are used. Each is measured under its own name, after
+    the prefix (which defaults to the name of the module or class).
+    """
+    prefix = prefix or owner.__name__.rsplit(".", 1)[-1]
+    for name in names:
+        setattr(owner, name, timed(prefix + "." + name,
+                                   getattr(owner, name)))
+
+
+def process_age():
+    """Return how long ago (in seconds) the process started.
+
+    On Linux this is read from /proc, so it includes starting Python and
+    importing everything. Elsewhere it is only the time since this module
+    was imported.
+    """
+    try:
+        with open("/proc/self/stat", encoding="ascii") as stat:
+            # The start time is the 22nd field, counting the fields after
+            # the program's name (which can hold spaces) from the 3rd
+            started = int(stat.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", encoding="ascii") as uptime:
+            return float(uptime.read().split()[0]) -\
+                started / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.perf_counter() - IMPORTED
+
+
+def startup(name):
+    """Measure how long the process took to get here, the first time only."""
+    if profile["enabled"] and name not in profile["histograms"]:
+        observe(name, process_age())
+
+
+def render():
+    """Return the histograms in the Prometheus text format."""
+    lines = ["# TYPE vessegen_seconds histogram"]
+    with profile["lock"]:
+        histograms = sorted(profile["histograms"].items())
+        for name, histogram in histograms:
+            total = 0
+            for bound, count in zip(BUCKETS + ("+Inf",),
+                                    histogram["buckets"]):
+                total += count
+                le = bound if isinstance(bound, str) else format(bound, "g")
+                lines.append('vessegen_seconds_bucket{name="' + name +
+                             '",le="' + le + '"} ' + str(total))
+            lines.append('vessegen_seconds_sum{name="' + name + '"} ' +
+                         repr(histogram["sum"]))
+            lines.append('vessegen_seconds_count{name="' + name + '"} ' +
+                         str(histogram["count"]))
+        lines.append("# TYPE vessegen_seconds_max gauge")
+        for name, histogram in histograms:
+            lines.append('vessegen_seconds_max{name="' + name + '"} ' +
+                         repr(histogram["max"]))
+    return "\n".join(lines) + "\n"
+
+
+def write(path=None):
+    """Write the histograms to a file without ever leaving it half written."""
+    path = path or profile["path"]
+    if path is None:
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as metrics:
+        metrics.write(render())
+    os.replace(path + ".tmp", path)
+
+
+def _work():
+    """Write the histograms every so often until told to stop."""
+    while not profile["wake"].wait(vessegen.METRICS_INTERVAL):
+        write()
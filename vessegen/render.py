@@ -0,0 +1,78 @@
+"""Only push text to the GUI when it has actually changed."""
+import datetime
+
+# Keep track of the text last shown in each element, keyed by element key
+rendered = {}
+
+# Keep track of humanized durations so they are only recomputed once the shown
+# value could have changed. Each entry is keyed by a name chosen by the caller
+# and holds the start time, the text and when the text expires.
+humanized = {}
+
+
+def reset():
+    """Forget everything that was rendered, e.g. when a new window is built."""
+    rendered.clear()
+    humanized.clear()
+
+
+def set_text(window, key, text):
+    """Update the text of an element only if it differs from what is shown.
+
+    Returns True if the element was updated.
+    """
+    if rendered.get(key) == text:
+        return False
+    window[key].update(text)
+    rendered[key] = text
+    return True
+
+
+def set_disabled(window, key, disabled):
+    """Enable or disable an element only if that differs from what is shown.
+
+    Returns True if the element was updated.
+    """
+    if rendered.get((key, "disabled")) == disabled:
+        return False
+    window[key].update(disabled=disabled)
+    rendered[(key, "disabled")] = disabled
+    return True
+
+
+def natural_delta(name, since, now, ago=False):
+    """Return the humanized time between since and now.
+
+    This gives the same text as humanize.naturaldelta (or humanize.naturaltime
+    if ago is True), but the text is cached under the given name until the
+    duration rolls over to the next second, minute, hour or day, depending on
+    which of them is being shown. humanize is only loaded the first time
+    this has something to humanize, to keep it out of the way of starting up.
+    """
+    cached = humanized.get(name)
+    if cached is not None and cached[0] == since and cached[1] == ago and\
+            now < cached[3]:
+        return cached[2]
+
+    # Humanize the duration
+    # pylint: disable=import-outside-toplevel
+    import humanize
+    delta = now - since
+    text = humanize.naturaltime(delta) if ago else\
+        humanize.naturaldelta(delta)
+
+    # Work out the smallest unit shown for this duration. The text can't
+    # change until the duration reaches the next multiple of that unit.
+    seconds = delta.total_seconds()
+    if seconds < 60:
+        unit = 1
+    elif seconds < 60 * 60:
+        unit = 60
+    elif seconds < 24 * 60 * 60:
+        unit = 60 * 60
+    else:
+        unit = 24 * 60 * 60
+    expires = since + datetime.timedelta(seconds=(seconds // unit + 1) * unit)
+
+    humanized[name] = (since, ago, text, expires)
+    return text
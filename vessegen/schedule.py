@@ -0,0 +1,122 @@
+"""Change the media automatically at a regular interval.
+
+Each chamber in use is due for a media change the run's change interval after
+its media was last changed. The deadlines are kept in a heap, so finding the
+next chamber due takes no time no matter how many chambers there are. When a
+chamber comes due, every other chamber due within vessegen.AUTO_CHANGE_WINDOW
+is taken with it so that they are changed in a single cycle.
+"""
+import heapq
+import vessegen
+from vessegen import control
+
+# A heap of (when, chamber_id) tuples for the upcoming media changes, along
+# with the deadline each chamber is actually due at. Entries in the heap that
+# no longer match the chamber's deadline are skipped when they come up.
+plan = {
+    "heap": [],
+    "due": {},
+    "last_changed": {}
+}
+
+
+def start():
+    """Plan the media changes for the run and keep the plan up to date."""
+    if _on_change not in control.listeners:
+        control.listeners.append(_on_change)
+    _rebuild()
+
+
+def stop():
+    """Stop changing the media automatically."""
+    if _on_change in control.listeners:
+        control.listeners.remove(_on_change)
+    plan["heap"] = []
+    plan["due"] = {}
+    plan["last_changed"] = {}
+
+
+def next_deadline():
+    """Return the time the next chamber is due, or None if none are."""
+    # Throw away any deadlines that have been replaced
+    heap = plan["heap"]
+    while heap and plan["due"].get(heap[0][1]) != heap[0][0]:
+        heapq.heappop(heap)
+    return heap[0][0] if heap else None
+
+
+def take_due(now):
+    """Return the IDs of the chambers whose media should be changed now.
+
+    Chambers due within vessegen.AUTO_CHANGE_WINDOW of now are included, so
+    they can share the cycle. The chambers taken are planned again one change
+    interval from now, in case their media change can't run (e.g. they are
+    low on media). Once their media is changed, they are planned from then.
+    """
+    chamber_ids = []
+    while True:
+        deadline = next_deadline()
+        if deadline is None or deadline > now + vessegen.AUTO_CHANGE_WINDOW:
+            break
+        _, chamber_id = heapq.heappop(plan["heap"])
+        del plan["due"][chamber_id]
+        chamber_ids.append(chamber_id)
+
+    for chamber_id in chamber_ids:
+        _plan(chamber_id, now + control.run["change_interval"])
+    return sorted(chamber_ids)
+
+
+def _plan(chamber_id, when):
+    """Plan a chamber's next media change, unless it is after the run ends."""
+    if control.run["length"] is not None:
+        end = control.run["start_time"].timestamp() + control.run["length"]
+        if when > end:
+            plan["due"].pop(chamber_id, None)
+            return
+    plan["due"][chamber_id] = when
+    heapq.heappush(plan["heap"], (when, chamber_id))
+
+
+def _rebuild():
+    """Plan every chamber in use from when its media was last changed."""
+    plan["heap"] = []
+    plan["due"] = {}
+    plan["last_changed"] = {}
+    if not control.run["active"] or not control.run["change_interval"]:
+        return
+    for chamber_id in control.in_use():
+        _replan(chamber_id)
+
+
+def _replan(chamber_id):
+    """Plan a chamber from when its media was last changed."""
+    last_changed = control.chambers[chamber_id].last_changed
+    plan["last_changed"][chamber_id] = last_changed
+    if last_changed is not None:
+        _plan(chamber_id, last_changed.timestamp() +
+              control.run["change_interval"])
+
+
+def _on_change(kind, chamber_ids):
+    """Keep the plan up to date as the run and chambers change.
+
+    This is a control listener, so it is called with the kind of change and
+    the IDs of the chambers that changed.
+    """
+    if kind == "run":
+        _rebuild()
+        return
+    if not control.run["active"] or not control.run["change_interval"]:
+        return
+
+    # Only chambers whose media was just changed (or that were just put in or
+    # out of use) need to be planned again
+    for chamber_id in chamber_ids:
+        chamber = control.chambers[chamber_id]
+        if not chamber.is_in_use:
+            plan["due"].pop(chamber_id, None)
+            plan["last_changed"].pop(chamber_id, None)
+        elif plan["last_changed"].get(chamber_id, False) !=\
+                chamber.last_changed:
+            _replan(chamber_id)
@@ -0,0 +1,175 @@
+"""Replay a scripted experiment against a simulated board and virtual clock.
+
+A script is a JSON file that picks the chambers to use and lists the actions
+to take, each at a number of seconds after the run starts, e.g.
+
+    {
+        "chambers": [1, 2, 3],
+        "actions": [
+            {"at": 0, "action": "add_media", "chambers": [1, 2, 3],
+             "volume": 100},
+            {"at": 86400, "action": "change_media"},
+            {"at": 172800, "action": "empty_reservoirs", "chambers": [2]},
+            {"at": 604800, "action": "end"}
+        ]
+    }
+
+The actions are "add_media", "empty_reservoirs", "change_media" and "end".
+Leaving out "chambers" applies the action to every chamber in use. Chambers
+are numbered from 1, like they are on the screen. The script can also set a
+"change_interval" (and optionally a "length" for the run) in seconds to have
+the media changed automatically, and a "pins" list (like the pin maps in
+vessegen.PIN_MAPS) to simulate a rig with a different number of chambers.
+Without a "length" or an "end" action, the replay stops once the valves are
+done after the last action, since the media would otherwise be changed
+forever.
+Time only moves forward when there is something to do, so a week-long run
+replays in well under a second.
+"""
+import argparse
+import json
+import sys
+from vessegen import clock
+from vessegen import config
+from vessegen import control
+from vessegen import gpio
+from vessegen import schedule
+from vessegen import status
+from vessegen import valves
+
+
+def run_script(script, start=0.0):
+    """Run a script, returning the pin timeline, events and chamber states.
+
+    The times in the result are seconds since the start of the run.
+    """
+    # Drive a fresh simulated board with a virtual clock
+    virtual = clock.use(clock.VirtualClock(start))
+    board = gpio.use("simulated")
+    engine = valves.new_engine()
+    events = []
+
+    # Pick the pins and chambers to use and start the run
+    if "pins" in script:
+        config.use_pins(script["pins"])
+    control.reset_chambers()
+    control.set_in_use([number - 1 for number in script.get("chambers", [])],
+                       True)
+    control.start_run(script.get("length"), script.get("change_interval"))
+    schedule.start()
+
+    def change_media(chamber_ids):
+        """Start changing the media in the chambers, noting any skipped."""
+        for chamber_id in control.low_media(chamber_ids):
+            events.append({"time": virtual.time() - start,
+                           "chamber": chamber_id + 1,
+                           "event": "low_media"})
+        for job in control.media_change_jobs(chamber_ids):
+            valves.submit(engine, job)
+
+    def run_valves(until=None):
+        """Run the valves and automatic media changes until the given time.
+
+        If until is None, this runs until every valve job is done and no more
+        automatic media changes are planned. Without a length, the run never
+        ends on its own, so the automatic media changes are then left out and
+        this stops once the valves are done.
+        """
+        while True:
+            planned = schedule.next_deadline()
+            if until is None and control.run["length"] is None:
+                planned = None
+
+            # The valves are timed with the monotonic clock, so work out when
+            # their next deadline is on the wall clock to compare them
+            valve_deadline = valves.next_deadline(engine)
+            deadlines = [deadline for deadline in
+                         (None if valve_deadline is None else
+                          virtual.time() +
+                          (valve_deadline - virtual.monotonic_ns()) / 1e9,
+                          planned)
+                         if deadline is not None]
+            if not deadlines or (until is not None and
+                                 min(deadlines) > until):
+                break
+            if planned == min(deadlines):
+                virtual.advance_to(planned)
+            else:
+                virtual.advance_to_ns(valve_deadline)
+
+            # Start any automatic media changes that are due
+            if planned is not None and planned <= virtual.time():
+                change_media(schedule.take_due(virtual.time()))
+
+            for job, event in valves.poll(engine, virtual.monotonic_ns()):
+                progress = valves.progress(job, event)
+                control.apply_valve_event(progress)
+                events.append(_event(virtual.time() - start, progress))
+        if until is not None:
+            virtual.advance_to(until)
+
+    for action in sorted(script.get("actions", []), key=lambda a: a["at"]):
+        run_valves(start + action["at"])
+
+        # Work out which chambers the action is for
+        chamber_ids = control.in_use() if "chambers" not in action else\
+            [number - 1 for number in action["chambers"]]
+
+        if action["action"] == "end":
+            break
+        if action["action"] == "add_media":
+            control.add_media(chamber_ids, action["volume"])
+        elif action["action"] == "empty_reservoirs":
+            control.empty_reservoirs(chamber_ids)
+        elif action["action"] == "change_media":
+            change_media(chamber_ids)
+        else:
+            raise ValueError("Unknown action: " + str(action["action"]))
+    else:
+        # If the script didn't end the run, let the valves finish
+        run_valves()
+    schedule.stop()
+
+    return {
+        "duration": virtual.time() - start,
+        "pins": [{"time": when - start, "pin": pin, "value": value}
+                 for when, pin, value in board.transitions],
+        "events": events,
+        "chambers": control.saved_state()["chambers"]
+    }
+
+
+def _event(elapsed, progress):
+    """Turn valve progress into an event for the result."""
+    return {
+        "time": elapsed,
+        "chamber": None if progress["chamber_id"] is None else
+        progress["chamber_id"] + 1,
+        "event": progress["event"],
+        "status": status.describe(progress["status"], progress.get("detail"))
+    }
+
+
+def main():
+    """Run a script from the command line and print the result as JSON."""
+    parser = argparse.ArgumentParser(
+        prog="vessegen-simulate",
+        description="Replay a scripted experiment against a simulated board.")
+    parser.add_argument("script", help="the JSON script to run")
+    parser.add_argument("-o", "--output",
+                        help="write the result here instead of stdout")
+    args = parser.parse_args()
+
+    with open(args.script, encoding="utf-8") as script_file:
+        result = run_script(json.load(script_file))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(result, output_file, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
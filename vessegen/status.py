@@ -0,0 +1,44 @@
+"""The statuses a chamber can have."""
+import enum
+
+
+class Status(str, enum.Enum):
+    """The statuses a chamber can have, named so they can't be mistyped.
+
+    Each status is also the text shown for it, and compares equal to that
+    text, so statuses read back from JSON work the same way. The history
+    stores statuses by their position here (see vessegen/telemetry.py), so
+    new ones go at the end. Anything more to say about a status, e.g. which
+    cycle of a wash a chamber is draining for, is kept beside it as its
+    detail (see describe).
+    """
+
+    UNUSED = "Unused"
+    RUNNING = "Running"
+    WAITING = "Waiting for valve..."
+    REMOVING = "Removing media..."
+    ADDING = "Adding media..."
+    SOAKING = "Soaking..."
+    QUEUED = "Queued..."
+    DRAINING = "Draining..."
+    FILLING = "Filling with wash media..."
+    DRAINING_WASH = "Draining the wash media..."
+    CALIBRATING = "Calibrating..."
+
+    def __str__(self):
+        """Return the text shown for the status."""
+        return self.value
+
+
+def describe(status, detail=None):
+    """Return the text shown for a status along with its detail, if any.
+
+    The detail goes before the trailing dots, e.g. "Draining (cycle 1 of
+    3)...".
+    """
+    text = str(status)
+    if not detail:
+        return text
+    if text.endswith("..."):
+        return text[:-3] + " " + detail + "..."
+    return text + " " + detail
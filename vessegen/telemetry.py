@@ -0,0 +1,499 @@
+"""Record the history of the chambers so it can be looked back on.
+
+Every change to a chamber and every valve event is written as a fixed-size
+record of (time, value, chamber, kind) to a ring file in the data directory,
+which wraps around once it holds vessegen.TELEMETRY_CAPACITY records, so the
+history never takes more than a set amount of space. As records are written
+they are also rolled up into buckets of each length in
+vessegen.TELEMETRY_ROLLUPS, holding the count, total, minimum, maximum and
+last value of each kind for each chamber, which are kept in ring files of
+their own. The rollups last far longer than the raw records, so a month of
+history can be plotted from them without reading every record.
+
+The files are memory mapped, and records are kept in time order, so finding
+a range of time is a binary search. The wall clock can be set back (by NTP,
+say), so a record that would be older than the one before it is stored at
+the same time as that one instead, and a rollup bucket is only written out
+once every chamber has moved past it. Query results are returned as columns
+of arrays rather than as lists of tuples, which keeps them small.
+"""
+import array
+import math
+import mmap
+import os
+import struct
+import threading
+import vessegen
+from vessegen import clock
+from vessegen import control
+from vessegen.status import Status
+
+# The kinds of records, which are stored by their index in this tuple. The
+# value of an "in_use" record is 1 or 0, of a "volume" record is the media in
+# the reservoir (in mL), and of a "status" record is the index of the status
+# in STATUSES. The value of a valve event ("opened", "closed", "done" or
+# "cancelled") is the pin, except for "done", which holds the media used. Each
+# time a valve closes, how long it was "requested" to be open and how long it
+# was "achieved" are recorded too (in seconds). A "forced" record holds a pin
+# the watchdog had to close.
+KINDS = ("in_use", "volume", "status", "opened", "closed", "done",
+         "cancelled", "requested", "achieved", "forced")
+
+# The statuses a chamber can have, stored by their index in this tuple. Any
+# other status is stored as the length of the tuple.
+STATUSES = tuple(status.value for status in Status)
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+
+# A raw record is (time, value, chamber, kind), and a rollup record is
+# (bucket start time, chamber, kind, count, total, minimum, maximum, last)
+RECORD = struct.Struct("<dfHH")
+ROLLUP = struct.Struct("<dHHIffff")
+
+# The names of the columns in query results, in the order of the records
+RECORD_COLUMNS = (("time", "d"), ("value", "f"), ("chamber", "H"),
+                  ("kind", "H"))
+ROLLUP_COLUMNS = (("time", "d"), ("chamber", "H"), ("kind", "H"),
+                  ("count", "I"), ("total", "f"), ("minimum", "f"),
+                  ("maximum", "f"), ("last", "f"))
+
+
+class RingFile:
+    """Fixed-size records kept in a file that wraps around once it is full.
+
+    The file starts with the index the next record will be written at and
+    the number of records it holds, followed by room for every record. If
+    the file was made for a different capacity, its newest records are
+    moved into a file of the new capacity. Each record also has a sequence
+    number, counting from the oldest record when the file was opened, which
+    stays the same when older records are replaced.
+    """
+
+    HEADER = struct.Struct("<QQ")
+
+    # How many records are read at a time
+    CHUNK = 1000
+
+    def __init__(self, path, record, capacity=None):
+        self.record = record
+
+        # Without a capacity, open the file as it is to read it
+        if capacity is None:
+            self.file = open(path, "rb")
+            size = os.fstat(self.file.fileno()).st_size
+            self.capacity = (size - self.HEADER.size) // record.size
+            if size < self.HEADER.size + record.size or\
+                    (size - self.HEADER.size) % record.size:
+                self.file.close()
+                raise ValueError(path + " is not a history file")
+            self.map = mmap.mmap(self.file.fileno(), size,
+                                 access=mmap.ACCESS_READ)
+        else:
+            self.capacity = capacity
+            size = self.HEADER.size + record.size * capacity
+            with open(path, "a+b") as ring:
+                existing = os.fstat(ring.fileno()).st_size
+                if not existing:
+                    ring.truncate(size)
+            if existing not in (0, size):
+                _resize(path, record, capacity)
+            self.file = open(path, "r+b")
+            self.map = mmap.mmap(self.file.fileno(), size)
+        self.head, self.count = self.HEADER.unpack_from(self.map, 0)
+        self.first = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, *values):
+        """Write a record, replacing the oldest one if the file is full."""
+        self.record.pack_into(self.map, self._offset(self.head), *values)
+        if self.count == self.capacity:
+            self.first += 1
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.HEADER.pack_into(self.map, 0, self.head, self.count)
+
+    def get(self, index):
+        """Return a record, with index 0 being the oldest."""
+        position = (self.head - self.count + index) % self.capacity
+        return self.record.unpack_from(self.map, self._offset(position))
+
+    def at(self, sequence):
+        """Return the records from a sequence number on, a chunk at a time.
+
+        Records that have been replaced are left out, so this starts from
+        the oldest record if it has a later sequence number.
+        """
+        start = max(sequence - self.first, 0)
+        return [self.get(index) for index in
+                range(start, min(start + self.CHUNK, self.count))]
+
+    def first_time(self):
+        """Return the time of the oldest record, or None if there are none."""
+        return self.get(0)[0] if self.count else None
+
+    def covers(self, when):
+        """Return True if no records from after a time have been replaced."""
+        return self.count < self.capacity or self.first_time() <= when
+
+    def bisect(self, when):
+        """Return the index of the first record at or after a time."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get(middle)[0] < when:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def flush(self):
+        """Write the records to disk."""
+        self.map.flush()
+
+    def close(self):
+        """Close the file."""
+        self.map.close()
+        self.file.close()
+
+    def _offset(self, position):
+        """Return where a record is in the file."""
+        return self.HEADER.size + position * self.record.size
+
+
+# Keep track of the ring files, the rollup buckets still being filled, and
+# what was last recorded for each chamber so only changes are written
+store = {
+    "raw": None,
+    "levels": [],
+    "last": {},
+    "latest": -math.inf,
+    "lock": threading.Lock(),
+    "wake": threading.Event(),
+    "thread": None
+}
+
+
+def _resize(path, record, capacity):
+    """Move the newest records of a ring file into one of a new capacity."""
+    old = RingFile(path, record)
+    try:
+        if os.path.exists(path + ".new"):
+            os.remove(path + ".new")
+        new = RingFile(path + ".new", record, capacity)
+        for index in range(max(len(old) - capacity, 0), len(old)):
+            new.append(*old.get(index))
+        new.flush()
+        new.close()
+    finally:
+        old.close()
+    os.replace(path + ".new", path)
+
+
+def open_history(directory=None):
+    """Open the history recorded by another process so it can be read.
+
+    The history is read as it was when it was opened. This does nothing if
+    the history is already open.
+    """
+    directory = os.path.join(directory or vessegen.DATA_DIR, "telemetry")
+    with store["lock"]:
+        if store["raw"] is not None:
+            return
+        levels = []
+        for name in os.listdir(directory):
+            if name.startswith("rollup-") and name.endswith(".bin"):
+                levels.append({
+                    "seconds": float(name[len("rollup-"):-len(".bin")]),
+                    "ring": RingFile(os.path.join(directory, name), ROLLUP),
+                    "buckets": {}
+                })
+        store["raw"] = RingFile(os.path.join(directory, "raw.bin"), RECORD)
+        store["levels"] = sorted(levels, key=lambda level: level["seconds"])
+
+
+def close_history():
+    """Close the history opened with open_history."""
+    with store["lock"]:
+        _close()
+
+
+def start(directory=None):
+    """Open the history and start recording changes to the chambers."""
+    directory = os.path.join(directory or vessegen.DATA_DIR, "telemetry")
+    os.makedirs(directory, exist_ok=True)
+    with store["lock"]:
+        store["raw"] = RingFile(os.path.join(directory, "raw.bin"), RECORD,
+                                vessegen.TELEMETRY_CAPACITY)
+        store["levels"] = [{
+            "seconds": seconds,
+            "ring": RingFile(os.path.join(directory, "rollup-" +
+                                          str(int(seconds)) + ".bin"),
+                             ROLLUP, capacity),
+            "buckets": {},
+            "start": None
+        } for seconds, capacity in vessegen.TELEMETRY_ROLLUPS]
+        store["last"] = {}
+        raw = store["raw"]
+        store["latest"] = raw.get(len(raw) - 1)[0] if len(raw) else\
+            -math.inf
+
+    # Record where each chamber starts out, then keep up with the changes
+    _on_change("run", range(len(control.chambers)))
+    control.listeners.append(_on_change)
+    store["wake"].clear()
+    store["thread"] = threading.Thread(target=_work, name="vessegen-telemetry",
+                                       daemon=True)
+    store["thread"].start()
+
+
+def stop():
+    """Write out what is recorded and stop recording."""
+    if store["thread"] is None:
+        return
+    if _on_change in control.listeners:
+        control.listeners.remove(_on_change)
+    store["wake"].set()
+    store["thread"].join()
+    store["thread"] = None
+
+    with store["lock"]:
+        # Write out the buckets that are still being filled
+        for level in store["levels"]:
+            _write_buckets(level)
+        _close()
+
+
+def record(chamber_id, kind, value, when=None):
+    """Record a value of some kind for a chamber.
+
+    The time is never earlier than that of the last record, so the records
+    stay in time order if the clock is set back.
+    """
+    when = clock.time() if when is None else when
+    kind = KINDS.index(kind)
+    with store["lock"]:
+        if store["raw"] is None:
+            return
+        when = store["latest"] = max(when, store["latest"])
+        store["raw"].append(when, value, chamber_id, kind)
+
+        # Add the value to the bucket it falls in at each level, writing out
+        # every bucket once the time has moved past them
+        for level in store["levels"]:
+            start_time = math.floor(when / level["seconds"]) * level["seconds"]
+            if start_time != level["start"]:
+                _write_buckets(level)
+                level["start"] = start_time
+            bucket = level["buckets"].get((chamber_id, kind))
+            if bucket is None:
+                level["buckets"][(chamber_id, kind)] =\
+                    [start_time, 1, value, value, value, value]
+            else:
+                bucket[1] += 1
+                bucket[2] += value
+                bucket[3] = min(bucket[3], value)
+                bucket[4] = max(bucket[4], value)
+                bucket[5] = value
+
+
+def record_progress(progress):
+    """Record a valve event, given the progress made by valves.progress."""
+    if progress["chamber_id"] is None:
+        return
+    record(progress["chamber_id"], progress["event"],
+           progress["volume"] if progress["event"] == "done" else
+           progress["pin"])
+    if "achieved" in progress:
+        record(progress["chamber_id"], "requested", progress["requested"])
+        record(progress["chamber_id"], "achieved", progress["achieved"])
+
+
+def query(start, end, chamber_id=None, kind=None, resolution=0, limit=None,
+          skip=0):
+    """Return the history between two times as columns of arrays.
+
+    The records can be narrowed down to a single chamber and kind. The raw
+    records are used if they go back far enough, or else the finest rollup
+    that does, and a resolution (in seconds) can be given to use a rollup at
+    least that coarse. The result is a dictionary holding the "resolution"
+    used (0 for raw records), and an array for each column, as named in
+    RECORD_COLUMNS or ROLLUP_COLUMNS.
+
+    If a limit is given, at most that many records are returned, and if
+    there are more, the result also holds "next", the arguments for the
+    next page: its "start", "resolution" and how many records to "skip",
+    since records at the start time may already have been returned.
+    """
+    resolution = choose_resolution(start, resolution)
+    names = ROLLUP_COLUMNS if resolution else RECORD_COLUMNS
+    result = {name: array.array(code) for name, code in names}
+
+    # Keep count of the records returned (or skipped) at the latest time, so
+    # the next page can skip them
+    count = 0
+    latest, same = start, 0
+    for values in scan(start, end, chamber_id, kind, resolution):
+        if skip and values[0] == start:
+            skip -= 1
+            same += 1
+            continue
+        if limit is not None and count >= limit:
+            result["next"] = {
+                "start": values[0],
+                "resolution": resolution,
+                "skip": same if values[0] == latest else 0
+            }
+            break
+        for (name, _), value in zip(names, values):
+            result[name].append(value)
+        count += 1
+        if values[0] == latest:
+            same += 1
+        else:
+            latest, same = values[0], 1
+    result["resolution"] = resolution
+    return result
+
+
+def choose_resolution(start, resolution=0):
+    """Return the resolution a query from a start time will be answered at.
+
+    This is 0 if the raw records will be used, or else the length of the
+    rollup buckets that will be used (in seconds).
+    """
+    with store["lock"]:
+        return _choose(start, resolution)[1]
+
+
+def scan(start, end, chamber_id=None, kind=None, resolution=0):
+    """Yield the records between two times, oldest first.
+
+    This takes the same arguments as query, but yields each record as a
+    tuple, so any amount of history can be gone through in constant memory.
+    The store is only locked for a short while at a time, so recording
+    carries on while the history is read. The records are read by their
+    sequence numbers, so none are missed or repeated when the oldest ones
+    are replaced, except those replaced before they could be read.
+    """
+    kind = None if kind is None else KINDS.index(kind)
+    with store["lock"]:
+        ring, resolution, names = _choose(start, resolution)
+        if ring is None:
+            return
+        sequence = ring.first + ring.bisect(start)
+
+    # The chamber and kind are at the same place in raw and rollup records
+    chamber_column = [name for name, _ in names].index("chamber")
+    while True:
+        with store["lock"]:
+            if store["raw"] is None:
+                return
+            chunk = ring.at(sequence)
+            sequence = max(sequence, ring.first) + len(chunk)
+
+        for values in chunk:
+            if values[0] >= end:
+                return
+            if chamber_id is not None and\
+                    values[chamber_column] != chamber_id:
+                continue
+            if kind is not None and values[chamber_column + 1] != kind:
+                continue
+            yield values
+        if not chunk:
+            break
+
+    # Rollups also include the buckets that are still being filled
+    if resolution:
+        with store["lock"]:
+            level = [level for level in store["levels"]
+                     if level["seconds"] == resolution][0]
+            buckets = sorted((bucket[0], key[0], key[1], *bucket[1:])
+                             for key, bucket in level["buckets"].items())
+        for values in buckets:
+            if start <= values[0] < end and\
+                    chamber_id in (None, values[1]) and kind in (None,
+                                                                 values[2]):
+                yield values
+
+
+def flush():
+    """Write the records to disk."""
+    with store["lock"]:
+        if store["raw"] is None:
+            return
+        store["raw"].flush()
+        for level in store["levels"]:
+            level["ring"].flush()
+
+
+def _choose(start, resolution):
+    """Choose the ring file to answer a query from.
+
+    Returns the ring file, its resolution and its columns.
+    """
+    if store["raw"] is None:
+        return None, resolution, RECORD_COLUMNS
+
+    # Use the finest ring file that goes back far enough, or else the
+    # coarsest, since it goes back the furthest
+    choices = [(level["ring"], level["seconds"], ROLLUP_COLUMNS)
+               for level in store["levels"] if level["seconds"] >= resolution]
+    if not resolution or not choices:
+        choices.insert(0, (store["raw"], 0, RECORD_COLUMNS))
+    for choice in choices:
+        if choice[0].covers(start):
+            return choice
+    return choices[-1]
+
+
+def _close():
+    """Close the ring files."""
+    if store["raw"] is None:
+        return
+    for level in store["levels"]:
+        level["ring"].close()
+    store["raw"].close()
+    store["raw"] = None
+    store["levels"] = []
+
+
+def _write_buckets(level):
+    """Write out the rollup buckets of a level that are being filled."""
+    for key, bucket in sorted(level["buckets"].items()):
+        level["ring"].append(bucket[0], key[0], key[1], *bucket[1:])
+    level["buckets"] = {}
+
+
+def _status_code(status):
+    """Return the number a status is stored as."""
+    return STATUS_CODES.get(status, len(STATUSES))
+
+
+def _on_change(kind, chamber_ids):
+    """Record what changed about the chambers.
+
+    This is a control listener, so it is called with the kind of change and
+    the IDs of the chambers that changed.
+    """
+    for chamber_id in chamber_ids:
+        chamber = control.chambers[chamber_id]
+        now = (chamber.is_in_use, chamber.media_in_chamber, chamber.status)
+        last = store["last"].get(chamber_id, (None, None, None))
+        if now == last:
+            continue
+        store["last"][chamber_id] = now
+        when = clock.time()
+        if now[0] != last[0]:
+            record(chamber_id, "in_use", 1 if now[0] else 0, when)
+        if now[1] != last[1]:
+            record(chamber_id, "volume", now[1], when)
+        if now[2] != last[2]:
+            record(chamber_id, "status", _status_code(now[2]), when)
+
+
+def _work():
+    """Write the records to disk every so often until told to stop."""
+    while not store["wake"].wait(vessegen.TELEMETRY_FLUSH_INTERVAL):
+        flush()
@@ -0,0 +1,85 @@
+"""Keep track of timed work so the GUI only wakes up when there is work."""
+import heapq
+import itertools
+import math
+import time
+from vessegen import clock
+from vessegen import metrics
+
+# A heap of (when, order, name) tuples for the timers that are waiting to run.
+# Timers that are cancelled or rescheduled are left in the heap and skipped
+# when they come up, since removing them from the middle of a heap is slow.
+heap = []
+
+# The timers that are waiting to run, keyed by name, each holding the time it
+# should run, its order in the heap and the function to call
+pending = {}
+
+# Break ties between timers due at the same time in the order they were added
+order = itertools.count()
+
+# When the last window read returned, to measure how long events take to
+# handle when profiling
+loop = {
+    "returned": None
+}
+
+
+def schedule(name, when, callback):
+    """Run the callback at the given time.
+
+    Scheduling a timer with the same name as one that is waiting replaces it.
+    """
+    entry = (when, next(order), name)
+    pending[name] = (entry, callback)
+    heapq.heappush(heap, entry)
+
+
+def cancel(name):
+    """Stop a timer from running, if it is waiting."""
+    pending.pop(name, None)
+
+
+def next_deadline():
+    """Return the time the next timer is due, or None if there are none."""
+    # Throw away any timers that were cancelled or rescheduled
+    while heap and pending.get(heap[0][2], (None,))[0] != heap[0]:
+        heapq.heappop(heap)
+    return heap[0][0] if heap else None
+
+
+def run_due(now=None):
+    """Run every timer that is due."""
+    now = clock.time() if now is None else now
+    while True:
+        deadline = next_deadline()
+        if deadline is None or deadline > now:
+            break
+        _, _, name = heapq.heappop(heap)
+        _, callback = pending.pop(name)
+        if metrics.profile["enabled"]:
+            metrics.observe("gui_timer_lag", now - deadline)
+        callback()
+
+
+def read(window):
+    """Read an event from the window, running timers while we wait.
+
+    The window is read until the next timer is due or a real event arrives,
+    so nothing wakes up the CPU when there is no work to do. Every window
+    reads its events through here, so the timers keep running no matter which
+    window is open.
+    """
+    if metrics.profile["enabled"] and loop["returned"] is not None:
+        metrics.observe("gui_event_handling",
+                        time.perf_counter() - loop["returned"])
+
+    deadline = next_deadline()
+    if deadline is None:
+        event, values = window.read()
+    else:
+        timeout = max(math.ceil((deadline - clock.time()) * 1000), 0)
+        event, values = window.read(timeout=timeout)
+    run_due()
+    loop["returned"] = time.perf_counter()
+    return event, values
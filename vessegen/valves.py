@@ -0,0 +1,293 @@
+"""Drive the solenoid valves for several chambers at the same time.
+
+The volume of media moved depends on how long a valve is open, so the engine
+times the valves with the monotonic clock in whole nanoseconds. Each valve's
+deadline is counted from the moment it was actually opened, and the time it
+was actually open is kept alongside the time asked for.
+"""
+import vessegen
+from vessegen import clock
+from vessegen import gpio
+from vessegen import metrics
+from vessegen.status import Status
+
+
+def new_engine(max_open=None):
+    """Create a new valve engine.
+
+    The engine keeps track of the jobs that are waiting for a valve, the jobs
+    that currently have a valve open, and the maximum number of valves that
+    may be open at once.
+    """
+    return {
+        "max_open": max_open or vessegen.MAX_OPEN_VALVES,
+        "waiting": [],
+        "running": []
+    }
+
+
+def pin_job(pin, duration, chamber_id=None, status=None):
+    """Create a job that opens a single pin for the given duration."""
+    return {
+        "chamber_id": chamber_id,
+        "steps": [
+            {
+                "pin": pin,
+                "duration": duration,
+                "status": status
+            }
+        ],
+        "step": 0,
+        "ready_at": 0,
+        "opened_at": None,
+        "deadline": None,
+        "timing": None
+    }
+
+
+def media_change_job(chamber_id, time_to_remove, time_to_add, volume=0):
+    """Create a job that removes and then adds media for a single chamber.
+
+    The volume is the amount of media we estimate will be taken from the
+    reservoir, so it can be subtracted once the job is done.
+    """
+    pins = vessegen.GPIO_PINS[chamber_id]
+    return {
+        "chamber_id": chamber_id,
+        "volume": volume,
+        "steps": [
+            {
+                "pin": pins["remove"],
+                "duration": time_to_remove,
+                "status": Status.REMOVING
+            },
+            {
+                "pin": pins["add"],
+                "duration": time_to_add,
+                "status": Status.ADDING
+            }
+        ],
+        "step": 0,
+        "ready_at": 0,
+        "opened_at": None,
+        "deadline": None,
+        "timing": None
+    }
+
+
+def wash_job(chamber_id, time_to_remove, times_to_add, soak, volume=0):
+    """Create a job that washes a single chamber.
+
+    Each cycle drains the chamber, fills it with wash media and leaves it to
+    soak, and the chamber is drained once more at the end, so there is one
+    cycle for each of the times to add. The valves are closed while the
+    chamber soaks, so other chambers can use them. The volume is the wash
+    media we estimate will be taken from the reservoir.
+    """
+    pins = vessegen.GPIO_PINS[chamber_id]
+    cycles = len(times_to_add)
+    steps = []
+    for cycle, time_to_add in enumerate(times_to_add):
+        label = "(cycle " + str(cycle + 1) + " of " + str(cycles) + ")"
+        steps.append({
+            "pin": pins["remove"],
+            "duration": time_to_remove,
+            "status": Status.DRAINING,
+            "detail": label
+        })
+        steps.append({
+            "pin": pins["add"],
+            "duration": time_to_add,
+            "status": Status.FILLING,
+            "detail": label,
+            "soak": soak
+        })
+    steps.append({
+        "pin": pins["remove"],
+        "duration": time_to_remove,
+        "status": Status.DRAINING_WASH
+    })
+    return {
+        "chamber_id": chamber_id,
+        "kind": "wash",
+        "volume": volume,
+        "steps": steps,
+        "step": 0,
+        "ready_at": 0,
+        "opened_at": None,
+        "deadline": None,
+        "timing": None
+    }
+
+
+def calibration_job(chamber_id, valve, duration):
+    """Create a job that opens one valve of a chamber for a test pulse.
+
+    The valve is "add" or "remove". The media it moves is measured by hand,
+    then fitted against how long the valve was actually open (see
+    vessegen/calibration.py).
+    """
+    return {
+        "chamber_id": chamber_id,
+        "kind": "calibration",
+        "steps": [
+            {
+                "pin": vessegen.GPIO_PINS[chamber_id][valve],
+                "duration": duration,
+                "status": Status.CALIBRATING,
+                "detail": "the " + valve + " valve"
+            }
+        ],
+        "step": 0,
+        "ready_at": 0,
+        "opened_at": None,
+        "deadline": None,
+        "timing": None
+    }
+
+
+def submit(engine, job):
+    """Queue a job so its valves are opened as soon as there is room."""
+    engine["waiting"].append(job)
+
+
+def is_idle(engine):
+    """Return True if the engine has no jobs left to run."""
+    return not engine["waiting"] and not engine["running"]
+
+
+def progress(job, event):
+    """Describe an event for a job so it can be passed to other threads.
+
+    The description is a dictionary holding the "chamber_id", the "event"
+    ("opened", "closed", "done" or "cancelled"), the "pin" it happened to
+    (for "closed", the pin that closed), the "status" and "detail" of the
+    step that is running (see vessegen/status.py), the "kind" of job
+    ("media_change", "wash" or "calibration") and the "volume" of the job.
+    For "closed" and "done", it also holds how long the valve that closed
+    was "requested" to be open and how long it was "achieved" (in seconds),
+    and for "closed", how long the chamber will "soak" before its next step.
+    """
+    step = job["steps"][min(job["step"], len(job["steps"]) - 1)]
+    closed = job["steps"][job["step"] - 1]
+    result = {
+        "chamber_id": job["chamber_id"],
+        "event": event,
+        "pin": closed["pin"] if event == "closed" else step["pin"],
+        "status": step["status"],
+        "detail": step.get("detail"),
+        "kind": job.get("kind", "media_change"),
+        "volume": job.get("volume", 0)
+    }
+    if event in ("closed", "done") and job.get("timing") is not None:
+        result["requested"], result["achieved"] = job["timing"]
+    if event == "closed":
+        result["soak"] = closed.get("soak", 0)
+    return result
+
+
+def poll(engine, now):
+    """Open and close valves that are due, returning what happened.
+
+    The time is the monotonic time in nanoseconds (from clock.monotonic_ns).
+    The return value is a list of (job, event) tuples, where event is one of
+    "opened", "closed" or "done".
+    """
+    events = []
+
+    # First, close any valves that have been open long enough, all at once
+    closing = [job for job in engine["running"] if now >= job["deadline"]]
+    if closing:
+        gpio.output_many([job["steps"][job["step"]]["pin"]
+                          for job in closing], gpio.LOW)
+        closed_at = clock.monotonic_ns()
+    for job in closing:
+        step = job["steps"][job["step"]]
+        job["timing"] = (step["duration"],
+                         (closed_at - job["opened_at"]) / 1e9)
+        if metrics.profile["enabled"]:
+            metrics.observe("valve_close_lag",
+                            (closed_at - job["deadline"]) / 1e9)
+        engine["running"].remove(job)
+        job["step"] += 1
+        job["opened_at"] = None
+        job["deadline"] = None
+
+        # If the job has more steps, let the valve settle (and the chamber
+        # soak, if it should) and then put it at the front of the line so
+        # chambers that were started finish first
+        if job["step"] < len(job["steps"]):
+            job["ready_at"] = closed_at + round(
+                (vessegen.VALVE_SETTLE_TIME + step.get("soak", 0)) * 1e9)
+            engine["waiting"].insert(0, job)
+            events.append((job, "closed"))
+        else:
+            events.append((job, "done"))
+
+    # Then, open valves for waiting jobs while we are under the limit, again
+    # all at once
+    room = engine["max_open"] - len(engine["running"])
+    opening = [job for job in engine["waiting"]
+               if now >= job["ready_at"]][:max(room, 0)]
+    if opening:
+        gpio.output_many([job["steps"][job["step"]]["pin"]
+                          for job in opening], gpio.HIGH)
+        opened_at = clock.monotonic_ns()
+    for job in opening:
+        step = job["steps"][job["step"]]
+        job["opened_at"] = opened_at
+        if metrics.profile["enabled"] and job["step"]:
+            metrics.observe("valve_open_lag",
+                            (opened_at - job["ready_at"]) / 1e9)
+        job["deadline"] = opened_at + round(step["duration"] * 1e9)
+        engine["waiting"].remove(job)
+        engine["running"].append(job)
+        events.append((job, "opened"))
+
+    return events
+
+
+def next_deadline(engine):
+    """Return the next time the engine needs to be polled, or None if idle.
+
+    The time is the monotonic time in nanoseconds.
+    """
+    deadlines = [job["deadline"] for job in engine["running"]]
+
+    # Waiting jobs only matter if there is room to open their valves
+    if len(engine["running"]) < engine["max_open"]:
+        deadlines += [job["ready_at"] for job in engine["waiting"]]
+
+    return min(deadlines) if deadlines else None
+
+
+def cancel(engine, chamber_ids):
+    """Drop the jobs for some chambers, returning the jobs dropped.
+
+    The valves of the jobs that are running are closed, all at once.
+    """
+    chamber_ids = set(chamber_ids)
+    jobs = [job for job in engine["running"] + engine["waiting"]
+            if job["chamber_id"] in chamber_ids]
+    running = [job for job in jobs if job in engine["running"]]
+    gpio.output_many([job["steps"][job["step"]]["pin"] for job in running],
+                     gpio.LOW)
+
+    engine["running"] = [job for job in engine["running"]
+                         if job not in running]
+    engine["waiting"] = [job for job in engine["waiting"]
+                         if job["chamber_id"] not in chamber_ids]
+    return jobs
+
+
+def cancel_all(engine):
+    """Close every valve and drop all jobs, returning the jobs dropped."""
+    jobs = engine["running"] + engine["waiting"]
+
+    # Close the valves of every chamber, not just the ones we know are open
+    gpio.output_many([pin for pins in vessegen.GPIO_PINS
+                      for pin in (pins["remove"], pins["add"])], gpio.LOW)
+
+    engine["running"] = []
+    engine["waiting"] = []
+    return jobs
@@ -0,0 +1,207 @@
+"""Close any valve left open past its deadline, whatever else goes wrong.
+
+The actuator closes every valve on time as long as it keeps running. The
+watchdog runs on a thread of its own and is told by the actuator which pins
+are open and when each should close (see track). If a pin is still open
+vessegen.WATCHDOG_GRACE seconds after its deadline, the watchdog drives it
+LOW itself. The actuator stamps a heartbeat every time it goes round its
+loop, which it does at least every vessegen.WATCHDOG_INTERVAL seconds. The
+heartbeat is checked every vessegen.WATCHDOG_INTERVAL seconds, and if the
+actuator has died or its heartbeat is more than vessegen.WATCHDOG_STALL
+seconds old, every valve pin is driven LOW, since it may have stopped
+opening a pin before it could say so. Each intervention is written to
+stderr, and those for open pins are handed to the listener, which records
+them in the history.
+
+The actuator holds the lock returned by writing from when it polls the
+engine until it has told the watchdog which pins are open, and the watchdog
+holds it while it closes pins. That way the watchdog never closes a pin that
+was closed and opened again for another job before it heard about it.
+
+check does the work of a single pass, so the watchdog can be tested with a
+simulated board and a virtual clock without the thread.
+"""
+import sys
+import threading
+import vessegen
+from vessegen import clock
+from vessegen import gpio
+
+# Keep track of the pins that are open, as pin: (deadline, chamber ID), along
+# with the lock for writing to the pins, the watchdog thread, how to read the
+# actuator's heartbeat (and whether it was found dead), and who should hear
+# about interventions
+watch = {
+    "armed": {},
+    "condition": threading.Condition(),
+    "lock": threading.Lock(),
+    "thread": None,
+    "running": False,
+    "heartbeat": None,
+    "dead": False,
+    "listener": None
+}
+
+
+def start(heartbeat=None):
+    """Start the watchdog thread if it isn't already running.
+
+    heartbeat is called to find out when the actuator last went round its
+    loop (the monotonic time in nanoseconds), or None if it has stopped.
+    Every valve is closed if it has stopped, or if it hasn't gone round for
+    vessegen.WATCHDOG_STALL seconds.
+    """
+    if watch["thread"] is not None and watch["thread"].is_alive():
+        return
+    watch["heartbeat"] = heartbeat
+    watch["dead"] = False
+    watch["running"] = True
+    watch["thread"] = threading.Thread(target=_work, name="vessegen-watchdog",
+                                       daemon=True)
+    watch["thread"].start()
+
+
+def stop():
+    """Stop the watchdog thread."""
+    if watch["thread"] is None:
+        return
+    with watch["condition"]:
+        watch["running"] = False
+        watch["condition"].notify_all()
+    watch["thread"].join()
+    watch["thread"] = None
+
+
+def set_listener(listener):
+    """Set the function that is told about interventions.
+
+    The listener is called from the watchdog thread with a dictionary like
+    the ones made by valves.progress, with the "event" "forced", the "pin"
+    and how "late" (in seconds) it was closed.
+    """
+    watch["listener"] = listener
+
+
+def writing():
+    """Return the lock held while the valves are opened and closed.
+
+    The actuator holds it from polling the engine until it has called track.
+    """
+    return watch["lock"]
+
+
+def track(engine):
+    """Note the pins the engine has open and when each should close.
+
+    The actuator calls this every time it has polled the engine, so the
+    watchdog always knows what should be open.
+    """
+    armed = {job["steps"][job["step"]]["pin"]: (job["deadline"],
+                                                job["chamber_id"])
+             for job in engine["running"]}
+    with watch["condition"]:
+        if armed != watch["armed"]:
+            watch["armed"] = armed
+            watch["condition"].notify_all()
+
+
+def next_deadline():
+    """Return when the next pin is overdue, or None if no pins are open.
+
+    The time is the monotonic time in nanoseconds.
+    """
+    with watch["condition"]:
+        if not watch["armed"]:
+            return None
+        return min(deadline for deadline, _ in watch["armed"].values()) +\
+            round(vessegen.WATCHDOG_GRACE * 1e9)
+
+
+def check(now):
+    """Close the pins that are overdue, returning the interventions.
+
+    The time is the monotonic time in nanoseconds. Every open pin is overdue
+    if the actuator has died or is stuck, and the first time it is found that
+    way every valve pin is driven LOW, in case it stopped before it could say
+    which pins it had opened.
+    """
+    grace = round(vessegen.WATCHDOG_GRACE * 1e9)
+
+    # The actuator holds the lock while it opens and closes valves, so if
+    # it can't be had in time, the actuator is stuck part way through
+    held = watch["lock"].acquire(timeout=vessegen.WATCHDOG_STALL)
+    try:
+        dead = not held or not _alive(now)
+        with watch["condition"]:
+            overdue = {pin: armed for pin, armed in watch["armed"].items()
+                       if dead or now >= armed[0] + grace}
+            closing = list(overdue)
+            died = dead and not watch["dead"]
+            watch["dead"] = dead
+            if died:
+                closing += [pin for pins in vessegen.GPIO_PINS
+                            for pin in (pins["remove"], pins["add"])]
+            if not closing:
+                return []
+            gpio.output_many(dict.fromkeys(closing), gpio.LOW)
+            closed_at = clock.monotonic_ns()
+            for pin in overdue:
+                del watch["armed"][pin]
+    finally:
+        if held:
+            watch["lock"].release()
+
+    if died:
+        sys.stderr.write("vessegen-watchdog: forced every valve LOW, the "
+                         "actuator has stopped responding\n")
+
+    interventions = []
+    for pin, (deadline, chamber_id) in overdue.items():
+        intervention = {
+            "chamber_id": chamber_id,
+            "event": "forced",
+            "pin": pin,
+            "status": None,
+            "volume": 0,
+            "late": (closed_at - deadline) / 1e9
+        }
+        sys.stderr.write("vessegen-watchdog: forced pin " + str(pin) +
+                         " LOW " + format(intervention["late"], ".6f") +
+                         " s after its deadline" +
+                         (" (the actuator has stopped responding)" if dead
+                          else "") +
+                         "\n")
+        if watch["listener"] is not None:
+            watch["listener"](intervention)
+        interventions.append(intervention)
+    return interventions
+
+
+def _alive(now):
+    """Return False if the actuator has died or its heartbeat is too old."""
+    if watch["heartbeat"] is None:
+        return True
+    beat = watch["heartbeat"]()
+    return beat is not None and\
+        now - beat <= round(vessegen.WATCHDOG_STALL * 1e9)
+
+
+def _work():
+    """Check the open pins as each one's grace period runs out."""
+    while True:
+        with watch["condition"]:
+            if not watch["running"]:
+                break
+
+            # Sleep until shortly before the next pin is overdue, waking up
+            # if the pins change, then wait out the rest precisely
+            deadline = next_deadline()
+            timeout = vessegen.WATCHDOG_INTERVAL if deadline is None else\
+                min((deadline - clock.monotonic_ns()) / 1e9 -
+                    vessegen.VALVE_SPIN_TIME, vessegen.WATCHDOG_INTERVAL)
+            if timeout > 0 and watch["condition"].wait(timeout):
+                continue
+        if deadline is not None and deadline - clock.monotonic_ns() <=\
+                round(vessegen.VALVE_SPIN_TIME * 1e9):
+            clock.sleep_until_ns(deadline)
+        check(clock.monotonic_ns())